@@ -1,10 +1,13 @@
 import argparse
 import translate_search
-from abundance import annotation
+from streaming import run_streaming
+import batch
+from abundance import annotation, counts_table_annotation
 from annotation import blast_search
 from blast_annotation import run_blast
+from enzyme_search import run_enzyme_search
 from quantify_hmm import quantify_hmm
-from pathmanager import PathManager
+from pathmanager import PathManager, check_arg
 import traceback
 from database_operations import database_fetch
 from hmm_operations import hmm_fetch
@@ -13,42 +16,63 @@ import logging
 import threading
 
 
-def main(args, debug=False, blast=True):
+def main(args, debug=False, blast=True, scheduler=None):
     """Main function to run PlasticTools.
 
     Args:
         args (argparse.Namespace): Parsed command-line arguments.
         debug (bool, optional): If True, enables debug logging. Defaults to False.
         blast (bool, optional): If True, enables blast search. Defaults to True.
-    """
+        scheduler (CoreScheduler, optional): Core budget shared with other runs. Defaults to None.
 
+    Returns:
+        pandas.DataFrame: The abundance table of the run.
+    """
 
-    # Create an instance of PathManager with the provided arguments
-    p = PathManager(args)
 
-    # Set up logging
+    # Set up logging, before PathManager and its CoreScheduler log anything to the unconfigured root logger
     if debug:
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.WARNING)
+
+    # Create an instance of PathManager with the provided arguments
+    p = PathManager(args, scheduler)
     
-    # extract ORFs from the contigs and translate them into protein code using PRODIGAL
-    logging.info('Extracting ORFs using PRODIGAL...')
-    translate_search.run_prodigal(p)
-    
-    # Search extracted ORFs with HMM motifs using HMMER
-    logging.info('Searching for HMM hits...')
-    translate_search.run_hmmer(p)
+    saf_paths = None
+    if p.in_process_search:
+        # Predict the genes with pyrodigal and search their proteins with pyhmmer, without writing them to disk
+        logging.info('Predicting genes and searching for HMM hits in process...')
+        translate_search.run_gene_search(p)
+    elif p.streaming:
+        # Search the ORFs of every chunk of contigs as soon as PRODIGAL translated it
+        logging.info('Extracting ORFs and searching for HMM hits chunk by chunk...')
+        saf_paths = run_streaming(p)
+    else:
+        # extract ORFs from the contigs and translate them into protein code using PRODIGAL
+        logging.info('Extracting ORFs using PRODIGAL...')
+        translate_search.run_prodigal(p)
+        
+        # Search extracted ORFs with HMM motifs using HMMER
+        logging.info('Searching for HMM hits...')
+        translate_search.run_hmmer(p)
+
+    # Find the closest known enzyme of every hit, in process and without BLAST
+    logging.info('Searching hits for known plastic degrading enzymes...')
+    run_enzyme_search(p)
 
     if blast:
         # Create a thread to run blast search in the background
         logging.info('Blasting reads...')
-        blast_thread = threading.Thread(target=run_blast, args=(p.output,))
+        blast_thread = threading.Thread(target=run_blast, args=(p.output, p.scheduler, p.blast_db))
         blast_thread.start()
 
-    # Continue with annotation
+    # Continue with annotation, precomputed count tables replace counting the mapping files
     logging.info('Calculating abundances...')
-    annotation(p)
+    if p.counts_tables:
+        abundances = counts_table_annotation(p)
+    else:
+        abundances = annotation(p, saf_paths)
 
     if blast:
         # Wait for blast to finish
@@ -56,11 +80,13 @@ def main(args, debug=False, blast=True):
 
     # Create html
     logging.info('Creating html report...')
-    create_html(p)
+    create_html(p, abundances)
 
     # Remove temporary files
     logging.info('Removing temporary files...')
     remove_temps(p, debug) # debug=True to keep temporary files and only moving fasta, tsv and html files to the output directory
+
+    return abundances
     
 
 
@@ -88,14 +114,28 @@ if __name__ == "__main__":
     # Add required arguments
     required.add_argument('--output', required=True, help='Provide the output directory where all temporary files and outputs will be saved')
     required.add_argument('--plastic', required=True, help='Provide type of plastic searched (PLA,PET,nylon...)')
-    required.add_argument('--contigs', required=True, help='Provide contigs file path')
-    required.add_argument('--mappings', help='Provide path to BAM/SAM files separated by the comma')
+    required.add_argument('--contigs', help='Provide contigs file path, not needed with --manifest')
+    required.add_argument('--mappings', help='Provide path to BAM/SAM files separated by the comma, not needed with --counts_table')
  
     # Add optional arguments
+    optional.add_argument('--manifest', help='Run every sample of a TSV manifest with the columns sample, contigs and comma separated BAM/SAM files')
     optional.add_argument('--b', action='store_false', help='Disable blast')
+    optional.add_argument('--blast_db', help='BLAST protein database searched for the annotation (default: $PLASTICTOOLS_BLAST_DB or swissprot)')
     optional.add_argument('--p', action='store_true', help='Enable multiprocessing')
-    optional.add_argument('--f', action='store_true', help='Force overwrite existing files')
+    optional.add_argument('--threads', type=int, help='Number of cores shared by all tools (default: all cores available to the process)')
+    optional.add_argument('--max_memory', '--max-memory', type=float, help='Memory cap in GB for the tools running in parallel, tasks wait until their estimated memory fits')
+    optional.add_argument('--f', action='store_true', help='Force overwrite existing files and rerun all stages')
+    optional.add_argument('--k', action='store_true', help='Keep temporary files and stage checkpoints so later runs can resume from them')
     optional.add_argument('--d', action='store_true', help='Enable debug logging')
+    optional.add_argument('--cache_size', type=float, help='Size cap in GB of the shared Prodigal output cache, 0 disables it (default: 50)')
+    optional.add_argument('--combined', action='store_true', help='Search all plastic motifs in a single pass over the proteins')
+    optional.add_argument('--stream', action='store_true', help='Search the proteins of every chunk of contigs as soon as it is translated')
+    optional.add_argument('--combined_counts', action='store_true', help='Count all plastics and mapping files with a single featureCounts run')
+    optional.add_argument('--counts_table', '--counts-table', help='Comma separated per-contig count tables (samtools idxstats, long or wide) read instead of the mapping files')
+    optional.add_argument('--hmm_engine', choices=['auto', 'hmmsearch', 'pyhmmer'], default='auto', help='Search the motifs with the hmmsearch binary or in process with pyhmmer, auto uses pyhmmer when it is installed, except with --stream or --combined (default: auto)')
+    optional.add_argument('--gene_finder', choices=['auto', 'prodigal', 'pyrodigal'], default='auto', help='Predict genes with the prodigal binary or in process with pyrodigal, auto uses pyrodigal when it is installed, except with --stream (default: auto)')
+    optional.add_argument('--write_genes', action='store_true', help='Write the predicted .faa and .ffn sequences also when pyrodigal proteins are searched in memory')
+    optional.add_argument('--counter', choices=['featurecounts', 'regions'], default='featurecounts', help='Count reads with featureCounts, or in process reading only the hit gene regions of indexed BAM files (default: featurecounts)')
  
     optional.add_argument('-v', '--version', action='version', version='%(prog)s 1.0', help="Show the version number and exit")
     optional.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS,
@@ -112,7 +152,12 @@ if __name__ == "__main__":
             database_fetch(plastic_type, args.output)
         elif args.command == 'hmm-fetch':
             hmm_fetch(args.output)
+        elif args.manifest:
+            batch.run_batch(args, batch.read_manifest(args.manifest), main, debug=args.d, blast=not args.b)
         else:
+            check_arg(args.contigs, "contigs")
+            if args.counts_table is None:
+                check_arg(args.mappings, "mappings")
             main(args, debug=args.d, blast=not args.b)
        
     except Exception as e:
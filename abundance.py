@@ -1,80 +1,193 @@
-from Bio import SeqIO
 import os
-import utilities
+import region_counts
+import counts_tables
+from hmmer_tables import gene_contig, gene_contigs
+from scheduler import estimate_memory
 import subprocess
-import time
-import multiprocessing
+from multiprocessing.pool import ThreadPool
 from functools import partial
 import logging
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Columns of the abundance table, the sample TSV files hold all but the sample column
+ABUNDANCE_COLUMNS = ["sample", "plastic name", "reads mapped", "total reads", "proportion", "rpkm"]
+
+# featureCounts tables with at least this many sample columns are parsed with the wide-table fast path
+WIDE_TABLE_SAMPLES = 64
+
+# Longest genomic span of a read that combined counting has to account for
+READ_SPAN = 1000
 
 def check_translate_result(p):
 
-    # Check if aa and nt files exist
+    # Check if the gene coordinates exist, in the GFF or the nt file; proteins searched in memory have no aa and nt files
     contigs_file = os.path.basename(p.contigs)
     contigs_base = contigs_file.split(".")[0]
-    aa_file = os.path.join(p.temps, f"{contigs_base}.faa")
+    gff_file = os.path.join(p.temps, f"{contigs_base}.gff")
     nt_file = os.path.join(p.temps, f"{contigs_base}.ffn")
     
-    if not os.path.isfile(aa_file):
-        logging.warning(f"AA file {aa_file} does not exist.")
-        return False
-    
-    if not os.path.isfile(nt_file):
-        logging.warning(f"NT file {nt_file} does not exist.")
+    if not os.path.isfile(gff_file) and not os.path.isfile(nt_file):
+        logging.warning(f"Neither the GFF file {gff_file} nor the NT file {nt_file} exists.")
         return False
     
     # If all checks passed
     return True
 
-def search_for_hits(hits_file_path, genes_file_path, output_file_path):
-    # Read all sequence IDs from hits.fa into a list
-    hits_ids = [rec.id for rec in SeqIO.parse(hits_file_path, "fasta")]
-
-    # Open output file
-    with open(output_file_path, "w") as output_file:
-        # Open genes.ffn and iterate through each sequence
-        with open(genes_file_path, "r") as genes_file:
-            for record in SeqIO.parse(genes_file, "fasta"):
-                # If the sequence ID (without the extra details) is in the list of hits
-                # write it to the output file with original header from genes.ffn
-                if '_'.join(record.id.split('_')[0:3]) in hits_ids:
-                    SeqIO.write(record, output_file, "fasta")
-
-def correct_ffn_file(input_file, output_file):
-    with open(input_file, 'r') as original, open(output_file, 'w') as corrected:
-        for record in SeqIO.parse(original, 'fasta'):
-            header = record.description.split(' ')
-            contig_id, start, end, strand = header[0], int(header[2]), int(header[4]), int(header[6])
-            if strand == -1:
-                record.seq = record.seq.reverse_complement()
-            record.id = record.description  # Important: Ensure record.id is the same as record.description
-            SeqIO.write(record, corrected, "fasta")  # Use SeqIO.write to write the record in FASTA format
-
-def ffn_to_saf(input_ffn_file, output_saf_file):
-    with open(input_ffn_file, "r") as ffn, open(output_saf_file, "w") as saf:
-        # Write the SAF header
-        saf.write("\t".join(["GeneID", "Chr", "Start", "End", "Strand"]) + "\n")
-        
-        # Parse each FASTA entry in the input file
-        for record in SeqIO.parse(ffn, "fasta"):
-            # Extract information from the record description
-            fields = record.description.split("#")
+def read_hit_ids(hits_file_path):
+    # Only the headers are needed, so skip the sequences instead of parsing every record
+    with open(hits_file_path, "r") as hits_file:
+        return {line[1:].split(None, 1)[0] for line in hits_file if line.startswith(">") and line[1:].strip()}
+
+def hits_output_base(temp_folder_path):
+    fasta_files = [file for file in os.listdir(temp_folder_path) if file.endswith('.fasta')]
+    if not fasta_files:
+        return None, None
+    return os.path.join(temp_folder_path, fasta_files[0]), os.path.basename(fasta_files[0]).split(".")[0]
+
+def demultiplex_hits(p, plastic_types):
+    """Map every hit gene to the plastics it was found for, reading the hits file of every plastic once.
+
+    A gene can hit several motifs. The genes are matched against this map in a single pass over
+    all genes, which demultiplexes them to their plastics, instead of one pass per plastic.
+
+    Args:
+        p (PathManager): The path manager of the current run.
+        plastic_types (list): The plastics to map the hits of.
+
+    Returns:
+        tuple: The plastics of every hit gene ID, and the base name of the hits file of every
+            plastic that has one.
+    """
+    hit_plastics = {}
+    output_bases = {}
+    for plastic_type in plastic_types:
+        temp_folder_path = os.path.join(p.temps, plastic_type)
+        hits_file_path, output_file_base = hits_output_base(temp_folder_path)
+        if hits_file_path is None:
+            continue
+        output_bases[plastic_type] = output_file_base
+        for hit_id in read_hit_ids(hits_file_path):
+            hit_plastics.setdefault(hit_id, []).append(plastic_type)
+    return hit_plastics, output_bases
+
+def read_gene_coordinates(p):
+    """Yield the SAF fields of every predicted gene without reading any sequence.
+
+    The coordinates come from the Prodigal GFF output when present, otherwise from the
+    '# start # end # strand #' fields of the .ffn headers.
+
+    Args:
+        p (PathManager): The path manager of the current run.
+
+    Yields:
+        tuple: GeneID, Chr, Start, End and Strand of a gene.
+    """
+    contigs_base = os.path.basename(p.contigs).split(".")[0]
+    gff_file_path = os.path.join(p.temps, f"{contigs_base}.gff")
+    genes_file_path = os.path.join(p.temps, f"{contigs_base}.ffn")
+
+    if os.path.isfile(gff_file_path):
+        yield from gff_gene_coordinates(gff_file_path)
+    else:
+        yield from ffn_gene_coordinates(genes_file_path)
+
+def gff_gene_coordinates(gff_file_path):
+    # Yields the SAF fields of every gene in a Prodigal GFF file
+    with open(gff_file_path, "r") as gff:
+        for line in gff:
+            if line.startswith("#") or not line.strip():
+                continue
+            fields = line.rstrip("\n").split("\t")
+            # Prodigal numbers genes per sequence as ID=<sequence>_<gene>, the .ffn IDs use <contig>_<gene>
+            gene_number = fields[8].split(";", 1)[0].rsplit("_", 1)[-1]
+            yield f"{fields[0]}_{gene_number}", fields[0], fields[3], fields[4], fields[6]
+
+def ffn_gene_coordinates(genes_file_path):
+    # Yields the SAF fields of every gene from the headers of a Prodigal .ffn file
+    with open(genes_file_path, "r") as genes_file:
+        for line in genes_file:
+            if not line.startswith(">"):
+                continue
+            fields = line[1:].split("#")
             gene_id = fields[0].strip()
-            start = fields[1].strip()
-            end = fields[2].strip()
-            strand = fields[3].strip()
-            if strand == '1':
-                strand = '+'
-            elif strand == '-1':
-                strand = '-'
-            
-            # Remove last suffix from Chr
-            chr = "_".join(gene_id.split("_")[:-1])
-            
-            # Write the SAF entry
-            saf.write("\t".join([gene_id, chr, start, end, strand]) + "\n")
-
-def annotation(p):
+            strand = '+' if fields[3].strip() == '1' else '-'
+            yield gene_id, gene_contig(gene_id), fields[1].strip(), fields[2].strip(), strand
+
+def combined_saf_file(p):
+    # Path of the SAF with the hit genes of all plastics, used for the combined featureCounts run
+    contigs_base = os.path.basename(p.contigs).split(".")[0]
+    return os.path.join(p.temps, f"{contigs_base}_combined.saf")
+
+def build_saf(p, plastic_types, combined_saf_path=None):
+    """Write the SAF annotations of the hit genes straight from the Prodigal coordinates.
+
+    Every plastic with a hits file gets <hits>.saf in its temps folder. If combined_saf_path is
+    given, one SAF with every hit gene once is written as well, its GeneID is tagged with the
+    plastics the gene was found for as <gene>|<plastic>,<plastic>.
+
+    Args:
+        p (PathManager): The path manager of the current run.
+        plastic_types (list): The plastics to write the SAF files for.
+        combined_saf_path (str, optional): Path of the combined SAF file. Defaults to None.
+
+    Returns:
+        dict: The path of the written SAF file for every plastic that has a hits file.
+    """
+    hit_plastics, output_bases = demultiplex_hits(p, plastic_types)
+    saf_paths = {plastic_type: os.path.join(p.temps, plastic_type, f"{output_file_base}.saf")
+                 for plastic_type, output_file_base in output_bases.items()}
+
+    write_saf(saf_paths, hit_saf_rows(read_gene_coordinates(p), hit_plastics), combined_saf_path)
+    return saf_paths
+
+def hit_saf_rows(gene_coordinates, hit_plastics):
+    # Yields the SAF fields of the hit genes followed by the plastics they were found for, the hits
+    # and the genes are both named <contig>_<gene number>, so their IDs are matched as they are
+    for gene_id, chr, start, end, strand in gene_coordinates:
+        plastics = hit_plastics.get(gene_id)
+        if plastics:
+            yield gene_id, chr, start, end, strand, plastics
+
+def write_saf(saf_paths, saf_rows, combined_saf_path=None):
+    """Write the per-plastic SAF files and optionally the combined SAF file.
+
+    Args:
+        saf_paths (dict): The SAF file to write for every plastic.
+        saf_rows (iterable): GeneID, Chr, Start, End, Strand and the plastics of every hit gene.
+        combined_saf_path (str, optional): Path of the combined SAF file. Defaults to None.
+    """
+    saf_header = "\t".join(["GeneID", "Chr", "Start", "End", "Strand"]) + "\n"
+
+    outputs = {plastic_type: open(path, "w") for plastic_type, path in saf_paths.items()}
+    combined = open(combined_saf_path, "w") if combined_saf_path else None
+    try:
+        for output in list(outputs.values()) + [combined]:
+            if output:
+                output.write(saf_header)
+
+        for gene_id, chr, start, end, strand, plastics in saf_rows:
+            for plastic_type in plastics:
+                outputs[plastic_type].write("\t".join([gene_id, chr, start, end, strand]) + "\n")
+            if combined:
+                combined.write("\t".join([f"{gene_id}|{','.join(plastics)}", chr, start, end, strand]) + "\n")
+    finally:
+        for output in list(outputs.values()) + [combined]:
+            if output:
+                output.close()
+
+def annotation(p, saf_paths=None):
+    """Count the reads mapped to the hit genes of every plastic and sample.
+
+    Args:
+        p (PathManager): The path manager of the current run.
+        saf_paths (dict, optional): SAF files already written for every plastic, e.g. by the
+            streaming pipeline. Defaults to None, the SAF files are built from the hits then.
+
+    Returns:
+        pandas.DataFrame: The abundance table, one row per plastic and sample.
+    """
     if not check_translate_result(p):
         return
 
@@ -85,48 +198,343 @@ def annotation(p):
     elif isinstance(p.plastic, str) and p.plastic.lower() == "all":
         plastic_types = [os.path.splitext(file)[0] for file in os.listdir(motif_dir) if file.endswith('.hmm')]
     
-    #create tsv files for each mapping file
-    for mapping_file in p.mappings.split(','):
-        sample_name = mapping_file.split('.')[0].split('/')[-1]
-        tsv_output_file = os.path.join(p.temps, f'{sample_name}.tsv')
-        with open(tsv_output_file, 'w') as tsv_file:
-            tsv_file.write('\t'.join(["plastic name", "reads mapped", "total reads", "proportion", "rpkm"]) + '\n')
-
-
-    # Create a new function that has `p` already filled in
-    featurecounts_p = partial(featurecounts, p=p)
-
-    # Start the tasks
-    pool = multiprocessing.Pool(processes=utilities.get_logical_cores() if p.multiprocessing else 1)
-    pool.map(featurecounts_p, plastic_types)
+    mapping_files = p.mappings.split(',')
+    sample_names = [sample_name_of(mapping_file) for mapping_file in mapping_files]
+
+    # Write the SAF files of all plastics in one pass over the gene coordinates
+    combined_saf_path = combined_saf_file(p) if p.combined_counts else None
+    if saf_paths is None:
+        saf_paths = build_saf(p, plastic_types, combined_saf_path)
+
+    # Reuse the results of the plastic and sample pairs whose inputs did not change since they were counted
+    records = []
+    todo = {}
+    for plastic_type in plastic_types:
+        if plastic_type not in saf_paths:
+            logging.warning(f"No .fasta files found in {os.path.join(p.temps, plastic_type)}. Skipping this folder.")
+            continue
+        for mapping_file in mapping_files:
+            record = p.checkpoints.result(*featurecounts_stage(plastic_type, mapping_file, saf_paths, p.counter))
+            if record is None:
+                todo.setdefault(plastic_type, []).append(mapping_file)
+            else:
+                records.append(record)
+    if records:
+        logging.info(f"Reusing {len(records)} featurecounts results of a previous run.")
+
+    # Count all plastics in one featureCounts run, the rest is counted per plastic below
+    remaining = todo
+    if p.combined_counts and p.counter == "featurecounts" and todo:
+        combined_mappings = [mapping_file for mapping_file in mapping_files if any(mapping_file in files for files in todo.values())]
+        combined_records, separate = combined_featurecounts(p, list(todo), saf_paths, combined_saf_path, combined_mappings)
+        records.extend(record for record in combined_records if record["sample"] in map(sample_name_of, todo[record["plastic name"]]))
+        remaining = {plastic_type: todo[plastic_type] for plastic_type in separate}
+
+    # Create a new function that has `p` and the cores of every run already filled in
+    featurecounts_p = partial(featurecounts, p=p, cores=p.scheduler.share(len(remaining)))
+
+    # Start the tasks, every worker returns its records instead of writing to the sample files
+    pool = ThreadPool(processes=max(1, min(len(remaining), p.scheduler.total)))
+    for plastic_records in pool.starmap(featurecounts_p, remaining.items()):
+        records.extend(plastic_records)
 
     # Wait for the tasks to finish
     pool.close()
     pool.join()
 
-def featurecounts(plastic_type, p):
-    try:
-        # Get the base name of the contigs file
-        contigs_base = os.path.basename(p.contigs).split(".")[0]
+    # Assemble the results in plastic order and write every sample file once
+    order = {plastic_type: i for i, plastic_type in enumerate(plastic_types)}
+    records.sort(key=lambda record: order[record["plastic name"]])
+    table = abundance_table(records)
+    write_sample_tsvs(p, table, sample_names)
 
+    return table
+
+def counts_table_annotation(p):
+    """Calculate the abundances of every plastic and sample from precomputed per-contig count tables.
+
+    No BAM or SAM file is read: the reads of a plastic are the reads of the contigs holding its
+    hit genes, every contig counted once. The tables are read in chunks and only the rows of hit
+    contigs are kept, so tables of thousands of samples fit in memory.
+
+    Args:
+        p (PathManager): The path manager of the current run, with counts_tables set.
+
+    Returns:
+        pandas.DataFrame: The abundance table, one row per plastic and sample.
+    """
+    if not check_translate_result(p):
+        return
+
+    # The contigs with hit genes of every plastic
+    plastic_contigs = {}
+    for plastic_type in p.plastic_list:
+        temp_folder_path = os.path.join(p.temps, plastic_type)
+        hits_file_path, _ = hits_output_base(temp_folder_path) if os.path.isdir(temp_folder_path) else (None, None)
+        if hits_file_path is None:
+            logging.warning(f"No .fasta files found in {temp_folder_path}. Skipping this folder.")
+            continue
+        plastic_contigs[plastic_type] = pd.unique(gene_contigs(sorted(read_hit_ids(hits_file_path))))
+    contigs = pd.Index(pd.unique(np.concatenate(list(plastic_contigs.values())))) if plastic_contigs else pd.Index([])
+
+    # Tables without a sample column are named like mapping files
+    sample_names = [sample_name_of(counts_table) for counts_table in p.counts_tables]
+    counts = counts_tables.read_counts_tables(p.counts_tables, contigs, sample_names, threads=p.scheduler.total)
+    logging.info(f"Read counts of {len(contigs)} hit contigs in {len(counts.samples)} samples taken from {len(p.counts_tables)} count tables.")
+
+    # One row per plastic selecting its contigs, the reads and RPK of all plastics and samples are two products
+    rows = np.concatenate([np.full(len(plastic_contigs[plastic_type]), i) for i, plastic_type in enumerate(plastic_contigs)] or [np.zeros(0, dtype=np.int64)])
+    columns = np.concatenate([contigs.get_indexer(plastic_contigs[plastic_type]) for plastic_type in plastic_contigs] or [np.zeros(0, dtype=np.int64)])
+    selection = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(plastic_contigs), len(contigs)))
+    reads_mapped = np.asarray((selection @ counts.reads).todense())
+    total_rpk = np.asarray((selection @ counts.densities).todense()) * 1e3
+
+    total_reads = counts.library_sizes
+    has_reads = total_reads != 0
+    records = []
+    for i, plastic_type in enumerate(plastic_contigs):
+        proportion = np.divide(reads_mapped[i], total_reads, out=np.zeros(len(total_reads)), where=has_reads)
+        rpkm = np.divide(total_rpk[i], total_reads / 1e6, out=np.zeros(len(total_reads)), where=has_reads)
+        for column, sample_name in enumerate(counts.samples):
+            records.append(abundance_record(sample_name, plastic_type, reads_mapped[i, column], total_reads[column], proportion[column], rpkm[column]))
+
+    table = abundance_table(records)
+    write_sample_tsvs(p, table, counts.samples)
+    return table
+
+def read_featurecounts(counts_path):
+    """Read a featureCounts output table into NumPy arrays.
+
+    Tables with many sample columns take a fast path that parses the whole count block with a
+    single NumPy call instead of building one pandas column per sample.
+
+    Args:
+        counts_path (str): Path to the featureCounts output table.
+
+    Returns:
+        tuple: The gene IDs, the gene lengths and the genes x samples count matrix.
+    """
+    with open(counts_path, 'r') as counts_file:
+        # Skip the program line, the second line holds the column names
+        next(counts_file)
+        n_samples = len(next(counts_file).split('\t')) - 6
+
+        if n_samples >= WIDE_TABLE_SAMPLES:
+            gene_ids, lengths, count_blocks = [], [], []
+            for line in counts_file:
+                fields = line.rstrip('\n').split('\t', 6)
+                gene_ids.append(fields[0])
+                lengths.append(fields[5])
+                count_blocks.append(fields[6])
+            counts = np.fromstring('\t'.join(count_blocks), dtype=np.int64, sep='\t') if count_blocks else np.zeros(0, dtype=np.int64)
+            return np.array(gene_ids, dtype=object), np.array(lengths, dtype=np.int64), counts.reshape(len(gene_ids), n_samples)
+
+    table = pd.read_csv(counts_path, sep='\t', skiprows=1, dtype={0: str})
+    return table.iloc[:, 0].to_numpy(dtype=object), table.iloc[:, 5].to_numpy(dtype=np.int64), table.iloc[:, 6:].to_numpy(dtype=np.int64)
+
+def read_featurecounts_summary(summary_path):
+    """Read a featureCounts summary into the assigned and total reads of every sample.
+
+    Every read ends up in exactly one summary category, so the total is the column sum.
+
+    Args:
+        summary_path (str): Path to the featureCounts .summary file.
+
+    Returns:
+        tuple: The assigned reads and the total reads of every sample as NumPy arrays.
+    """
+    summary = pd.read_csv(summary_path, sep='\t', index_col=0)
+    counts = summary.to_numpy(dtype=np.int64)
+    assigned = summary.loc['Assigned'].to_numpy(dtype=np.int64) if 'Assigned' in summary.index else np.zeros(counts.shape[1], dtype=np.int64)
+    return assigned, counts.sum(axis=0)
+
+def abundance_statistics(lengths, counts, reads_mapped, total_reads):
+    """Calculate the proportion and RPKM of every sample in one vectorized step.
+
+    Args:
+        lengths (numpy.ndarray): The gene lengths.
+        counts (numpy.ndarray): The genes x samples count matrix.
+        reads_mapped (numpy.ndarray): The reads mapped to the genes of every sample.
+        total_reads (numpy.ndarray): The total reads of every sample.
+
+    Returns:
+        tuple: The proportion and RPKM of every sample as NumPy arrays.
+    """
+    # Reads per kilobase of every gene, genes without length count as 0
+    kilobases = (lengths / 1e3)[:, None]
+    rpk = np.divide(counts, kilobases, out=np.zeros(counts.shape), where=kilobases != 0)
+    total_rpk = rpk.sum(axis=0)
+
+    has_reads = total_reads != 0
+    proportion = np.divide(reads_mapped, total_reads, out=np.zeros(len(total_reads)), where=has_reads)
+    rpkm = np.divide(total_rpk, total_reads / 1e6, out=np.zeros(len(total_reads)), where=has_reads)
+    return proportion, rpkm
+
+def abundance_record(sample_name, plastic_type, reads_mapped, total_reads, proportion=0.0, rpkm=0.0):
+    return {"sample": sample_name, "plastic name": plastic_type, "reads mapped": int(reads_mapped), "total reads": int(total_reads), "proportion": float(proportion), "rpkm": float(rpkm)}
+
+def sample_name_of(mapping_file):
+    return mapping_file.split('.')[0].split('/')[-1]
+
+def featurecounts_stage(plastic_type, mapping_file, saf_paths, counter="featurecounts"):
+    # Checkpoint stage name, input files and parameters of counting a plastic in a mapping file
+    return f"featurecounts/{plastic_type}/{sample_name_of(mapping_file)}", [saf_paths[plastic_type], mapping_file.strip()], {"counter": counter}
+
+def abundance_table(records):
+    """Assemble the abundance records of all plastics and samples into one table.
+
+    Args:
+        records (list): Records returned by abundance_record.
+
+    Returns:
+        pandas.DataFrame: One row per plastic and sample.
+    """
+    return pd.DataFrame.from_records(records, columns=ABUNDANCE_COLUMNS)
+
+def write_sample_tsvs(p, table, sample_names):
+    # Write the TSV file of every sample once, the proportion is formatted in scientific notation
+    for sample_name in sample_names:
+        tsv_output_file = os.path.join(p.temps, f'{sample_name}.tsv')
+        with open(tsv_output_file, 'w') as tsv_file:
+            tsv_file.write('\t'.join(ABUNDANCE_COLUMNS[1:]) + '\n')
+            rows = table.loc[table["sample"] == sample_name, ABUNDANCE_COLUMNS[1:]]
+            for plastic_type, reads_mapped, total_reads, proportion, rpkm in rows.itertuples(index=False, name=None):
+                # Without any reads the rpkm is reported as the integer 0
+                rpkm = rpkm if total_reads != 0 else 0
+                tsv_file.write('\t'.join([plastic_type, str(reads_mapped), str(total_reads), "{:.2e}".format(proportion), str(rpkm)]) + '\n')
+
+def read_combined_saf(saf_path):
+    # Returns the SAF rows of a combined SAF as (gene_id, plastics, chr, start, end)
+    rows = []
+    with open(saf_path, "r") as saf:
+        next(saf)
+        for line in saf:
+            gene_id, chr, start, end, _ = line.rstrip("\n").split("\t")
+            gene, plastics = gene_id.rsplit("|", 1)
+            rows.append((gene, plastics.split(","), chr, int(start), int(end)))
+    return rows
+
+def plastics_sharing_reads(saf_rows, read_span=READ_SPAN):
+    """Find the plastics whose counts would change when counted together with other plastics.
+
+    featureCounts leaves reads that overlap more than one feature unassigned. Counted per plastic,
+    a read spanning two nearby genes of different plastics is assigned in both runs, in a combined
+    run it is not. Genes of different plastic sets closer than read_span therefore have to be
+    counted per plastic to keep the results identical.
+
+    Args:
+        saf_rows (list): Rows returned by read_combined_saf.
+        read_span (int, optional): The longest genomic span of a read. Defaults to READ_SPAN.
+
+    Returns:
+        set: The plastics that have to be counted per plastic.
+    """
+    affected = set()
+    by_chr = {}
+    for gene, plastics, chr, start, end in saf_rows:
+        by_chr.setdefault(chr, []).append((start, end, plastics))
+
+    for features in by_chr.values():
+        features.sort()
+        for i, (start, end, plastics) in enumerate(features):
+            for next_start, _, next_plastics in features[i + 1:]:
+                if next_start > end + read_span:
+                    break
+                if set(plastics) != set(next_plastics):
+                    affected.update(plastics)
+                    affected.update(next_plastics)
+    return affected
+
+def complete_featurecounts(p, records, mapping_files, saf_paths):
+    # Store every record in the checkpoint of its plastic and mapping file
+    mapping_by_sample = {sample_name_of(mapping_file): mapping_file for mapping_file in mapping_files}
+    for record in records:
+        stage = featurecounts_stage(record["plastic name"], mapping_by_sample[record["sample"]], saf_paths, p.counter)
+        p.checkpoints.complete(*stage, result=record)
+
+def combined_featurecounts(p, plastic_types, saf_paths, combined_saf_path, mapping_files):
+    """Count the hit genes of all plastics with a single featureCounts run over all mapping files.
+
+    The combined SAF holds every hit gene once, tagged with its plastics, and featureCounts runs
+    once with a thread count from the core budget. The count matrix is split back into one row per
+    plastic and sample, identical to the rows of the per-plastic runs.
+
+    Args:
+        p (PathManager): The path manager of the current run.
+        plastic_types (list): The plastics to count.
+        saf_paths (dict): The per-plastic SAF files written by build_saf.
+        combined_saf_path (str): The combined SAF file written by build_saf.
+        mapping_files (list): The mapping files to count.
+
+    Returns:
+        tuple: The abundance records of the counted plastics and the plastics that could not be
+            counted together and still need a per-plastic run.
+    """
+    contigs_base = os.path.basename(p.contigs).split(".")[0]
+    saf_rows = read_combined_saf(combined_saf_path)
+
+    separate = plastics_sharing_reads(saf_rows)
+    if separate:
+        logging.info(f"Genes of {', '.join(sorted(separate))} lie close to genes of other plastics, counting them separately.")
+    plastics = [plastic_type for plastic_type in plastic_types if plastic_type in saf_paths and plastic_type not in separate]
+
+    sample_names = [sample_name_of(mapping_file) for mapping_file in mapping_files]
+
+    records = []
+    if not saf_rows or not plastics:
+        # featureCounts refuses an annotation without features, the per-plastic run reports nothing then
+        records = [abundance_record(sample_name, plastic_type, 0, 0) for plastic_type in plastics for sample_name in sample_names]
+        complete_featurecounts(p, records, mapping_files, saf_paths)
+        return records, [plastic_type for plastic_type in plastic_types if plastic_type not in plastics]
+
+    fc_output = os.path.join(p.temps, f"{contigs_base}_combined_counts.out")
+    log_file = os.path.join(p.temps, "combined_featureCounts.log")
+    program_output_file = os.path.join(p.temps, "combined_featureCounts.out")
+
+    for output in (fc_output, f"{fc_output}.summary"):
+        if os.path.isfile(output):
+            os.remove(output)
+
+    logging.info(f"Starting combined featurecounts for {', '.join(plastics)}.")
+    memory = estimate_memory("featureCounts", combined_saf_path, threads=p.scheduler.total)
+    with p.scheduler.cores(p.scheduler.total, memory) as threads:
+        fc_command = f"featureCounts -T {threads} -a {combined_saf_path} -F SAF -o {fc_output} {' '.join(mapping_file.strip() for mapping_file in mapping_files)}"
+        with open(log_file, 'w') as f, open(program_output_file, 'w') as p_out:
+            process = subprocess.Popen(fc_command, shell=True, stdout=p_out, stderr=f)
+        process.wait()
+
+    if process.returncode != 0:
+        logging.error(f"Combined featurecounts failed, see {log_file}. Counting per plastic instead.")
+        return records, [plastic_type for plastic_type in plastic_types if plastic_type in saf_paths]
+
+    _, total_reads = read_featurecounts_summary(f"{fc_output}.summary")
+    gene_ids, lengths, counts = read_featurecounts(fc_output)
+    gene_plastics = [set(gene_id.rsplit('|', 1)[1].split(',')) for gene_id in gene_ids]
+
+    for plastic_type in plastics:
+        genes = np.array([plastic_type in tags for tags in gene_plastics], dtype=bool)
+        if not genes.any():
+            # featureCounts refuses an annotation without features, the per-plastic run reports nothing then
+            records.extend(abundance_record(sample_name, plastic_type, 0, 0) for sample_name in sample_names)
+            continue
+
+        reads_mapped = counts[genes].sum(axis=0)
+        proportion, rpkm = abundance_statistics(lengths[genes], counts[genes], reads_mapped, total_reads)
+        for column, sample_name in enumerate(sample_names):
+            records.append(abundance_record(sample_name, plastic_type, reads_mapped[column], total_reads[column], proportion[column], rpkm[column]))
+
+    complete_featurecounts(p, records, mapping_files, saf_paths)
+    return records, [plastic_type for plastic_type in plastic_types if plastic_type not in plastics]
+
+def featurecounts(plastic_type, mapping_files, p, cores=1):
+    records = []
+    try:
         temp_folder_path = os.path.join(p.temps, plastic_type)
-        fasta_files = [file for file in os.listdir(temp_folder_path) if file.endswith('.fasta')]
+        hits_file_path, output_file_base = hits_output_base(temp_folder_path)
         
-        if fasta_files:
-            # Construct file paths
-            hits_file_path = os.path.join(temp_folder_path, fasta_files[0])
-            genes_file_path = os.path.join(p.temps, f"{contigs_base}.ffn")
-            output_file_base = os.path.basename(fasta_files[0]).split(".")[0]
-            output_file_path = os.path.join(temp_folder_path, f"{output_file_base}.fnn")
-            
-            # Process hits and correct the .ffn file
-            search_for_hits(hits_file_path, genes_file_path, output_file_path)
-            corrected_file_path = os.path.join(temp_folder_path, f"{output_file_base}-corrected.fnn")
-            correct_ffn_file(output_file_path, corrected_file_path)
-            
-            # Convert corrected .ffn file to .saf
+        if hits_file_path:
+            # The .saf file was written by build_saf
             saf_file_path = os.path.join(temp_folder_path, f"{output_file_base}.saf")
-            ffn_to_saf(corrected_file_path, saf_file_path)
 
 
             logging.info(f"Starting {plastic_type} featurecounts.")
@@ -138,93 +546,61 @@ def featurecounts(plastic_type, p):
             
             #There should one .saf file per plastic folder.      
             
-            # Split the mappings argument into a list of individual file paths
-            mapping_files = p.mappings.split(',')
+            # Only the given mapping files are counted, the others have up to date checkpoints
             for mapping_file in mapping_files:
 
-                sample_name = mapping_file.split('.')[0].split('/')[-1]
+                sample_name = sample_name_of(mapping_file)
                 mapping_file = mapping_file.strip()  # Remove any leading/trailing whitespace
                 fc_input = saf_file_path
                 fc_output = os.path.join(temp_folder_path, f"{plastic_type}_{os.path.basename(mapping_file)}_counts.out")
-                fc_command = f"featureCounts -a {fc_input} -F SAF -o {fc_output} {mapping_file}"
                 log_file = os.path.join(temp_folder_path, f"{os.path.basename(mapping_file)}_featureCounts.log")
             
                 # Specify the file to capture program output
                 program_output_file = os.path.join(temp_folder_path, f"{os.path.basename(mapping_file)}_featureCounts.out")
+
+                # Count in process, reading only the regions of the hit genes from indexed BAM files
+                if p.counter == "regions" and region_counts.can_count(mapping_file):
+                    if os.path.getsize(saf_file_path) <= len("GeneID\tChr\tStart\tEnd\tStrand\n"):
+                        # Reported like the featureCounts run that fails on an annotation without features
+                        records.append(abundance_record(sample_name, plastic_type, 0, 0))
+                    else:
+                        with p.scheduler.cores(1):
+                            reads_mapped, total_reads, lengths, counts = region_counts.count_saf(mapping_file, saf_file_path)
+                        proportion, rpkm = abundance_statistics(lengths, counts, reads_mapped, total_reads)
+                        records.append(abundance_record(sample_name, plastic_type, reads_mapped[0], total_reads[0], proportion[0], rpkm[0]))
+                    complete_featurecounts(p, records[-1:], [mapping_file], {plastic_type: saf_file_path})
+                    continue
             
-                with open(log_file, 'w') as f, open(program_output_file, 'w') as p_out:
-                    process = subprocess.Popen(fc_command, shell=True, stdout=p_out, stderr=f)
-
-                while process.poll() is None:
-                    time.sleep(0.1)
-
-                #Calculate statistsics on the abundance data: average, standard div, sum.
-
-                # Initialize counts
-                reads_mapped = 0
-                total_reads = 0
-                total_rpk = 0
-
-                # Folder where fc_output files are stored
-                fc_folder_path = temp_folder_path            
-                # Iterate through all files in the directory
-                for filename in os.listdir(fc_folder_path):
-                    # Check if the file is a featureCounts output summary file
-                    if filename.endswith("_counts.out.summary") and sample_name in filename:
-                        # Open the file
-                        with open(os.path.join(fc_folder_path, filename), 'r') as fc_output:
-
-                            # Iterate through each line in the file
-                            for line in fc_output:
-                                # Ignore lines that are not part of the summary
-                                if not line.startswith('Assigned') and not line.startswith('Unassigned'):
-                                    continue
-
-                                # Extract count from the line
-                                count = int(line.split('\t')[1].strip())
-
-                                # Add the count to the appropriate variable
-                                if line.startswith('Assigned'):
-                                    reads_mapped = count
-                                total_reads += count
-
-
-                    # Check if the file is a featureCounts output file
-                    if filename.endswith("_counts.out") and sample_name in filename:
-                        # Open the file
-                        with open(os.path.join(fc_folder_path, filename), 'r') as fc_output:
-                            # Skip the header lines
-                            for _ in range(2):
-                                next(fc_output)
-
-                            # Iterate through each line in the file
-                            for line in fc_output:
-
-                                # Extract count and length from the line
-                                fields = line.split('\t')
-                                reads = int(fields[6].strip())
-                                gene_length = int(fields[5].strip())
-
-                                # Calculate RPK and add it to the list
-                                rpk = reads / (gene_length / 1e3) if gene_length != 0 else 0
-                                total_rpk += rpk
-
-                            
-                # Calculate proportion
-                proportion = reads_mapped / total_reads if total_reads != 0 else 0
-                # Format the proportion in scientific notation
-                proportion = "{:.2e}".format(proportion)
-
-                # Calculate rpkm
-                rpkm = total_rpk / (total_reads / 1e6) if total_reads != 0 else 0
-
-                # Open the TSV output file in append mode
-                tsv_output_file = os.path.join(p.temps, f'{sample_name}.tsv')
-                with open(tsv_output_file, 'a+') as tsv_file:
-                    # Write row to TSV file
-                    tsv_file.write('\t'.join([plastic_type, str(reads_mapped), str(total_reads), str(proportion), str(rpkm)]) + '\n')
+                # The outputs of an earlier run must never be read as the counts of this one
+                for output in (fc_output, f"{fc_output}.summary"):
+                    if os.path.isfile(output):
+                        os.remove(output)
+
+                with p.scheduler.cores(cores, estimate_memory("featureCounts", saf_file_path, threads=cores)) as threads:
+                    fc_command = f"featureCounts -T {threads} -a {fc_input} -F SAF -o {fc_output} {mapping_file}"
+                    with open(log_file, 'w') as f, open(program_output_file, 'w') as p_out:
+                        process = subprocess.Popen(fc_command, shell=True, stdout=p_out, stderr=f)
+                    process.wait()
+
+                if process.returncode != 0:
+                    records.append(abundance_record(sample_name, plastic_type, 0, 0))
+                    # featureCounts fails on an annotation without features, no reads are mapped to the plastic then
+                    if os.path.getsize(saf_file_path) <= len("GeneID\tChr\tStart\tEnd\tStrand\n"):
+                        complete_featurecounts(p, records[-1:], [mapping_file], {plastic_type: saf_file_path})
+                    else:
+                        logging.error(f"featurecounts failed for {plastic_type} in {mapping_file}, see {log_file}. Reporting 0 reads.")
+                    continue
+
+                # Read exactly the outputs of this run and calculate the statistics on them
+                reads_mapped, total_reads = read_featurecounts_summary(f"{fc_output}.summary")
+                _, lengths, counts = read_featurecounts(fc_output)
+                proportion, rpkm = abundance_statistics(lengths, counts, reads_mapped, total_reads)
+                records.append(abundance_record(sample_name, plastic_type, reads_mapped[0], total_reads[0], proportion[0], rpkm[0]))
+                complete_featurecounts(p, records[-1:], [mapping_file], {plastic_type: saf_file_path})
         else:
             logging.warning(f"No .fasta files found in {temp_folder_path}. Skipping this folder.")
             pass
     except Exception as e:
         logging.error(f"Error running featurecounts for {plastic_type}: {e}")
+
+    return records
@@ -0,0 +1,219 @@
+import os
+import gzip
+import struct
+import hashlib
+import logging
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import pandas as pd
+import utilities
+from bgzf import BgzfReader
+
+# Binning scheme of BAI indexes, CSI indexes store their own; the pseudo-bin 37450 of a reference
+# holds its unmapped offsets and its mapped and unmapped read counts
+BAI_MIN_SHIFT = 14
+BAI_DEPTH = 5
+
+# Reference names, lengths and mapped and unmapped reads, like the lines of samtools idxstats
+IndexStats = namedtuple("IndexStats", ["names", "lengths", "mapped", "unmapped", "no_coordinate"])
+
+# A BAI or CSI index, with the chunks of every bin and the linear index of every reference when read with bins
+BamIndex = namedtuple("BamIndex", ["min_shift", "depth", "mapped", "unmapped", "no_coordinate", "bins", "linear"])
+
+
+def find_index(bam_file):
+    # The index of a BAM file, where samtools index writes it
+    base = bam_file[:-4] if bam_file.endswith(".bam") else bam_file
+    for index_file in (f"{bam_file}.bai", f"{base}.bai", f"{bam_file}.csi", f"{base}.csi"):
+        if os.path.isfile(index_file):
+            return index_file
+    raise ValueError(f"ERROR: No .bai or .csi index found for {bam_file}, index it with 'samtools index {bam_file}'")
+
+
+def read_references(bam_file):
+    """Read the reference names and lengths from the header of a BAM file.
+
+    Only the BGZF blocks of the header are decompressed.
+
+    Returns:
+        tuple: The reference names and their lengths as NumPy arrays.
+    """
+    with BgzfReader(bam_file) as reader:
+        _, references = reader.read_header()
+    names = np.array([name for name, _ in references], dtype=str)
+    return names, np.array([length for _, length in references], dtype=np.int64)
+
+
+def read_index(index_file, with_bins=False):
+    """Read a BAI or CSI index.
+
+    samtools index stores the mapped and unmapped reads of every reference in a pseudo-bin, so
+    the counts are known without reading the BAM file. With with_bins, the chunks of every bin
+    and the linear index are kept too, to look up the reads of a region.
+
+    Returns:
+        BamIndex: The index.
+    """
+    with open(index_file, "rb") as f:
+        data = f.read()
+    if data[:2] == b"\x1f\x8b":
+        # CSI indexes are BGZF compressed
+        data = gzip.decompress(data)
+    view = memoryview(data)
+
+    magic = bytes(view[:4])
+    if magic == b"BAI\1":
+        min_shift, depth, offset, bin_extra = BAI_MIN_SHIFT, BAI_DEPTH, 4, 0
+    elif magic == b"CSI\1":
+        min_shift, depth, l_aux = struct.unpack_from("<iii", view, 4)
+        offset, bin_extra = 16 + l_aux, 8
+    else:
+        raise ValueError(f"ERROR: {index_file} is not a BAI or CSI index")
+    pseudo_bin = ((1 << ((depth + 1) * 3)) - 1) // 7 + 1
+
+    n_ref, = struct.unpack_from("<i", view, offset)
+    offset += 4
+    mapped = np.zeros(n_ref, dtype=np.int64)
+    unmapped = np.zeros(n_ref, dtype=np.int64)
+    bins = [] if with_bins else None
+    linear = [] if with_bins else None
+    for ref in range(n_ref):
+        n_bin, = struct.unpack_from("<i", view, offset)
+        offset += 4
+        found = n_bin == 0
+        ref_bins = {}
+        for _ in range(n_bin):
+            # A CSI bin also holds the offset of its first read
+            bin_id, = struct.unpack_from("<I", view, offset)
+            n_chunk, = struct.unpack_from("<i", view, offset + 4 + bin_extra)
+            chunks = offset + 8 + bin_extra
+            if bin_id == pseudo_bin:
+                mapped[ref], unmapped[ref] = struct.unpack_from("<QQ", view, chunks + 16)
+                found = True
+            elif with_bins:
+                ref_bins[bin_id] = np.frombuffer(view, dtype="<u8", count=2 * n_chunk, offset=chunks).reshape(n_chunk, 2)
+            offset = chunks + 16 * n_chunk
+        if not found:
+            raise ValueError(f"ERROR: {index_file} has no read counts, index the BAM file again with a current samtools")
+        n_intv = 0
+        if magic == b"BAI\1":
+            # The linear index only exists in BAI indexes
+            n_intv, = struct.unpack_from("<i", view, offset)
+            offset += 4
+        if with_bins:
+            bins.append(ref_bins)
+            linear.append(np.frombuffer(view, dtype="<u8", count=n_intv, offset=offset))
+        offset += 8 * n_intv
+
+    no_coordinate = struct.unpack_from("<Q", view, offset)[0] if offset + 8 <= len(view) else 0
+    return BamIndex(min_shift, depth, mapped, unmapped, no_coordinate, bins, linear)
+
+
+def region_bins(begin, end, min_shift=BAI_MIN_SHIFT, depth=BAI_DEPTH):
+    # The bins that can hold reads overlapping the 0-based, half-open region [begin, end)
+    end -= 1
+    bins = []
+    first, shift = 0, min_shift + depth * 3
+    for level in range(depth + 1):
+        bins.extend(range(first + (begin >> shift), first + (end >> shift) + 1))
+        first += 1 << (level * 3)
+        shift -= 3
+    return bins
+
+
+def region_chunks(index, ref, begin, end):
+    """Return the chunks of the BAM file that hold the reads overlapping a region.
+
+    Args:
+        index (BamIndex): An index read with with_bins.
+        ref (int): The reference of the region.
+        begin (int): The 0-based start of the region.
+        end (int): The 0-based, exclusive end of the region.
+
+    Returns:
+        list: The merged (begin, end) virtual offset pairs, sorted.
+    """
+    ref_bins = index.bins[ref]
+    chunks = [chunk for bin_id in region_bins(begin, end, index.min_shift, index.depth) if bin_id in ref_bins
+              for chunk in ref_bins[bin_id].tolist()]
+
+    # Reads before the first read of the region's linear window cannot overlap it
+    linear = index.linear[ref]
+    window = begin >> BAI_MIN_SHIFT
+    min_offset = int(linear[min(window, len(linear) - 1)]) if len(linear) and index.min_shift == BAI_MIN_SHIFT else 0
+    return merge_chunks(chunk for chunk in chunks if chunk[1] > min_offset)
+
+
+def merge_chunks(chunks):
+    # Merge overlapping and adjacent chunks
+    merged = []
+    for chunk_begin, chunk_end in sorted(chunks):
+        if merged and chunk_begin <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], chunk_end)
+        else:
+            merged.append([chunk_begin, chunk_end])
+    return merged
+
+
+def stats_cache_file(bam_file, index_file):
+    # The BAM file and its index are identified by path, size and modification time
+    key = []
+    for file in (bam_file, index_file):
+        stat = os.stat(file)
+        key.append(f"{os.path.realpath(file)}:{stat.st_size}:{stat.st_mtime_ns}")
+    return os.path.join(utilities.get_cache_dir("bam_stats"), f"{hashlib.sha256(';'.join(key).encode()).hexdigest()}.npz")
+
+
+def index_stats(bam_file, use_cache=True):
+    """Return the per-reference read counts of a BAM file, the numbers samtools idxstats reports.
+
+    The counts come from the BAM index and are cached by the path, size and modification time
+    of the BAM file and its index.
+
+    Args:
+        bam_file (str): Path to a coordinate sorted and indexed BAM file.
+        use_cache (bool, optional): If True, use and fill the cache. Defaults to True.
+
+    Returns:
+        IndexStats: The names, lengths, mapped and unmapped reads of every reference and the reads without coordinates.
+    """
+    index_file = find_index(bam_file)
+    cache_file = stats_cache_file(bam_file, index_file) if use_cache else None
+    if cache_file and os.path.isfile(cache_file):
+        try:
+            with np.load(cache_file) as cached:
+                return IndexStats(cached["names"], cached["lengths"], cached["mapped"], cached["unmapped"], int(cached["no_coordinate"]))
+        except (OSError, ValueError, KeyError):
+            logging.debug(f"Ignoring unreadable cached statistics {cache_file}")
+
+    names, lengths = read_references(bam_file)
+    index = read_index(index_file)
+    if len(index.mapped) != len(names):
+        raise ValueError(f"ERROR: {index_file} does not belong to {bam_file}")
+    stats = IndexStats(names, lengths, index.mapped, index.unmapped, index.no_coordinate)
+
+    if cache_file:
+        # Write to a temporary file first, so concurrent runs never read half an entry
+        temp_file = f"{cache_file}.{os.getpid()}.tmp.npz"
+        np.savez(temp_file, names=names, lengths=lengths, mapped=stats.mapped, unmapped=stats.unmapped, no_coordinate=stats.no_coordinate)
+        os.replace(temp_file, cache_file)
+    return stats
+
+
+def index_stats_all(bam_files, threads=None, use_cache=True):
+    """Read the index statistics of many BAM files in parallel.
+
+    Returns:
+        list: The IndexStats of every BAM file, in the order of bam_files.
+    """
+    if not bam_files:
+        return []
+    threads = threads or utilities.get_logical_cores()
+    with ThreadPool(processes=max(1, min(len(bam_files), threads))) as pool:
+        return pool.map(lambda bam_file: index_stats(bam_file, use_cache), bam_files)
+
+
+def idxstats_table(stats):
+    # The statistics as a table with the columns of samtools idxstats, without the '*' line
+    return pd.DataFrame({"contig": stats.names, "length": stats.lengths, "num_reads": stats.mapped, "unmapped_reads": stats.unmapped})
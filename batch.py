@@ -0,0 +1,137 @@
+import os
+import copy
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from pathmanager import check_file_exists, check_directory_exists, build_scheduler
+from output import write_html
+
+
+def read_manifest(manifest_file):
+    """Read the samples of a batch from a TSV manifest.
+
+    Every line holds a sample name, its contigs file and its comma separated BAM/SAM files.
+    Empty lines, lines starting with '#' and a header line starting with 'sample' are skipped.
+
+    Args:
+        manifest_file (str): Path to the manifest.
+
+    Returns:
+        list: The sample name, contigs file and mapping files of every sample.
+
+    Raises:
+        ValueError: If a line does not have three columns or a sample name is used twice.
+    """
+    check_file_exists(manifest_file)
+    samples = []
+    with open(manifest_file) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip() or line.startswith("#"):
+                continue
+            fields = [field.strip() for field in line.rstrip("\n").split("\t")]
+            if line_number == 1 and fields[0].lower() == "sample":
+                continue
+            if len(fields) != 3 or not all(fields):
+                raise ValueError(f"ERROR: Line {line_number} of {manifest_file} needs the columns sample, contigs and mappings")
+            sample_name, contigs, mappings = fields
+            samples.append((sample_name, contigs, [mapping.strip() for mapping in mappings.split(",") if mapping.strip()]))
+
+    sample_names = [sample_name for sample_name, _, _ in samples]
+    duplicates = sorted({sample_name for sample_name in sample_names if sample_names.count(sample_name) > 1})
+    if duplicates:
+        raise ValueError(f"ERROR: Sample names {', '.join(duplicates)} are used more than once in {manifest_file}")
+    return samples
+
+
+def samples_from_files(contigs_files, mapping_files):
+    """Pair contigs files with the mapping files that belong to them, e.g. for the GUI's Auto Fill.
+
+    A mapping file belongs to a contigs file when its name starts with the name of the contigs
+    file followed by '.', '_' or '-'. A contigs file without such mapping files gets all mapping
+    files, with a warning, since their reads may not have been mapped to these contigs.
+
+    Returns:
+        list: The sample name, contigs file and mapping files of every contigs file.
+    """
+    samples = []
+    for contigs in contigs_files:
+        sample_name = os.path.basename(contigs).split(".")[0]
+        own_mappings = [mapping for mapping in mapping_files
+                        if os.path.basename(mapping)[:len(sample_name) + 1] in (f"{sample_name}.", f"{sample_name}_", f"{sample_name}-")]
+        if not own_mappings:
+            logging.warning(f"No mapping file is named after {contigs}, counting the reads of all {len(mapping_files)} mapping files for sample {sample_name}.")
+        samples.append((sample_name, contigs, own_mappings or list(mapping_files)))
+    return samples
+
+
+def sample_args(args, sample_name, contigs, mapping_files):
+    # The arguments of one sample, its outputs go to a folder per sample
+    args = copy.copy(args)
+    args.output = os.path.join(args.output, sample_name)
+    args.contigs = contigs
+    args.mappings = ",".join(mapping_files)
+    return args
+
+
+def run_batch(args, samples, run, debug=False, blast=True):
+    """Run PlasticTools for every sample of a batch and combine their abundance tables.
+
+    The samples run concurrently and share one core and memory budget, the motifs and the caches.
+    Every sample writes its outputs to <output>/<sample>, the combined table is written to
+    <output>/abundances.tsv and <output>/abundances.html. A failing sample is logged and skipped.
+
+    Args:
+        args (argparse.Namespace): The parsed command-line arguments, shared by all samples.
+        samples (list): The sample name, contigs file and mapping files of every sample.
+        run (callable): Runs one sample and returns its abundance table, PlasticTools.main. It is
+            passed in so this module does not import the script that imports it.
+        debug (bool, optional): If True, enables debug logging. Defaults to False.
+        blast (bool, optional): If True, enables blast search. Defaults to True.
+
+    Returns:
+        pandas.DataFrame: The abundance table of all samples with the sample name in the 'assembly' column.
+    """
+    output = check_directory_exists(args.output)
+
+    # Check every input before any sample starts
+    for _, contigs, mapping_files in samples:
+        check_file_exists(contigs)
+        for mapping_file in mapping_files:
+            check_file_exists(mapping_file)
+
+    # Set up logging before the shared CoreScheduler logs its budget, as main does for a single sample
+    logging.basicConfig(level=logging.DEBUG if debug else logging.WARNING)
+    scheduler = build_scheduler(args)
+
+    def run_sample(sample):
+        sample_name, contigs, mapping_files = sample
+        try:
+            logging.info(f"Starting sample {sample_name}.")
+            table = run(sample_args(args, sample_name, contigs, mapping_files), debug=debug, blast=blast, scheduler=scheduler)
+            logging.info(f"Sample {sample_name} finished.")
+            return table
+        except Exception as e:
+            logging.error(f"Sample {sample_name} failed: {e}\n{traceback.format_exc()}")
+            return None
+
+    # The samples only wait for their tools most of the time, the scheduler limits what actually runs
+    with ThreadPoolExecutor(max_workers=max(1, min(len(samples), scheduler.total))) as executor:
+        tables = list(executor.map(run_sample, samples))
+
+    failed = [sample_name for (sample_name, _, _), table in zip(samples, tables) if table is None]
+    if failed:
+        logging.error(f"{len(failed)} of {len(samples)} samples failed: {', '.join(failed)}")
+
+    combined = [table.assign(assembly=sample_name) for (sample_name, _, _), table in zip(samples, tables) if table is not None]
+    if not combined:
+        raise ValueError("ERROR: No sample of the batch finished")
+
+    table = pd.concat(combined, ignore_index=True)
+    table = table[["assembly"] + [column for column in table.columns if column != "assembly"]]
+    table.to_csv(os.path.join(output, "abundances.tsv"), sep="\t", index=False)
+
+    # The mapping sample names are only unique within an assembly
+    html_table = table.assign(sample=table["assembly"] + "/" + table["sample"])
+    write_html(html_table, os.path.join(output, "abundances.html"))
+    return table
@@ -0,0 +1,137 @@
+"""Throughput benchmarks of the in-process readers.
+
+Usage:
+    python3 benchmarks.py bgzf <file.bam> [<file.bam> ...] [--threads 1,2,4,8]
+    python3 benchmarks.py tblout [--rows 1000000,5000000] [--tblout <file.tbl>]
+"""
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import pandas as pd
+from Bio import SearchIO
+import bgzf
+import hmmer_tables
+from utilities import get_logical_cores
+
+MB = 1024 ** 2
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def decompressed_size(path, threads):
+    return sum(len(data) for data in bgzf.read_blocks(path, threads))
+
+
+def samtools_count(path):
+    # The reference: samtools view | wc -l, with samtools decompressing on one thread like a plain pipe
+    output = subprocess.run(f"samtools view {path} | wc -l", shell=True, check=True, capture_output=True, text=True).stdout
+    return int(output.split()[0])
+
+
+def benchmark_bgzf(bam_files, thread_counts):
+    """Compare decompression and record streaming of bgzf with samtools view | wc -l.
+
+    For every BAM file and thread count, the decompression throughput of read_blocks and the
+    record rate of BamRecords are reported, next to the time samtools needs for the same count.
+    """
+    has_samtools = shutil.which("samtools") is not None
+    if not has_samtools:
+        print("samtools not found, skipping the samtools view | wc -l reference")
+
+    print("\t".join(["file", "threads", "MB compressed", "MB/s decompressed", "records", "records/s", "seconds"]))
+    for path in bam_files:
+        compressed = os.path.getsize(path) / MB
+        for threads in thread_counts:
+            size, seconds = timed(decompressed_size, path, threads)
+            records, record_seconds = timed(bgzf.count_records, path, threads)
+            print("\t".join([os.path.basename(path), str(threads), f"{compressed:.1f}", f"{size / MB / seconds:.1f}",
+                             str(records), f"{records / record_seconds:.0f}", f"{record_seconds:.3f}"]))
+        if has_samtools:
+            records, seconds = timed(samtools_count, path)
+            print("\t".join([os.path.basename(path), "samtools", f"{compressed:.1f}", "", str(records), f"{records / seconds:.0f}", f"{seconds:.3f}"]))
+
+
+def write_tblout(path, rows, seed=0):
+    # A hmmsearch tblout of Prodigal proteins with the given number of rows
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        f.write("#                                                               --- full sequence ---- --- best 1 domain ---- --- domain number estimation ----\n")
+        f.write("# target name        accession  query name           accession    E-value  score  bias   E-value  score  bias   exp reg clu  ov env dom rep inc description of target\n")
+        f.write("#------------------- ---------- -------------------- ---------- --------- ------ ----- --------- ------ -----   --- --- --- --- --- --- --- --- ---------------------\n")
+        for i in range(rows):
+            # Every protein is a hit once, like in a real hmmsearch tblout
+            contig, gene = i // 7, i % 7 + 1
+            start = rng.randrange(1, 10 ** 5)
+            score = rng.uniform(20, 500)
+            f.write(f"k141_{contig}_{gene} - PET - {10 ** -score / 10:.1e} {score:.1f} 0.1 {10 ** -score / 9:.1e} {score - 1:.1f} 0.1 1.0 1 1 0 1 1 1 1 "
+                    f"# {start} # {start + 899} # {rng.choice((-1, 1))} # ID={contig}_{gene};partial=00;start_type=ATG;rbs_motif=None;rbs_spacer=None;gc_cont=0.512\n")
+        f.write("#\n# Program:         hmmsearch\n# [ok]\n")
+
+
+def legacy_quantify_parse(path):
+    # The parsing quantify_hmm did before hmmer_tables
+    with open(path) as f:
+        rows = [line.split() for line in f.readlines() if not line.startswith('#') and line.strip()]
+    df = pd.DataFrame(rows)
+    df = df.loc[:, ~df.eq('#').all()]
+    df = df.iloc[:, :10]
+    df.columns = ['#target_name', 'target_accession', 'query_name', 'query_accession', 'E_value', 'score', 'bias', 'exp', 'reg', 'clu']
+    numeric_cols = ['E_value', 'score', 'bias', 'exp', 'reg', 'clu']
+    df[numeric_cols] = df[numeric_cols].apply(pd.to_numeric)
+    df['contig'] = df['#target_name'].apply(lambda x: '_'.join(x.split('_')[:2]))
+    return df
+
+
+def legacy_hit_ids(path):
+    # The hit IDs run_hmmer_thread collected with Biopython before hmmer_tables
+    return {result.id for result in SearchIO.read(path, "hmmer3-tab")}
+
+
+def benchmark_tblout(row_counts, tblout_files=()):
+    """Compare hmmer_tables with the parsing it replaced, on generated tblouts and given files.
+
+    For every table the time of read_tblout, read_target_names, the former quantify_hmm
+    DataFrame parsing and the former SearchIO hit collection is reported.
+    """
+    print("\t".join(["file", "rows", "read_tblout s", "read_target_names s", "quantify_hmm before s", "SearchIO before s"]))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tables = list(tblout_files)
+        for rows in row_counts:
+            path = os.path.join(tmp_dir, f"{rows}.tbl")
+            write_tblout(path, rows)
+            tables.append(path)
+
+        for path in tables:
+            table, parse_seconds = timed(hmmer_tables.read_tblout, path)
+            _, names_seconds = timed(hmmer_tables.read_target_names, path)
+            _, legacy_seconds = timed(legacy_quantify_parse, path)
+            _, searchio_seconds = timed(legacy_hit_ids, path)
+            print("\t".join([os.path.basename(path), str(len(table))] + [f"{seconds:.2f}" for seconds in (parse_seconds, names_seconds, legacy_seconds, searchio_seconds)]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="benchmarks", description="Throughput benchmarks of the in-process readers")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    bgzf_parser = subparsers.add_parser("bgzf", help="Parallel BGZF decompression and BAM record streaming")
+    bgzf_parser.add_argument("bam_files", nargs="+", help="BAM files to read")
+    bgzf_parser.add_argument("--threads", default=None, help="Comma separated thread counts (default: 1 and all cores)")
+
+    tblout_parser = subparsers.add_parser("tblout", help="HMMER tblout parsing")
+    tblout_parser.add_argument("--rows", default="1000000,5000000", help="Comma separated row counts of the generated tblouts (default: 1000000,5000000)")
+    tblout_parser.add_argument("--tblout", nargs="*", default=[], help="Existing tblout files to read as well")
+
+    args = parser.parse_args()
+    if args.command == "bgzf":
+        thread_counts = [int(threads) for threads in args.threads.split(",")] if args.threads else sorted({1, get_logical_cores()})
+        benchmark_bgzf(args.bam_files, thread_counts)
+    elif args.command == "tblout":
+        benchmark_tblout([int(rows) for rows in args.rows.split(",") if rows], args.tblout)
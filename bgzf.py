@@ -0,0 +1,291 @@
+import os
+import struct
+import zlib
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import utilities
+
+# Size of the fixed part of a BGZF block header, up to and including XLEN
+HEADER_SIZE = 12
+
+# Blocks decompressed by one task, about 4 MB of data
+BLOCKS_PER_TASK = 64
+
+
+def block_size(header, extra, offset=0, path=""):
+    # The compressed size of a block, stored minus one in the BC subfield of the gzip extra field
+    if len(header) < HEADER_SIZE or header[:4] != b"\x1f\x8b\x08\x04":
+        raise ValueError(f"ERROR: No BGZF block at offset {offset} of {path}")
+    xlen, = struct.unpack_from("<H", header, 10)
+    position = 0
+    while position + 4 <= xlen:
+        subfield_length, = struct.unpack_from("<H", extra, position + 2)
+        if extra[position:position + 2] == b"BC":
+            return struct.unpack_from("<H", extra, position + 4)[0] + 1
+        position += 4 + subfield_length
+    raise ValueError(f"ERROR: BGZF block at offset {offset} of {path} has no block size")
+
+
+def decompress_block(block):
+    # The data of a complete compressed block, without its header, extra field and trailer
+    xlen, = struct.unpack_from("<H", block, 10)
+    return zlib.decompress(block[HEADER_SIZE + xlen:-8], -15)
+
+
+def read_block(f, offset):
+    """Read and decompress the BGZF block starting at a file offset.
+
+    Returns:
+        tuple: The decompressed data and the compressed size of the block, (b"", 0) at the end of the file.
+    """
+    f.seek(offset)
+    header = f.read(HEADER_SIZE)
+    if not header:
+        return b"", 0
+    extra = f.read(struct.unpack_from("<H", header, 10)[0]) if len(header) == HEADER_SIZE else b""
+    size = block_size(header, extra, offset, f.name)
+    return decompress_block(header + extra + f.read(size - HEADER_SIZE - len(extra))), size
+
+
+def block_offsets(path):
+    """Find the file offsets of all BGZF blocks by reading only their headers.
+
+    Returns:
+        tuple: The offset and the compressed size of every block as arrays.
+    """
+    offsets, sizes = array("Q"), array("I")
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        offset = 0
+        while offset < file_size:
+            f.seek(offset)
+            header = f.read(HEADER_SIZE)
+            extra = f.read(struct.unpack_from("<H", header, 10)[0]) if len(header) == HEADER_SIZE else b""
+            size = block_size(header, extra, offset, path)
+            offsets.append(offset)
+            sizes.append(size)
+            offset += size
+    return offsets, sizes
+
+
+def read_blocks(path, threads=None, blocks_per_task=BLOCKS_PER_TASK):
+    """Decompress a BGZF file on a thread pool and yield its data in order.
+
+    The blocks are enumerated first, then groups of consecutive blocks are read and decompressed
+    by the threads; zlib releases the GIL, so the groups really decompress in parallel. At most
+    two groups per thread are in flight, so memory stays bounded for files of any size.
+
+    Args:
+        path (str): Path to the BGZF file.
+        threads (int, optional): The number of threads. Defaults to None, the logical cores then.
+        blocks_per_task (int, optional): The blocks of one group. Defaults to BLOCKS_PER_TASK.
+
+    Yields:
+        bytes: The decompressed data of consecutive groups of blocks.
+    """
+    offsets, sizes = block_offsets(path)
+    threads = max(1, threads or utilities.get_logical_cores())
+    fd = os.open(path, os.O_RDONLY)
+
+    def decompress_group(start):
+        stop = min(start + blocks_per_task, len(offsets))
+        data = memoryview(os.pread(fd, offsets[stop - 1] + sizes[stop - 1] - offsets[start], offsets[start]))
+        parts = []
+        position = 0
+        for size in sizes[start:stop]:
+            parts.append(decompress_block(data[position:position + size]))
+            position += size
+        return b"".join(parts)
+
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = deque()
+            for start in range(0, len(offsets), blocks_per_task):
+                pending.append(executor.submit(decompress_group, start))
+                if len(pending) >= 2 * threads:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        os.close(fd)
+
+
+def parse_header(data, position=0):
+    # The text and references of a BAM header and the position after it, None if data ends inside the header
+    view = memoryview(data)
+    if len(view) < position + 8:
+        return None
+    if bytes(view[position:position + 4]) != b"BAM\1":
+        raise ValueError("ERROR: Not a BAM file")
+    l_text, = struct.unpack_from("<i", view, position + 4)
+    position += 8 + l_text
+    if len(view) < position + 4:
+        return None
+    text = bytes(view[position - l_text:position]).rstrip(b"\0").decode()
+    n_ref, = struct.unpack_from("<i", view, position)
+    position += 4
+    references = []
+    for _ in range(n_ref):
+        if len(view) < position + 4:
+            return None
+        l_name, = struct.unpack_from("<i", view, position)
+        if len(view) < position + 8 + l_name:
+            return None
+        name = bytes(view[position + 4:position + 3 + l_name]).decode()
+        length, = struct.unpack_from("<i", view, position + 4 + l_name)
+        references.append((name, length))
+        position += 8 + l_name
+    return text, references, position
+
+
+class BamRecords:
+    """Stream the alignment records of a BAM file, decompressed in parallel.
+
+    Every record is handed out as a memoryview into the decompressed data, starting after its
+    block_size field. Only a record split across two groups of blocks is copied, from the end of
+    the one and the head of the next. A view stays valid after the iteration moved on, but
+    consumers that keep many of them keep their blocks in memory.
+
+    Args:
+        path (str): Path to the BAM file.
+        threads (int, optional): The decompression threads. Defaults to None, the logical cores then.
+
+    Example:
+        records = BamRecords("sample.bam", threads=8)
+        for record in records:
+            ref_id, position = struct.unpack_from("<ii", record)
+    """
+    def __init__(self, path, threads=None):
+        self.path = path
+        self.threads = threads
+        self.text = None
+        self.references = None
+
+    def __iter__(self):
+        # The incomplete record at the end of the previous data, the only bytes ever copied
+        leftover = b""
+        header_done = False
+        for data in read_blocks(self.path, self.threads):
+            position = 0
+
+            if not header_done:
+                data = leftover + data if leftover else data
+                leftover = b""
+                header = parse_header(data)
+                if header is None:
+                    leftover = bytes(data)
+                    continue
+                self.text, self.references, position = header
+                header_done = True
+            elif leftover:
+                # Complete the record split across the previous and this data from the head of data
+                head = bytes(memoryview(data)[:max(0, 4 - len(leftover))])
+                size_field = (leftover + head)[:4]
+                needed = 4 + int.from_bytes(size_field, "little") - len(leftover) if len(size_field) == 4 else None
+                if needed is None or needed > len(data):
+                    # The record spans more than two groups, e.g. a very long read
+                    leftover += bytes(data)
+                    continue
+                record = leftover + bytes(memoryview(data)[:needed])
+                yield memoryview(record)[4:]
+                leftover = b""
+                position = needed
+
+            view = memoryview(data)
+            end = len(data)
+            while position + 4 <= end:
+                record_end = position + 4 + int.from_bytes(view[position:position + 4], "little")
+                if record_end > end:
+                    break
+                yield view[position + 4:record_end]
+                position = record_end
+            leftover = bytes(view[position:]) if position < end else b""
+
+        if header_done and leftover:
+            raise ValueError(f"ERROR: {self.path} ends inside a record")
+
+
+def count_records(path, threads=None):
+    # The number of alignment records of a BAM file, what samtools view | wc -l counts
+    return sum(1 for _ in BamRecords(path, threads))
+
+
+class BgzfReader:
+    """Random access reader of a BGZF compressed file, e.g. a BAM file.
+
+    Positions are virtual offsets, the file offset of a block shifted left by 16 bits plus the
+    offset within the decompressed block, as stored in BAM indexes.
+
+    Args:
+        path (str): Path to the BGZF file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._block_offset = 0
+        self._block_size = 0
+        self._data = b""
+        self._position = 0
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _load(self, offset):
+        self._data, self._block_size = read_block(self._file, offset)
+        self._block_offset = offset
+        self._position = 0
+
+    def seek(self, virtual_offset):
+        offset, position = virtual_offset >> 16, virtual_offset & 0xFFFF
+        if offset != self._block_offset or not self._block_size:
+            self._load(offset)
+        self._position = position
+
+    def tell(self):
+        # The virtual offset of the next byte, at the end of a block that is the start of the next block
+        if self._position == len(self._data) and self._block_size:
+            return (self._block_offset + self._block_size) << 16
+        return (self._block_offset << 16) | self._position
+
+    def read(self, size):
+        """Read up to size decompressed bytes, continuing into the next blocks as needed."""
+        parts = []
+        while size > 0:
+            if self._position == len(self._data):
+                if not self._block_size:
+                    break
+                self._load(self._block_offset + self._block_size)
+                if not self._block_size:
+                    break
+                continue
+            part = self._data[self._position:self._position + size]
+            self._position += len(part)
+            size -= len(part)
+            parts.append(part)
+        return b"".join(parts)
+
+    def read_header(self):
+        """Read the header of a BAM file from its first blocks.
+
+        Returns:
+            tuple: The header text and the (name, length) of every reference.
+        """
+        self.seek(0)
+        data = self.read(8)
+        if data[:4] != b"BAM\1":
+            raise ValueError(f"ERROR: {self.path} is not a BAM file")
+        data += self.read(struct.unpack_from("<i", data, 4)[0] + 4)
+        n_ref, = struct.unpack_from("<i", data, len(data) - 4)
+        parts = [data]
+        for _ in range(n_ref):
+            l_name = self.read(4)
+            parts += [l_name, self.read(struct.unpack("<i", l_name)[0] + 4)]
+        text, references, _ = parse_header(b"".join(parts))
+        return text, references
@@ -1,36 +1,41 @@
 import os
 import glob
-from blast_handler import blast_local
-import concurrent.futures
+import logging
+from Bio import SeqIO
+from blast_handler import blast_sequences, top_hits, ANNOTATION_COLUMNS
 
-
-import os
-import glob
-from blast_handler import blast_local
-import concurrent.futures
-
-def run_blast(dir):
+def run_blast(dir, scheduler=None, db=None):
     """
-    Runs a local BLAST search for each fasta file in the specified directory.
+    Runs a local BLAST search for the fasta files in the specified directory and its subdirectories.
 
-    The results of each BLAST search are saved as an XML file in the same directory.
+    The unique sequences of all fasta files are searched with a single blastp run. The annotation
+    of every fasta file is saved as a tab separated <fasta file>.blast.tsv file next to it.
 
     Args:
         dir (str): The directory containing the fasta files. This should be the output directory of pathmanager but can also be used more generally.
+        scheduler (CoreScheduler, optional): The core budget of the run, shared with the other tools. Defaults to a budget of all available cores.
+        db (str, optional): The BLAST database. Defaults to the PLASTICTOOLS_BLAST_DB environment variable or swissprot.
     """
-    fasta_files = glob.glob(os.path.join(dir, "*.fasta"))
-
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        futures = []
-        for fasta_file in fasta_files:
-            filename = os.path.basename(fasta_file)
-            output_file = os.path.join(dir, f"{filename}.xml")
-
-            future = executor.submit(blast_local, fasta_file, output_file)
-            futures.append(future)
-
-        # Wait for all the blast jobs to complete
-        concurrent.futures.wait(futures)
-
-
-
+    fasta_files = glob.glob(os.path.join(dir, "**", "*.fasta"), recursive=True)
+
+    # Every sequence is searched once, also when it was found for several plastics
+    records = {}
+    for fasta_file in fasta_files:
+        with open(fasta_file) as f:
+            for record in SeqIO.parse(f, 'fasta'):
+                records.setdefault(str(record.seq), []).append((fasta_file, record.id))
+    if not records:
+        return
+
+    results = {fasta_file: [] for fasta_file in fasta_files}
+    sequences = list(records)
+    for seq, hits in blast_sequences(sequences, dir, db, scheduler):
+        for fasta_file, record_id in records[seq]:
+            results[fasta_file].extend(top_hits(record_id, hits))
+
+    for fasta_file, rows in results.items():
+        with open(f"{fasta_file}.blast.tsv", 'w') as f:
+            f.write('\t'.join(ANNOTATION_COLUMNS) + '\n')
+            for row in rows:
+                f.write('\t'.join(map(str, row)) + '\n')
+    logging.info(f"BLAST annotation of {len(fasta_files)} fasta files finished.")
@@ -0,0 +1,93 @@
+import os
+import json
+import glob
+import hashlib
+import sqlite3
+import utilities
+
+
+def sequence_hash(sequence):
+    return hashlib.sha256(sequence.encode()).hexdigest()
+
+
+def database_files(db):
+    # The index files of a BLAST database, looked up like blastp does: as given, then in $BLASTDB
+    directories = [""] + [directory for directory in os.environ.get("BLASTDB", "").split(os.pathsep) if directory]
+    for directory in directories:
+        base = os.path.join(directory, db)
+        files = sorted(glob.glob(f"{base}.p*") + glob.glob(f"{base}.[0-9][0-9].p*"))
+        if files:
+            return files
+    return []
+
+
+def database_identity(db):
+    """Return a string that changes when the BLAST database is replaced or updated.
+
+    The identity holds the resolved path, size and modification time of the database index
+    files. A database that cannot be found is identified by its name only.
+    """
+    files = database_files(db)
+    if not files:
+        return db
+    stats = [f"{os.path.basename(file)}:{os.path.getsize(file)}:{os.stat(file).st_mtime_ns}" for file in files]
+    return hashlib.sha256(";".join([os.path.realpath(files[0])] + stats).encode()).hexdigest()
+
+
+class BlastCache:
+    """On-disk cache of BLAST hits, shared by all runs of the user.
+
+    The hits of every query sequence are stored per sequence hash, database identity and E-value
+    cutoff, so the same protein is only searched again against a changed database or with a
+    different cutoff. Sequences without hits are stored too.
+
+    Args:
+        db (str): The BLAST database the hits come from.
+        evalue (float): The E-value cutoff of the search.
+    """
+    def __init__(self, db, evalue):
+        self.db = database_identity(db)
+        self.evalue = evalue
+        self.path = os.path.join(utilities.get_cache_dir(), "blast.sqlite")
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=60)
+        connection.execute("CREATE TABLE IF NOT EXISTS hits (sequence_hash TEXT, db TEXT, evalue REAL, hits TEXT, PRIMARY KEY (sequence_hash, db, evalue))")
+        return connection
+
+    def lookup(self, sequences):
+        """Return the cached hits of the given sequences.
+
+        Returns:
+            dict: The hits of every cached sequence, cache misses are left out.
+        """
+        hashes = {sequence_hash(sequence): sequence for sequence in sequences}
+        cached = {}
+        connection = self._connect()
+        try:
+            keys = list(hashes)
+            # SQLite limits the number of parameters of one statement
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = connection.execute(
+                    f"SELECT sequence_hash, hits FROM hits WHERE db = ? AND evalue = ? AND sequence_hash IN ({','.join('?' * len(batch))})",
+                    [self.db, self.evalue] + batch)
+                for key, hits in rows:
+                    cached[hashes[key]] = json.loads(hits)
+        finally:
+            connection.close()
+        return cached
+
+    def store(self, results):
+        """Store the hits of the searched sequences.
+
+        Args:
+            results (dict): The hits of every searched sequence, an empty list for sequences without hits.
+        """
+        connection = self._connect()
+        try:
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?)",
+                                       ((sequence_hash(sequence), self.db, self.evalue, json.dumps(hits)) for sequence, hits in results.items()))
+        finally:
+            connection.close()
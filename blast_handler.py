@@ -1,35 +1,177 @@
+import os
+import subprocess
 import logging
-from Bio.Blast import NCBIWWW, NCBIXML
-from Bio.Blast.Applications import NcbiblastpCommandline
-
-def blast_local(query, output="/home/jasper/Thesis/blast/blast_results.xml"):
-    # path to local blast binary
-    blastp_path = "/home/jasper/Thesis/blast/ncbi-blast-2.15.0+/bin/blastp"
-
-    # path to local blast database
-    database_path = "/home/jasper/Thesis/blast/database/swissprot"
-
-    # create a blast query command
-    blastp_cline = NcbiblastpCommandline(cmd=blastp_path, query=query, db=database_path, evalue=0.01, outfmt=5, out=output)
-
-    # execute the command
-    stdout, stderr = blastp_cline()
-
-    # parse the XML output
-    result_handle = open(output)
-    
-    return result_handle
-
-def blast_parse(record, local=True):
-    try:
-        if local:
-            result_handle = blast_local(record.seq) 
-        else:
-            result_handle = NCBIWWW.qblast("blastp", "swissprot", record.seq, expect=0.01, filter=True, word_size=6)
-
-        #parse the result
-        blast_record = NCBIXML.read(result_handle)
-        return blast_record
-    
-    except Exception as e:
-        logging.error(f"Error: {e}")
+from scheduler import CoreScheduler, estimate_memory
+from blast_cache import BlastCache
+
+# Columns of the tabular blastp output, the fields run_blast used to take from the XML records
+BLAST_COLUMNS = ["qseqid", "sseqid", "stitle", "bitscore", "evalue", "length", "nident", "qlen", "sacc"]
+
+# Columns of the annotation tables
+ANNOTATION_COLUMNS = ["Fasta header", "Functional annotation", "Bit-score", "E-value", "Query Cover", "Percent Identity", "Accession"]
+
+# Database used without --blast_db and PLASTICTOOLS_BLAST_DB, blastp looks it up in $BLASTDB
+DEFAULT_BLAST_DB = "swissprot"
+
+EVALUE = 0.01
+TOP_HITS = 5
+
+
+def get_blast_db(db=None):
+    """Return the BLAST database to search.
+
+    Args:
+        db (str, optional): The database, e.g. from the --blast_db argument. Defaults to None,
+            PLASTICTOOLS_BLAST_DB or DEFAULT_BLAST_DB is used then.
+    """
+    return db or os.environ.get("PLASTICTOOLS_BLAST_DB") or DEFAULT_BLAST_DB
+
+
+def write_queries(sequences, query_file):
+    # Write every sequence once under the ID q<index>, so duplicate FASTA headers cannot mix up results
+    with open(query_file, "w") as f:
+        for i, sequence in enumerate(sequences):
+            f.write(f">q{i}\n{sequence}\n")
+
+
+def blastp(query_file, output_file, db=None, num_threads=1, log_file=None):
+    """Search all queries of a FASTA file with a single blastp run.
+
+    Args:
+        query_file (str): The FASTA file with the queries.
+        output_file (str): The tabular output file, with the BLAST_COLUMNS.
+        db (str, optional): The BLAST database. Defaults to None, see get_blast_db.
+        num_threads (int, optional): The number of threads of blastp. Defaults to 1.
+        log_file (str, optional): The file for the blastp messages. Defaults to <output_file>.log.
+
+    Returns:
+        int: The return code of blastp.
+    """
+    log_file = log_file or f"{output_file}.log"
+    # No -max_target_seqs, blastp keeps its default of 500 target sequences like the XML based search did
+    blast_command = ["blastp", "-query", query_file, "-db", get_blast_db(db), "-evalue", str(EVALUE),
+                     "-num_threads", str(num_threads),
+                     "-outfmt", "6 " + " ".join(BLAST_COLUMNS), "-out", output_file]
+
+    with open(log_file, "w") as f:
+        process = subprocess.Popen(blast_command, stdout=f, stderr=f)
+        returncode = process.wait()
+
+    if returncode != 0:
+        logging.error(f"blastp failed, see {log_file}")
+    return returncode
+
+
+def read_blast_table(output_file):
+    """Stream the tabular blastp output, one query at a time.
+
+    blastp writes the hits of every query together, best hit first.
+
+    Yields:
+        tuple: The query ID and the hits of the query as dictionaries with the BLAST_COLUMNS.
+    """
+    query, hits = None, []
+    with open(output_file) as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+            hit = dict(zip(BLAST_COLUMNS, line.rstrip("\n").split("\t")))
+            if hit["qseqid"] != query:
+                if hits:
+                    yield query, hits
+                query, hits = hit["qseqid"], []
+            hits.append(hit)
+    if hits:
+        yield query, hits
+
+
+def top_hits(record_id, hits):
+    """Turn the hits of a query into annotation rows.
+
+    Like the XML based search, a query needs at least TOP_HITS hit proteins, and of the first
+    TOP_HITS the best alignment of every protein with an E-value below EVALUE is reported.
+
+    Args:
+        record_id (str): The FASTA header of the query.
+        hits (list): The hits of the query from read_blast_table.
+
+    Returns:
+        list: One row with the ANNOTATION_COLUMNS per reported hit.
+    """
+    # Only the first, best alignment of every hit protein counts
+    proteins = {}
+    for hit in hits:
+        proteins.setdefault(hit["sseqid"], hit)
+
+    result_list = []
+    if len(proteins) < TOP_HITS:
+        return result_list
+
+    for hit in list(proteins.values())[:TOP_HITS]:
+        e_value = float(hit["evalue"])
+        if e_value < EVALUE:
+            # The title starts with the subject ID, the XML hit definition did not
+            protein_hit = hit["stitle"]
+            if protein_hit.startswith(hit["sseqid"]):
+                protein_hit = protein_hit[len(hit["sseqid"]):].strip()
+            align_length = int(hit["length"])
+            query_cover = (align_length / int(hit["qlen"])) * 100
+            perc_identity = (int(hit["nident"]) / align_length) * 100
+            result_list.append([record_id, protein_hit, float(hit["bitscore"]), e_value, query_cover, perc_identity, hit["sacc"]])
+    return result_list
+
+
+def blast_sequences(sequences, work_dir, db=None, scheduler=None, use_cache=True):
+    """Search unique protein sequences with one blastp run and stream the hits of every sequence.
+
+    Sequences found in the BLAST cache are not searched again, the hits of the searched
+    sequences are added to the cache.
+
+    Args:
+        sequences (list): The protein sequences, every sequence once.
+        work_dir (str): Directory for the query, output and log files.
+        db (str, optional): The BLAST database. Defaults to None, see get_blast_db.
+        scheduler (CoreScheduler, optional): The core budget blastp takes half of its cores from,
+            the rest is left to the steps running next to it. Defaults to None, a budget of all
+            available cores then.
+        use_cache (bool, optional): If True, use and fill the BLAST cache. Defaults to True.
+
+    Yields:
+        tuple: A sequence with hits and its hits from read_blast_table.
+    """
+    cache = BlastCache(get_blast_db(db), EVALUE) if use_cache else None
+    if cache:
+        cached = cache.lookup(sequences)
+        logging.info(f"{len(cached)} of {len(sequences)} sequences found in the BLAST cache.")
+        for sequence, hits in cached.items():
+            if hits:
+                yield sequence, hits
+        sequences = [sequence for sequence in sequences if sequence not in cached]
+        if not sequences:
+            return
+
+    query_file = os.path.join(work_dir, "blast_queries.faa")
+    output_file = os.path.join(work_dir, "blast_hits.tsv")
+    write_queries(sequences, query_file)
+
+    if scheduler is None:
+        scheduler = CoreScheduler()
+
+    logging.info(f"Running blastp for {len(sequences)} sequences against {get_blast_db(db)}, this may take a while...")
+    # blastp runs in the background of the abundance step, so it only requests a share of the cores
+    cores = scheduler.share(2)
+    with scheduler.cores(cores, estimate_memory("blastp", query_file, threads=cores)) as num_threads:
+        returncode = blastp(query_file, output_file, db, num_threads)
+    if returncode != 0:
+        return
+
+    # Sequences without hits are cached as well, so they are not searched again either
+    results = {sequence: [] for sequence in sequences} if cache else None
+    for query, hits in read_blast_table(output_file):
+        sequence = sequences[int(query[1:])]
+        if cache:
+            results[sequence] = hits
+        yield sequence, hits
+
+    if cache:
+        cache.store(results)
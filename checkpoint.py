@@ -0,0 +1,91 @@
+import os
+import json
+import logging
+import utilities
+
+# Mapping files are identified by path, size, modification time and inode instead of their
+# checksum, hashing them would read every multi-GB BAM file just to check a checkpoint
+IDENTITY_EXTENSIONS = (".bam", ".sam", ".cram")
+
+
+def file_fingerprint(file):
+    # The checksum of small inputs, the identity of mapping files
+    if file.lower().endswith(IDENTITY_EXTENSIONS):
+        return utilities.file_identity(file)
+    return utilities.file_checksum(file)
+
+
+class Checkpoints:
+    """Completion markers of the pipeline stages.
+
+    Every completed stage writes a marker with the fingerprints of its input files and the
+    parameters it ran with, optionally together with its result. On a rerun a stage whose
+    marker still matches its inputs and parameters can be skipped.
+
+    Args:
+        temps (str): Path to the temporary folder of the run, the markers are kept in temps/checkpoints.
+        force (bool, optional): If True, every stage is treated as not completed. Defaults to False.
+    """
+    def __init__(self, temps, force=False):
+        self.directory = os.path.join(temps, "checkpoints")
+        self.force = force
+
+    def _marker_file(self, stage):
+        return os.path.join(self.directory, *stage.split("/")) + ".json"
+
+    def fingerprint(self, inputs, params=None):
+        """Return the fingerprints of the input files and the parameters of a stage."""
+        return {
+            "inputs": {os.path.abspath(file): file_fingerprint(file) for file in inputs},
+            "params": params or {},
+        }
+
+    def result(self, stage, inputs, params=None, default=None):
+        """Return the stored result of a completed stage, or default if it has to run (again).
+
+        Args:
+            stage (str): Name of the stage, e.g. "hmmer/pet".
+            inputs (list): Paths to the input files of the stage.
+            params (dict, optional): Parameters the stage runs with. Defaults to None.
+            default (optional): Returned when the stage is not completed. Defaults to None.
+        """
+        marker_file = self._marker_file(stage)
+        if self.force or not os.path.isfile(marker_file):
+            return default
+        if not all(os.path.isfile(file) for file in inputs):
+            return default
+
+        try:
+            with open(marker_file) as f:
+                marker = json.load(f)
+        except (OSError, ValueError):
+            return default
+
+        # Parameters are compared after a JSON round trip, so tuples and lists compare equal
+        if marker.get("params") != json.loads(json.dumps(params or {})):
+            return default
+        if marker.get("inputs") != self.fingerprint(inputs)["inputs"]:
+            return default
+        return marker.get("result", True)
+
+    def is_complete(self, stage, inputs, params=None):
+        return self.result(stage, inputs, params, default=None) is not None
+
+    def complete(self, stage, inputs, params=None, result=True):
+        """Write the completion marker of a stage."""
+        marker_file = self._marker_file(stage)
+        os.makedirs(os.path.dirname(marker_file), exist_ok=True)
+
+        marker = self.fingerprint(inputs, params)
+        marker["result"] = result
+
+        tmp_file = f"{marker_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(marker, f, indent=1)
+        os.replace(tmp_file, marker_file)
+        logging.debug(f"Stage {stage} completed.")
+
+    def clear(self, stage):
+        marker_file = self._marker_file(stage)
+        if os.path.isfile(marker_file):
+            os.remove(marker_file)
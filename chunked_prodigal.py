@@ -0,0 +1,151 @@
+import os
+import re
+import shutil
+import subprocess
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# Sequence numbers in the ID= attribute of the Prodigal headers and GFF records, and in the GFF sequence headers
+GENE_ID = re.compile(r"ID=(\d+)_")
+SEQNUM = re.compile(r"seqnum=(\d+)")
+
+
+def read_contig_lengths(contigs):
+    """Return the number of bases of every contig in file order.
+
+    Args:
+        contigs (str): Path to the contigs FASTA file.
+    """
+    lengths = []
+    with open(contigs, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                lengths.append(0)
+            elif lengths:
+                lengths[-1] += len(line.strip())
+    return lengths
+
+
+def plan_chunks(lengths, n_chunks):
+    """Split the contigs into at most n_chunks consecutive ranges with about the same number of bases.
+
+    Consecutive ranges keep the contigs in file order, so merging the chunk outputs in chunk order
+    gives the same order as a single Prodigal run.
+
+    Returns:
+        list: The number of contigs in every chunk.
+    """
+    total = sum(lengths)
+    n_chunks = max(1, min(n_chunks, len(lengths)))
+    sizes = []
+    bases = 0
+    count = 0
+    for length in lengths:
+        bases += length
+        count += 1
+        if bases >= total * (len(sizes) + 1) / n_chunks and len(sizes) < n_chunks - 1:
+            sizes.append(count)
+            count = 0
+    if count:
+        sizes.append(count)
+    return sizes
+
+
+def split_contigs(contigs, sizes, chunk_dir):
+    # Write the consecutive ranges of contigs to one FASTA file per chunk
+    chunk_files = [os.path.join(chunk_dir, f"chunk_{i}.fa") for i in range(len(sizes))]
+    chunk = -1
+    remaining = 0
+    output = None
+    with open(contigs, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if remaining == 0:
+                    if output:
+                        output.close()
+                    chunk += 1
+                    remaining = sizes[chunk]
+                    output = open(chunk_files[chunk], 'wb')
+                remaining -= 1
+            if output:
+                output.write(line)
+    if output:
+        output.close()
+    return chunk_files
+
+
+def run_chunk(chunk_file, mode="meta"):
+    # Run prodigal on one chunk, the outputs are written next to the chunk file
+    base = os.path.splitext(chunk_file)[0]
+    outputs = {ext: f"{base}{ext}" for ext in (".faa", ".ffn", ".gff")}
+    command = ["prodigal", "-i", chunk_file, "-a", outputs[".faa"], "-d", outputs[".ffn"], "-f", "gff", "-o", outputs[".gff"], "-p", mode]
+    with open(f"{base}.log", 'w') as log:
+        returncode = subprocess.run(command, stdout=log, stderr=log).returncode
+    return returncode, outputs
+
+
+def merge_outputs(chunk_outputs, sizes, outputs):
+    """Concatenate the chunk outputs in chunk order and renumber the sequences of the later chunks.
+
+    Prodigal numbers the sequences of every input from 1, the ID=<seqnum>_<gene> attributes and
+    the seqnum of the GFF sequence headers are shifted so they match a single run over all contigs.
+    The gene names themselves are <contig>_<gene> and never collide between chunks.
+
+    Args:
+        chunk_outputs (list): The outputs of every chunk returned by run_chunk, in chunk order.
+        sizes (list): The number of contigs in every chunk.
+        outputs (dict): The merged output file for every extension.
+    """
+    for ext, merged_file in outputs.items():
+        with open(merged_file, 'w') as merged:
+            offset = 0
+            for i, (chunk, size) in enumerate(zip(chunk_outputs, sizes)):
+                with open(chunk[ext]) as f:
+                    for line in f:
+                        if line.startswith("##gff-version") and i > 0:
+                            continue
+                        if offset and (line.startswith(">") or ext == ".gff"):
+                            line = GENE_ID.sub(lambda match: f"ID={int(match.group(1)) + offset}_", line)
+                            line = SEQNUM.sub(lambda match: f"seqnum={int(match.group(1)) + offset}", line)
+                        merged.write(line)
+                offset += size
+
+
+def run_chunked_prodigal(contigs, outputs, cores, chunk_dir, log_file, mode="meta"):
+    """Run Prodigal on balanced chunks of the contigs in parallel and merge the outputs.
+
+    Every chunk runs in its own prodigal process, the pool threads only wait for them.
+
+    Args:
+        contigs (str): Path to the contigs FASTA file.
+        outputs (dict): The merged .faa, .ffn and .gff output file by extension.
+        cores (int): The number of prodigal processes to run at the same time.
+        chunk_dir (str): Directory for the chunk files, removed afterwards.
+        log_file (str): The logs of all chunks are collected in this file.
+        mode (str, optional): The Prodigal procedure. Defaults to "meta".
+
+    Returns:
+        bool: True if every chunk finished successfully.
+    """
+    os.makedirs(chunk_dir, exist_ok=True)
+    try:
+        sizes = plan_chunks(read_contig_lengths(contigs), cores)
+        chunk_files = split_contigs(contigs, sizes, chunk_dir)
+        logging.info(f"Running prodigal on {len(chunk_files)} chunks of {contigs}")
+
+        with ThreadPoolExecutor(max_workers=cores) as executor:
+            results = list(executor.map(lambda chunk_file: run_chunk(chunk_file, mode), chunk_files))
+
+        with open(log_file, 'w') as log:
+            for chunk_file in chunk_files:
+                with open(f"{os.path.splitext(chunk_file)[0]}.log") as chunk_log:
+                    log.write(chunk_log.read())
+
+        if any(returncode != 0 for returncode, _ in results):
+            logging.error(f"prodigal failed on a chunk of {contigs}, see {log_file}")
+            return False
+
+        merge_outputs([chunk_outputs for _, chunk_outputs in results], sizes, outputs)
+        return True
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
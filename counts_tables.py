@@ -0,0 +1,202 @@
+import os
+from collections import Counter, namedtuple
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import utilities
+
+# Rows read at once from a count table
+CHUNK_ROWS = 1 << 20
+
+# The columns of samtools idxstats output, the headerless layout of a single sample table
+IDXSTATS_COLUMNS = ["contig", "length", "num_reads", "unmapped_reads"]
+
+# The read counts of the hit contigs of every sample:
+#   samples: the sample names
+#   reads: the contigs x samples read counts as a scipy.sparse CSR matrix
+#   densities: the contigs x samples reads per base of the contig as a scipy.sparse CSR matrix
+#   listed: the contigs x samples boolean matrix of the contigs listed for every sample
+#   library_sizes: the reads of every sample on all contigs, hit or not
+SampleCounts = namedtuple("SampleCounts", ["samples", "reads", "densities", "listed", "library_sizes"])
+
+
+def table_layout(path):
+    """Detect the layout of a count table from its first line.
+
+    Three layouts are read, all tab separated:
+        idxstats: no header, the columns contig, length, num_reads and optionally unmapped_reads,
+            one sample per file, e.g. samtools idxstats output.
+        long: a header with the columns contig, length and num_reads, and a sample column when
+            the file holds more than one sample.
+        wide: a header with the columns contig and length, every other column is the read count
+            of one sample; an unmapped_reads column is ignored.
+
+    Returns:
+        tuple: The layout name and the column names of the file.
+    """
+    first = pd.read_csv(path, sep="\t", header=None, nrows=1, dtype=str).iloc[0].tolist()
+    if len(first) >= 3 and str(first[1]).strip().isdigit():
+        if len(first) > len(IDXSTATS_COLUMNS):
+            raise ValueError(f"ERROR: {path} has no header and more columns than samtools idxstats output")
+        return "idxstats", IDXSTATS_COLUMNS[:len(first)]
+
+    columns = [str(column).strip() for column in first]
+    if "contig" not in columns or "length" not in columns:
+        raise ValueError(f"ERROR: The header of {path} needs a contig and a length column")
+    if "num_reads" in columns:
+        return "long", columns
+    if "sample" in columns:
+        raise ValueError(f"ERROR: {path} has a sample column but no num_reads column")
+    return "wide", columns
+
+
+def read_counts_table(path, contigs, sample_name, chunksize=CHUNK_ROWS):
+    """Read the counts of the hit contigs from a count table, chunk by chunk.
+
+    Every chunk is parsed with explicit column types and semi-joined with the hit contigs right
+    away, only their rows are kept. The library size of every sample is summed over all rows.
+
+    Args:
+        path (str): Path to the count table, in one of the layouts of table_layout.
+        contigs (pandas.Index): The contigs with hit genes.
+        sample_name (str): The sample of tables without a sample column.
+        chunksize (int, optional): Rows parsed at once. Defaults to CHUNK_ROWS.
+
+    Returns:
+        tuple: The sample names and library sizes, and for every kept row its contig position,
+            sample position, reads and contig length as NumPy arrays.
+    """
+    layout, columns = table_layout(path)
+    header = None if layout == "idxstats" else 0
+    if layout == "wide":
+        sample_columns = [column for column in columns if column not in ("contig", "length", "unmapped_reads")]
+        usecols = ["contig", "length"] + sample_columns
+        dtypes = {column: np.float64 for column in sample_columns}
+    else:
+        sample_columns = None
+        usecols = [column for column in ("sample", "contig", "length", "num_reads") if column in columns]
+        dtypes = {"num_reads": np.float64}
+    dtypes.update({"contig": str, "sample": str, "length": np.int64})
+
+    samples = {} if sample_columns is None else {column: i for i, column in enumerate(sample_columns)}
+    if "sample" not in usecols and sample_columns is None:
+        samples[sample_name] = 0
+    library_sizes = {}
+    kept = {"positions": [], "samples": [], "reads": [], "lengths": []}
+
+    reader = pd.read_csv(path, sep="\t", header=header, names=columns if header is None else None, usecols=usecols,
+                         dtype={column: dtype for column, dtype in dtypes.items() if column in usecols},
+                         chunksize=chunksize, engine="c")
+    for chunk in reader:
+        positions = contigs.get_indexer(chunk["contig"])
+        found = positions >= 0
+
+        if sample_columns is not None:
+            counts = chunk[sample_columns].to_numpy(dtype=np.float64)
+            for i, total in enumerate(counts.sum(axis=0)):
+                library_sizes[i] = library_sizes.get(i, 0.0) + total
+            counts = counts[found]
+            kept["positions"].append(np.repeat(positions[found], len(sample_columns)))
+            kept["samples"].append(np.tile(np.arange(len(sample_columns)), len(counts)))
+            kept["reads"].append(counts.ravel())
+            kept["lengths"].append(np.repeat(chunk["length"].to_numpy(dtype=np.float64)[found], len(sample_columns)))
+            continue
+
+        if "sample" in chunk:
+            for sample in pd.unique(chunk["sample"]):
+                samples.setdefault(sample, len(samples))
+            sample_ids = chunk["sample"].map(samples).to_numpy(dtype=np.int64)
+        else:
+            sample_ids = np.zeros(len(chunk), dtype=np.int64)
+        reads = chunk["num_reads"].to_numpy(dtype=np.float64)
+        for i, total in enumerate(np.bincount(sample_ids, weights=reads, minlength=len(samples))):
+            library_sizes[i] = library_sizes.get(i, 0.0) + total
+        kept["positions"].append(positions[found])
+        kept["samples"].append(sample_ids[found])
+        kept["reads"].append(reads[found])
+        kept["lengths"].append(chunk["length"].to_numpy(dtype=np.float64)[found])
+
+    arrays = [np.concatenate(kept[key]) if kept[key] else np.zeros(0, dtype=dtype)
+              for key, dtype in (("positions", np.int64), ("samples", np.int64), ("reads", np.float64), ("lengths", np.float64))]
+    return list(samples), np.array([library_sizes.get(i, 0.0) for i in range(len(samples))]), *arrays
+
+
+def sample_counts(contigs, rows):
+    """Assemble the read counts of the samples into SampleCounts.
+
+    Args:
+        contigs (pandas.Index): The contigs with hit genes.
+        rows (list): The output of read_counts_table for every file.
+
+    Returns:
+        SampleCounts: The counts of all samples, in the order of rows.
+    """
+    samples, library_sizes = [], []
+    positions, columns, reads, densities = [], [], [], []
+    for file_samples, file_library_sizes, file_positions, file_sample_ids, file_reads, lengths in rows:
+        columns.append(file_sample_ids + len(samples))
+        samples.extend(file_samples)
+        library_sizes.append(file_library_sizes)
+        positions.append(file_positions)
+        reads.append(file_reads)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            densities.append(file_reads / lengths)
+
+    duplicates = sorted(sample for sample, n in Counter(samples).items() if n > 1)
+    if duplicates:
+        raise ValueError(f"ERROR: The samples {', '.join(duplicates)} appear in more than one count table")
+
+    shape = (len(contigs), len(samples))
+    positions = np.concatenate(positions) if positions else np.zeros(0, dtype=np.int64)
+    columns = np.concatenate(columns) if columns else np.zeros(0, dtype=np.int64)
+    reads = np.concatenate(reads) if reads else np.zeros(0)
+    densities = np.concatenate(densities) if densities else np.zeros(0)
+    listed = np.zeros(shape, dtype=bool)
+    listed[positions, columns] = True
+    library_sizes = np.concatenate(library_sizes) if library_sizes else np.zeros(0)
+    return SampleCounts(samples, sparse.csr_matrix((reads, (positions, columns)), shape=shape, dtype=np.float64),
+                        sparse.csr_matrix((densities, (positions, columns)), shape=shape, dtype=np.float64), listed, library_sizes)
+
+
+def read_counts_tables(paths, contigs, sample_names=None, threads=None, chunksize=CHUNK_ROWS):
+    """Read the counts of the hit contigs from many count tables in parallel.
+
+    Args:
+        paths (list): The count tables.
+        contigs (pandas.Index): The contigs with hit genes.
+        sample_names (list, optional): The sample of every table without a sample column.
+            Defaults to None, the file names then.
+        threads (int, optional): The tables read at once. Defaults to None, the logical cores then.
+        chunksize (int, optional): Rows parsed at once per table. Defaults to CHUNK_ROWS.
+
+    Returns:
+        SampleCounts: The counts of all samples, in the order of the tables.
+    """
+    sample_names = sample_names or [os.path.basename(path) for path in paths]
+    if not paths:
+        return sample_counts(contigs, [])
+    threads = threads or utilities.get_logical_cores()
+    with ThreadPool(processes=max(1, min(len(paths), threads))) as pool:
+        rows = pool.starmap(lambda path, name: read_counts_table(path, contigs, name, chunksize), zip(paths, sample_names))
+    return sample_counts(contigs, rows)
+
+
+def tables_counts(contigs, read_counts_tables):
+    """Gather the read counts of in-memory idxstats tables, one per sample, into SampleCounts.
+
+    Args:
+        contigs (pandas.Index): The contigs with hit genes.
+        read_counts_tables (dict): The table with the contig, length and num_reads columns of every sample.
+
+    Returns:
+        SampleCounts: The counts of all samples, in the order of the tables.
+    """
+    rows = []
+    for sample, table in read_counts_tables.items():
+        positions = contigs.get_indexer(table["contig"])
+        found = positions >= 0
+        reads = table["num_reads"].to_numpy(dtype=np.float64)
+        rows.append(([sample], np.array([reads.sum()]), positions[found], np.zeros(found.sum(), dtype=np.int64),
+                     reads[found], table["length"].to_numpy(dtype=np.float64)[found]))
+    return sample_counts(contigs, rows)
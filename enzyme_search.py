@@ -0,0 +1,317 @@
+import os
+import pickle
+import sqlite3
+import logging
+from collections import Counter
+from functools import lru_cache
+import numpy as np
+from Bio import SeqIO
+from Bio.Align import substitution_matrices
+import utilities
+
+# The curated plastic degrading enzymes shipped with the tool
+ENZYME_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "PlasticEnzymes.db")
+
+# Columns of the nearest enzyme tables
+ENZYME_COLUMNS = ["Fasta header", "Genus", "Species", "Strain", "Enzyme", "Plastic", "Percent Identity", "Score"]
+
+# Length of the k-mers seeding the alignments
+KMER_SIZE = 3
+
+# Candidates aligned per query, ranked by their shared k-mers on the best diagonal; a candidate
+# with less than CANDIDATE_RATIO of the seeds of the best one is not aligned
+CANDIDATES = 5
+CANDIDATE_RATIO = 0.5
+
+# Shared k-mers on one diagonal a candidate needs
+MIN_SEEDS = 3
+
+# Half width of the alignment band around the seeded diagonal
+BAND = 24
+
+GAP_OPEN = 11
+GAP_EXTEND = 1
+
+# BLOSUM62 score a nearest enzyme needs, about 40 bits
+MIN_SCORE = 80
+
+ENZYME_QUERY = """
+    SELECT Sequences.Seq_Pk, Sequences.SEQUENCE, Main_copy.Genus, Main_copy.Species, Main_copy.Strain,
+           Main_copy.Enzyme, Plastic.PLASTIC
+    FROM Main_copy
+    JOIN Sequences ON Main_copy.Sequences_id = Sequences.Seq_Pk
+    LEFT JOIN Plastic ON Main_copy.Plastic_id = Plastic.Plastic_id
+    ORDER BY Main_copy.Main_Pk
+"""
+
+
+def clean_sequence(sequence):
+    # The DB sequences hold line breaks and spaces, Prodigal proteins end with the stop '*'
+    return "".join(sequence.split()).upper().rstrip("*")
+
+
+def clean_field(value):
+    return value.strip() if isinstance(value, str) else ("" if value is None else str(value))
+
+
+def load_enzymes(db=ENZYME_DB):
+    """Read the enzymes with a sequence from the database.
+
+    An enzyme listed for several plastics is kept once, with all its plastics.
+
+    Returns:
+        tuple: The enzyme sequences and the genus, species, strain, enzyme and plastics of every sequence.
+    """
+    enzymes = {}
+    connection = sqlite3.connect(db)
+    try:
+        for seq_pk, sequence, genus, species, strain, enzyme, plastic in connection.execute(ENZYME_QUERY):
+            sequence = clean_sequence(sequence or "")
+            if not sequence:
+                continue
+            if seq_pk not in enzymes:
+                enzymes[seq_pk] = [sequence, clean_field(genus), clean_field(species), clean_field(strain), clean_field(enzyme), []]
+            plastic = clean_field(plastic)
+            if plastic and plastic not in enzymes[seq_pk][5]:
+                enzymes[seq_pk][5].append(plastic)
+    finally:
+        connection.close()
+
+    sequences = [enzyme[0] for enzyme in enzymes.values()]
+    annotations = [tuple(enzyme[1:5]) + (",".join(enzyme[5]),) for enzyme in enzymes.values()]
+    return sequences, annotations
+
+
+def build_index(sequences, k=KMER_SIZE):
+    # Positions of every k-mer in the enzyme sequences, as (sequence index, position) pairs
+    kmers = {}
+    for i, sequence in enumerate(sequences):
+        for position in range(len(sequence) - k + 1):
+            kmers.setdefault(sequence[position:position + k], []).append((i, position))
+    return kmers
+
+
+class EnzymeIndex:
+    """K-mer index over the enzyme sequences of PlasticEnzymes.db.
+
+    A protein identical to an enzyme is found by a dictionary lookup. Any other protein is
+    compared to the enzymes sharing the most k-mers with it on one diagonal, each with a banded
+    Smith-Waterman alignment around that diagonal, and gets the best scoring one.
+
+    Args:
+        sequences (list): The enzyme sequences.
+        annotations (list): The genus, species, strain, enzyme and plastics of every sequence.
+        k (int, optional): The k-mer length. Defaults to KMER_SIZE.
+    """
+    def __init__(self, sequences, annotations, k=KMER_SIZE):
+        self.sequences = sequences
+        self.annotations = annotations
+        self.k = k
+        self.kmers = build_index(sequences, k)
+        self.exact = {}
+        for i, sequence in enumerate(sequences):
+            self.exact.setdefault(sequence, i)
+
+    @classmethod
+    def load(cls, db=ENZYME_DB, use_cache=True):
+        """Load the index of a database from the cache, building and caching it on a miss.
+
+        The cached index is keyed by the checksum of the database, so a changed database is indexed again.
+        """
+        if not use_cache:
+            return cls(*load_enzymes(db))
+
+        cache_file = os.path.join(utilities.get_cache_dir("enzymes"), f"{utilities.file_checksum(db)}_k{KMER_SIZE}.pickle")
+        try:
+            with open(cache_file, "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            pass
+
+        index = cls(*load_enzymes(db))
+        # Write to a temporary file first, so concurrent runs never read half an index
+        temp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(temp_file, "wb") as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, cache_file)
+        return index
+
+    def candidates(self, query):
+        # The enzymes with the most shared k-mers on one diagonal, best first, with that diagonal
+        diagonals = Counter()
+        k = self.k
+        for position in range(len(query) - k + 1):
+            for i, target_position in self.kmers.get(query[position:position + k], ()):
+                diagonals[(i, target_position - position)] += 1
+
+        best = {}
+        for (i, diagonal), seeds in diagonals.items():
+            if seeds >= MIN_SEEDS and seeds > best.get(i, (0, 0))[0]:
+                best[i] = (seeds, diagonal)
+        ranked = sorted(best.items(), key=lambda item: -item[1][0])[:CANDIDATES]
+        return [(i, (seeds, diagonal)) for i, (seeds, diagonal) in ranked if seeds >= CANDIDATE_RATIO * ranked[0][1][0]]
+
+    def nearest(self, query):
+        """Find the closest enzyme of a protein.
+
+        Returns:
+            tuple: The annotation of the enzyme, the percent identity and the alignment score,
+                or None if no enzyme scores MIN_SCORE.
+        """
+        query = clean_sequence(query)
+        if query in self.exact:
+            return self.annotations[self.exact[query]], 100.0, None
+
+        best = None
+        for i, (_, diagonal) in self.candidates(query):
+            score, identity = banded_align(query, self.sequences[i], diagonal - BAND, diagonal + BAND)
+            if score >= MIN_SCORE and (best is None or score > best[2]):
+                best = (self.annotations[i], identity, score)
+        return best
+
+
+@lru_cache(maxsize=None)
+def blosum62():
+    # BLOSUM62 as an integer matrix, with the index of every residue; unknown residues count as 'X'
+    matrix = substitution_matrices.load("BLOSUM62")
+    alphabet = matrix.alphabet
+    scores = np.array([[matrix[a][b] for b in alphabet] for a in alphabet], dtype=np.int32)
+    lookup = np.full(256, alphabet.index("X"), dtype=np.int32)
+    for i, residue in enumerate(alphabet):
+        lookup[ord(residue)] = i
+    return scores, lookup
+
+
+def encode(sequence, lookup):
+    return lookup[np.frombuffer(sequence.encode("ascii", "replace"), dtype=np.uint8)]
+
+
+def banded_align(query, target, diagonal_lo, diagonal_hi, gap_open=GAP_OPEN, gap_extend=GAP_EXTEND):
+    """Align a query locally to a target within a band of diagonals, with BLOSUM62 and affine gaps.
+
+    Only the cells with diagonal_lo <= target position - query position <= diagonal_hi are
+    filled, one query row at a time with numpy. Gaps in the target follow from the previous
+    row, gaps in the query are resolved within the row with a running maximum.
+
+    Returns:
+        tuple: The best local alignment score and the percent identity of that alignment.
+    """
+    scores, lookup = blosum62()
+    q = encode(query, lookup)
+    t = encode(target, lookup)
+    n, m = len(q), len(t)
+    width = diagonal_hi - diagonal_lo + 1
+    offsets = np.arange(width)
+    neg = -(1 << 28)
+
+    # H and E of the previous row, one extra cell so the cell above the band's last cell is empty
+    h_prev = np.zeros(width + 1, dtype=np.int32)
+    e_prev = np.full(width + 1, neg, dtype=np.int32)
+    # Per cell: 0 start, 1 diagonal, 2 gap in the target, 3 gap in the query; and the extension flags
+    sources = np.zeros((n, width), dtype=np.int8)
+    e_extends = np.zeros((n, width), dtype=bool)
+    f_extends = np.zeros((n, width), dtype=bool)
+    best_score, best_cell = 0, None
+
+    # The substitution scores of all band cells at once, cells outside the target score neg
+    columns = np.arange(n)[:, None] + diagonal_lo + offsets
+    valid = (columns >= 0) & (columns < m)
+    substitution = np.where(valid, scores[q[:, None], t[np.clip(columns, 0, m - 1)]], neg)
+    f_gaps = gap_open + gap_extend * offsets[:-1]
+    f_ramp = gap_extend * offsets
+
+    for i in range(n):
+        diagonal = h_prev[:width] + substitution[i]
+        e_open = h_prev[1:] - gap_open
+        e_extend = e_prev[1:] - gap_extend
+        e = np.maximum(e_open, e_extend)
+        h0 = np.maximum(np.maximum(diagonal, e), 0)
+
+        # F[j] = max over k < j of H[k] - gap_open - gap_extend * (j - 1 - k)
+        running = np.maximum.accumulate(h0 + f_ramp)
+        f = np.full(width, neg, dtype=np.int32)
+        f[1:] = running[:-1] - f_gaps
+        h = np.maximum(h0, f)
+        h[~valid[i]] = 0
+
+        source = np.zeros(width, dtype=np.int8)
+        source[(h == f) & (h > 0)] = 3
+        source[(h == e) & (h > 0)] = 2
+        source[(h == diagonal) & (h > 0)] = 1
+        sources[i] = source
+        e_extends[i] = e_extend > e_open
+        f_extends[i, 1:] = f[1:] > h0[:-1] - gap_open
+
+        j = int(np.argmax(h))
+        if h[j] > best_score:
+            best_score, best_cell = int(h[j]), (i, j)
+
+        h_prev[:width] = h
+        e_prev[:width] = e
+
+    if best_cell is None:
+        return 0, 0.0
+
+    # Trace the alignment back to count its identical positions and columns
+    i, j = best_cell
+    state = sources[i, j]
+    matches = length = 0
+    while i >= 0 and state != 0:
+        length += 1
+        if state == 1:
+            matches += query[i] == target[i + diagonal_lo + j]
+            i -= 1
+            state = sources[i, j] if i >= 0 else 0
+        elif state == 2:
+            extends = e_extends[i, j]
+            i, j = i - 1, j + 1
+            state = 2 if extends else sources[i, j]
+        else:
+            extends = f_extends[i, j]
+            j -= 1
+            state = 3 if extends else sources[i, j]
+    return best_score, 100 * matches / length
+
+
+def nearest_enzymes(fasta_file, output_file, index=None):
+    """Write the closest known plastic degrading enzyme of every protein of a FASTA file.
+
+    Proteins without an enzyme scoring MIN_SCORE are left out.
+
+    Args:
+        fasta_file (str): The protein FASTA file, e.g. the HMM hits of a plastic.
+        output_file (str): The TSV file with the ENZYME_COLUMNS.
+        index (EnzymeIndex, optional): The enzyme index. Defaults to None, the cached index of PlasticEnzymes.db then.
+
+    Returns:
+        int: The number of proteins with a nearest enzyme.
+    """
+    index = index or EnzymeIndex.load()
+    found = 0
+    with open(fasta_file) as f, open(output_file, "w") as output:
+        output.write("\t".join(ENZYME_COLUMNS) + "\n")
+        for record in SeqIO.parse(f, "fasta"):
+            nearest = index.nearest(str(record.seq))
+            if nearest is None:
+                continue
+            (genus, species, strain, enzyme, plastics), identity, score = nearest
+            output.write("\t".join([record.id, genus, species, strain, enzyme, plastics, f"{identity:.1f}", "" if score is None else str(score)]) + "\n")
+            found += 1
+    return found
+
+
+def run_enzyme_search(p):
+    """Annotate the HMM hits of every plastic with their closest enzyme of PlasticEnzymes.db.
+
+    The table of every plastic is written next to its hits as <hits>_enzymes.tsv.
+    """
+    if not os.path.isfile(ENZYME_DB):
+        logging.warning(f"{ENZYME_DB} not found, skipping the nearest enzyme search.")
+        return
+    index = EnzymeIndex.load()
+    contigs_base = os.path.basename(p.contigs).split(".")[0]
+    for plastic_name in p.plastic_list:
+        hits_base = os.path.join(p.temps, plastic_name, f"{contigs_base}_{plastic_name}_hmm_output")
+        if os.path.isfile(f"{hits_base}.fasta"):
+            found = nearest_enzymes(f"{hits_base}.fasta", f"{hits_base}_enzymes.tsv", index)
+            logging.info(f"{found} {plastic_name} hits resemble a known enzyme.")
@@ -0,0 +1,164 @@
+import os
+import hashlib
+from array import array
+import logging
+import numpy as np
+
+# One row per record, sorted by the hash of the record name
+INDEX_DTYPE = np.dtype([('hash', '<u8'), ('length', '<i8'), ('offset', '<i8'), ('line_bases', '<i8'), ('line_width', '<i8')])
+
+# The index files written next to a FASTA file
+INDEX_SUFFIXES = (".fai", ".fai.npy", ".fai.id")
+
+
+def fasta_identity(fasta_file):
+    # Size, modification time and inode of the FASTA file; a hard link swapped in keeps the older mtime of its target
+    stat = os.stat(fasta_file)
+    return f"{stat.st_size}:{stat.st_mtime_ns}:{stat.st_ino}"
+
+
+def remove_index(fasta_file):
+    # Remove the index files of a FASTA file that is about to be replaced
+    for suffix in INDEX_SUFFIXES:
+        if os.path.lexists(f"{fasta_file}{suffix}"):
+            os.remove(f"{fasta_file}{suffix}")
+
+
+def name_hash(name):
+    return int.from_bytes(hashlib.blake2b(name.encode() if isinstance(name, str) else name, digest_size=8).digest(), 'little')
+
+
+class FastaIndex:
+    """Offset index of a FASTA file.
+
+    Next to the FASTA file a samtools faidx compatible .fai file is written, together with a
+    .fai.npy array sorted by record name hash. The array is memory-mapped, so the index is
+    built once per run and every worker process shares it without loading the names. The
+    .fai.id file holds the size, modification time and inode of the indexed FASTA file, the
+    index is rebuilt when any of them changed.
+
+    Args:
+        fasta_file (str): Path to the FASTA file.
+    """
+    def __init__(self, fasta_file):
+        self.fasta_file = fasta_file
+        self.index_file = f"{fasta_file}.fai"
+        self.array_file = f"{fasta_file}.fai.npy"
+        self.identity_file = f"{fasta_file}.fai.id"
+
+        if not self.is_current():
+            self.build()
+
+        self.rows = np.load(self.array_file, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def is_current(self):
+        # The index files exist and were built from the FASTA file as it is now
+        if not (os.path.isfile(self.array_file) and os.path.isfile(self.identity_file)):
+            return False
+        with open(self.identity_file) as f:
+            return f.read().strip() == fasta_identity(self.fasta_file)
+
+    def build(self):
+        """Scan the FASTA file once and write the .fai, .fai.npy and .fai.id index files."""
+        logging.info(f"Indexing {self.fasta_file}...")
+        identity = fasta_identity(self.fasta_file)
+        columns = [array('Q'), array('q'), array('q'), array('q'), array('q')]
+        tmp_index = f"{self.index_file}.{os.getpid()}.tmp"
+
+        with open(self.fasta_file, 'rb') as f, open(tmp_index, 'w') as fai:
+            def add(name, *values):
+                fai.write(name.decode() + "\t" + "\t".join(map(str, values)) + "\n")
+                columns[0].append(name_hash(name))
+                for column, value in zip(columns[1:], values):
+                    column.append(value)
+
+            name = None
+            position = 0
+            for line in f:
+                if line.startswith(b'>'):
+                    if name is not None:
+                        add(name, length, offset, line_bases, line_width)
+                    fields = line[1:].split(None, 1)
+                    name = fields[0] if fields else b""
+                    offset = position + len(line)
+                    length = line_bases = line_width = 0
+                    short_line = False
+                else:
+                    bases = len(line.rstrip(b'\r\n'))
+                    if bases:
+                        # Like faidx, every line but the last one of a record must have the same width
+                        if short_line or (line_bases and bases > line_bases):
+                            raise ValueError(f"ERROR: Different line length in sequence {name.decode()} of {self.fasta_file}")
+                        if not line_bases:
+                            line_bases, line_width = bases, len(line)
+                        elif bases < line_bases:
+                            short_line = True
+                        length += bases
+                position += len(line)
+            if name is not None:
+                add(name, length, offset, line_bases, line_width)
+
+        rows = np.empty(len(columns[0]), dtype=INDEX_DTYPE)
+        for field, column in zip(INDEX_DTYPE.names, columns):
+            rows[field] = np.asarray(column)
+        rows.sort(order='hash', kind='stable')
+
+        tmp_array = f"{self.array_file}.{os.getpid()}.tmp.npy"
+        np.save(tmp_array, rows)
+        os.replace(tmp_index, self.index_file)
+        os.replace(tmp_array, self.array_file)
+
+        # Written last, an interrupted build is never taken for a current index
+        tmp_identity = f"{self.identity_file}.{os.getpid()}.tmp"
+        with open(tmp_identity, "w") as f:
+            f.write(identity + "\n")
+        os.replace(tmp_identity, self.identity_file)
+
+    def _find(self, name):
+        key = np.uint64(name_hash(name))
+        row = int(np.searchsorted(self.rows['hash'], key))
+        if row < len(self.rows) and self.rows['hash'][row] == key:
+            return row
+        return None
+
+    def fetch(self, handle, row):
+        """Read the sequence of an index row from an open binary handle of the FASTA file."""
+        length, offset, line_bases, line_width = (int(value) for value in self.rows[['length', 'offset', 'line_bases', 'line_width']][row])
+        if length == 0:
+            return ""
+        full_lines = (length - 1) // line_bases
+        handle.seek(offset)
+        data = handle.read(length + full_lines * (line_width - line_bases))
+        return data.replace(b'\n', b'').replace(b'\r', b'').decode()
+
+    def extract(self, names, output_file, min_length=0):
+        """Write the records with the given names to a FASTA file.
+
+        Records are read in file order by seeking straight to their offsets, so the cost scales
+        with the number of records written and not with the size of the indexed file.
+
+        Args:
+            names (iterable): Names of the records to extract, unknown names are ignored.
+            output_file (str): Path to the FASTA file to write.
+            min_length (int, optional): Only records longer than this are written. Defaults to 0.
+
+        Returns:
+            int: The number of records written.
+        """
+        found = []
+        for name in set(names):
+            row = self._find(name)
+            if row is not None and self.rows['length'][row] > min_length:
+                found.append((int(self.rows['offset'][row]), name, row))
+        found.sort()
+
+        with open(self.fasta_file, 'rb') as fasta, open(output_file, 'w') as output:
+            for _, name, row in found:
+                output.write(">" + name + "\n" + self.fetch(fasta, row) + "\n")
+        return len(found)
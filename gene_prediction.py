@@ -0,0 +1,169 @@
+import io
+import re
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from chunked_prodigal import SEQNUM
+
+try:
+    import pyrodigal
+except ImportError:
+    pyrodigal = None
+
+# Bases of contigs predicted per task, small contigs are grouped so every task is worth a thread
+TASK_BASES = 1 << 20
+
+# Gene prediction backends of run_prodigal, auto uses pyrodigal when it is installed
+BACKENDS = ("auto", "prodigal", "pyrodigal")
+
+# The ID of a gene, <seqnum>_<gene> in the FASTA headers of pyrodigal but <contig>_<gene> in its GFF
+GENE_ID = re.compile(r"ID=[^;\s]*_(\d+);")
+
+
+def is_available():
+    return pyrodigal is not None
+
+
+def use_pyrodigal(backend):
+    """Decide whether genes are predicted in process.
+
+    Args:
+        backend (str): One of BACKENDS.
+
+    Returns:
+        bool: True for the pyrodigal backend, or for auto when pyrodigal is installed.
+    """
+    if backend == "pyrodigal" and not is_available():
+        raise ValueError("ERROR: The pyrodigal gene finder needs the pyrodigal package, install it with 'pip install pyrodigal'")
+    return backend == "pyrodigal" or (backend == "auto" and is_available())
+
+
+@lru_cache(maxsize=None)
+def gene_finder():
+    # The metagenomic models of prodigal -p meta, set up once per process; find_genes is thread-safe and releases the GIL
+    return pyrodigal.GeneFinder(meta=True)
+
+
+def read_contigs(contigs):
+    # Yields the name, the first word of the header like Prodigal uses it, and the sequence of every contig
+    name, parts = None, []
+    with open(contigs, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                if name is not None:
+                    yield name, b"".join(parts)
+                fields = line[1:].split(None, 1)
+                name, parts = fields[0].decode() if fields else "", []
+            else:
+                parts.append(line.strip())
+    if name is not None:
+        yield name, b"".join(parts)
+
+
+def contig_groups(contigs, task_bases=TASK_BASES):
+    # Consecutive contigs with about task_bases bases together, in file order
+    group, bases = [], 0
+    for name, sequence in contigs:
+        group.append((name, sequence))
+        bases += len(sequence)
+        if bases >= task_bases:
+            yield group
+            group, bases = [], 0
+    if group:
+        yield group
+
+
+def predict_group(group):
+    finder = gene_finder()
+    return [(name, finder.find_genes(sequence)) for name, sequence in group]
+
+
+def predict_genes(contigs, threads=1):
+    """Predict the genes of all contigs on a thread pool, in file order.
+
+    At most two groups of contigs per thread are in flight, so the contigs are never all in memory.
+
+    Args:
+        contigs (str): Path to the contigs FASTA file.
+        threads (int, optional): The prediction threads. Defaults to 1.
+
+    Yields:
+        tuple: The name of a contig and its pyrodigal Genes.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        pending = deque()
+        for group in contig_groups(read_contigs(contigs)):
+            pending.append(executor.submit(predict_group, group))
+            if len(pending) >= 2 * threads:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def renumber(text, seqnum):
+    # Prodigal names every gene ID=<seqnum>_<gene> with the sequences numbered in file order, pyrodigal
+    # counts them per gene finder in the order the threads reach them and uses the contig name in its GFF
+    text = GENE_ID.sub(lambda match: f"ID={seqnum}_{match.group(1)};", text)
+    return SEQNUM.sub(f"seqnum={seqnum}", text)
+
+
+def protein_description(seqnum, gene_number, gene):
+    # The header fields Prodigal writes after the name of a protein
+    return (f"# {gene.begin} # {gene.end} # {gene.strand} # ID={seqnum}_{gene_number};"
+            f"partial={int(gene.partial_begin)}{int(gene.partial_end)};start_type={gene.start_type};"
+            f"rbs_motif={gene.rbs_motif};rbs_spacer={gene.rbs_spacer};gc_cont={gene.gc_cont:.3f}")
+
+
+def predict_proteins(contigs, outputs=None, threads=1):
+    """Predict the genes of the contigs in process and yield their proteins.
+
+    Gene names are <contig>_<gene number> like those of Prodigal. Only the given outputs are
+    written, in the formats of prodigal -a, -d and -f gff, while the proteins are yielded.
+
+    Args:
+        contigs (str): Path to the contigs FASTA file.
+        outputs (dict, optional): The .faa, .ffn and .gff file to write by extension. Defaults to None.
+        threads (int, optional): The prediction threads. Defaults to 1.
+
+    Yields:
+        tuple: The name, the Prodigal header description and the protein sequence of every gene.
+    """
+    outputs = outputs or {}
+    files = {ext: open(path, "w") for ext, path in outputs.items()}
+    try:
+        n_genes = 0
+        for seqnum, (name, genes) in enumerate(predict_genes(contigs, threads), 1):
+            for ext, write in ((".gff", genes.write_gff), (".faa", genes.write_translations), (".ffn", genes.write_genes)):
+                if ext in files:
+                    text = io.StringIO()
+                    write(text, sequence_id=name)
+                    text = renumber(text.getvalue(), seqnum)
+                    if ext == ".gff" and seqnum > 1:
+                        # Like Prodigal, the version line opens the file only once
+                        text = text.split("\n", 1)[1]
+                    files[ext].write(text)
+
+            for gene_number, gene in enumerate(genes, 1):
+                yield f"{name}_{gene_number}", protein_description(seqnum, gene_number, gene), gene.translate()
+            n_genes += len(genes)
+        logging.info(f"pyrodigal predicted {n_genes} genes in {contigs}")
+    finally:
+        for f in files.values():
+            f.close()
+
+
+def write_gene_files(contigs, outputs, threads=1):
+    """Predict the genes of the contigs in process and write the files Prodigal writes.
+
+    Args:
+        contigs (str): Path to the contigs FASTA file.
+        outputs (dict): The .faa, .ffn and .gff file to write by extension.
+        threads (int, optional): The prediction threads. Defaults to 1.
+
+    Returns:
+        bool: True when the files were written.
+    """
+    for _ in predict_proteins(contigs, outputs, threads):
+        pass
+    return True
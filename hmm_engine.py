@@ -0,0 +1,177 @@
+import os
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+try:
+    import pyhmmer
+    from pyhmmer.easel import Alphabet, DigitalSequenceBlock, SequenceFile, TextSequence, TextSequenceBlock
+    from pyhmmer.plan7 import HMMFile, Pipeline
+except ImportError:
+    pyhmmer = None
+
+# Proteins searched per task, a batch is searched for all plastics before it is released
+BATCH_SIZE = 20000
+
+# Search engines of run_hmmer, auto uses pyhmmer when it is installed
+ENGINES = ("auto", "hmmsearch", "pyhmmer")
+
+
+def is_available():
+    return pyhmmer is not None
+
+
+def use_pyhmmer(engine):
+    """Decide whether the HMM search runs in process.
+
+    Args:
+        engine (str): One of ENGINES.
+
+    Returns:
+        bool: True for the pyhmmer engine, or for auto when pyhmmer is installed.
+    """
+    if engine == "pyhmmer" and not is_available():
+        raise ValueError("ERROR: The pyhmmer search engine needs the pyhmmer package, install it with 'pip install pyhmmer'")
+    return engine == "pyhmmer" or (engine == "auto" and is_available())
+
+
+@lru_cache(maxsize=None)
+def load_profile(hmm_file):
+    # The profile of a motif file, read once per process and shared by all searches
+    with HMMFile(hmm_file) as f:
+        return f.read()
+
+
+def search_batch(profiles, thresholds, proteins):
+    """Search one batch of proteins for every plastic.
+
+    Every task gets its own pipelines, they are not thread-safe, and the reporting threshold of a
+    plastic is its bitscore, like hmmsearch -T.
+
+    Args:
+        profiles (dict): The profile of every plastic.
+        thresholds (dict): The bitscore threshold of every plastic.
+        proteins (pyhmmer.easel.TextSequenceBlock): The proteins of the batch.
+
+    Returns:
+        tuple: The TopHits of every plastic and the (name, sequence) of every hit protein, in file order.
+    """
+    digital = proteins.digitize(Alphabet.amino())
+    top_hits = {}
+    hit_names = set()
+    for plastic_name, profile in profiles.items():
+        pipeline = Pipeline(Alphabet.amino(), T=thresholds[plastic_name])
+        top_hits[plastic_name] = pipeline.search_hmm(profile, digital)
+        hit_names.update(hit.name for hit in top_hits[plastic_name])
+    hit_sequences = [(protein.name, protein.sequence) for protein in proteins if protein.name in hit_names]
+    return top_hits, hit_sequences
+
+
+def protein_batches(aa_file, batch_size=BATCH_SIZE):
+    # The proteins of a FASTA file in blocks of batch_size, read as text so hits keep their residues as written
+    with SequenceFile(aa_file, format="fasta", digital=False) as f:
+        while True:
+            block = f.read_block(sequences=batch_size)
+            if not len(block):
+                break
+            yield block
+
+
+def protein_blocks(proteins, batch_size=BATCH_SIZE):
+    # Group (name, description, sequence) proteins predicted in memory into blocks of batch_size
+    block = TextSequenceBlock()
+    for name, description, sequence in proteins:
+        block.append(TextSequence(name=name, description=description, sequence=sequence))
+        if len(block) == batch_size:
+            yield block
+            block = TextSequenceBlock()
+    if len(block):
+        yield block
+
+
+def search(profiles, thresholds, batches, threads=1):
+    """Search batches of proteins for all plastics on a thread pool.
+
+    pyhmmer releases the GIL during the search, so the batches are searched in parallel. At most
+    two batches per thread are in memory, the hits of every batch are merged in order.
+
+    Args:
+        profiles (dict): The profile of every plastic.
+        thresholds (dict): The bitscore threshold of every plastic.
+        batches (iterable): Blocks of proteins, e.g. from protein_batches.
+        threads (int, optional): The search threads. Defaults to 1.
+
+    Returns:
+        dict: The merged TopHits and the (name, sequence) of every hit protein of every plastic.
+    """
+    top_hits = {plastic_name: [] for plastic_name in profiles}
+    hit_sequences = []
+
+    def collect(result):
+        batch_hits, batch_sequences = result
+        for plastic_name, hits in batch_hits.items():
+            top_hits[plastic_name].append(hits)
+        hit_sequences.extend(batch_sequences)
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append(executor.submit(search_batch, profiles, thresholds, batch))
+            if len(pending) >= 2 * threads:
+                collect(pending.popleft().result())
+        while pending:
+            collect(pending.popleft().result())
+
+    results = {}
+    for plastic_name, hits in top_hits.items():
+        # Merging sums the number of searched proteins, so E-values are those of one search over all proteins
+        merged = hits[0].merge(*hits[1:]) if hits else Pipeline(Alphabet.amino()).search_hmm(profiles[plastic_name], DigitalSequenceBlock(Alphabet.amino()))
+        names = {hit.name for hit in merged}
+        results[plastic_name] = (merged, [(name, sequence) for name, sequence in hit_sequences if name in names])
+    return results
+
+
+def write_tblout(top_hits, hmm_output):
+    # The hits in the --tblout format of hmmsearch
+    with open(hmm_output, "wb") as f:
+        top_hits.write(f, format="targets", header=True)
+
+
+def write_hits(hit_sequences, output, min_length=10):
+    # The hit proteins longer than min_length, written like FastaIndex.extract
+    with open(output, "w") as f:
+        for name, sequence in hit_sequences:
+            if len(sequence) > min_length:
+                f.write(">" + name + "\n" + sequence + "\n")
+
+
+def run_search(p, thresholds, batches, output_dir, contigs_base, threads=1):
+    """Search the proteins of a run for the given plastics in process, passing over the proteins once.
+
+    The outputs are the files hmmsearch and extract_hits write: for every plastic the tblout
+    temps/<plastic>/<contigs>_<plastic>_HMMER.out and the hit proteins
+    temps/<plastic>/<contigs>_<plastic>_hmm_output.fasta, both written from the hits in memory.
+
+    Args:
+        p (PathManager): The path manager of the current run.
+        thresholds (dict): The bitscore threshold of every plastic to search for.
+        batches (iterable): Blocks of proteins, from protein_batches or protein_blocks.
+        output_dir (str): The folder holding the folder of every plastic.
+        contigs_base (str): The base name of the outputs.
+        threads (int, optional): The search threads. Defaults to 1.
+
+    Returns:
+        dict: The merged TopHits of every plastic.
+    """
+    profiles = {plastic_name: load_profile(os.path.join(p.motif, f"{plastic_name}.hmm")) for plastic_name in thresholds}
+    results = search(profiles, thresholds, batches, threads)
+
+    hits = {}
+    for plastic_name, (top_hits, hit_sequences) in results.items():
+        temp_dir = os.path.join(output_dir, plastic_name)
+        write_tblout(top_hits, os.path.join(temp_dir, f"{contigs_base}_{plastic_name}_HMMER.out"))
+        write_hits(hit_sequences, os.path.join(temp_dir, f"{contigs_base}_{plastic_name}_hmm_output.fasta"))
+        logging.info(f"pyhmmer found {len(top_hits)} {plastic_name} hits.")
+        hits[plastic_name] = top_hits
+    return hits
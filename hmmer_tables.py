@@ -0,0 +1,100 @@
+import gc
+import numpy as np
+import pandas as pd
+
+# Columns of a hmmsearch/hmmscan --tblout table, the description may contain spaces
+TBLOUT_COLUMNS = ["target_name", "target_accession", "query_name", "query_accession",
+                  "E_value", "score", "bias", "domain_E_value", "domain_score", "domain_bias",
+                  "exp", "reg", "clu", "ov", "env", "dom", "rep", "inc", "description"]
+
+# Columns of a --domtblout table
+DOMTBLOUT_COLUMNS = ["target_name", "target_accession", "target_length", "query_name", "query_accession", "query_length",
+                     "E_value", "score", "bias", "domain_number", "domain_count", "c_E_value", "i_E_value",
+                     "domain_score", "domain_bias", "hmm_from", "hmm_to", "ali_from", "ali_to", "env_from", "env_to",
+                     "acc", "description"]
+
+FLOAT_COLUMNS = {"E_value", "score", "bias", "domain_E_value", "domain_score", "domain_bias", "exp",
+                 "c_E_value", "i_E_value", "acc"}
+INT_COLUMNS = {"reg", "clu", "ov", "env", "dom", "rep", "inc", "target_length", "query_length", "domain_number",
+               "domain_count", "hmm_from", "hmm_to", "ali_from", "ali_to", "env_from", "env_to"}
+
+
+def data_lines(path):
+    # The rows of a HMMER table, without the comment header and footer
+    with open(path) as f:
+        return [line for line in f if line[0] != "#" and not line.isspace()]
+
+
+def read_target_names(path):
+    """Read the target names of a tblout or domtblout table, the hit proteins of a hmmsearch.
+
+    Returns:
+        set: The target names.
+    """
+    return {line.split(None, 1)[0] for line in data_lines(path)}
+
+
+def gene_contig(gene_id):
+    # The contig of a Prodigal gene ID <contig>_<gene number>, contig names may contain '_' themselves
+    return gene_id.rpartition("_")[0]
+
+
+def gene_contigs(target_names):
+    """Derive the contig of every Prodigal gene with gene_contig.
+
+    Args:
+        target_names (array-like): The gene IDs.
+
+    Returns:
+        numpy.ndarray: The contig IDs.
+    """
+    # A plain loop over str.rpartition is several times faster than the numpy.char and pandas .str equivalents
+    return np.array([gene_contig(name) for name in target_names], dtype=object)
+
+
+def read_tblout(path, domains=False):
+    """Read a HMMER tblout or domtblout table into typed columns in a single pass.
+
+    Every row is split once into its fixed fields and the description, the rows form one object
+    array whose numeric columns are each converted by a single NumPy call. The contig of every
+    target gene is added as the 'contig' column.
+
+    Args:
+        path (str): Path to the table.
+        domains (bool, optional): If True, read a --domtblout table. Defaults to False, a --tblout table.
+
+    Returns:
+        pandas.DataFrame: One row per hit with the TBLOUT_COLUMNS or DOMTBLOUT_COLUMNS and 'contig'.
+    """
+    columns = DOMTBLOUT_COLUMNS if domains else TBLOUT_COLUMNS
+    n_fields = len(columns) - 1
+
+    # Millions of small row lists would trigger the cyclic garbage collector over and over
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        rows = [line.split(None, n_fields) for line in data_lines(path)]
+        for row in rows:
+            if len(row) <= n_fields:
+                # A row without a description
+                row.extend([""] * (n_fields + 1 - len(row)))
+        values = np.array(rows, dtype=object) if rows else np.empty((0, len(columns)), dtype=object)
+        del rows
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    data = {}
+    for i, name in enumerate(columns):
+        if name in FLOAT_COLUMNS:
+            data[name] = values[:, i].astype(np.float64)
+        elif name in INT_COLUMNS:
+            data[name] = values[:, i].astype(np.int64)
+        elif name == "description":
+            data[name] = np.array([description.rstrip() for description in values[:, i]], dtype=object)
+        else:
+            data[name] = values[:, i]
+
+    table = pd.DataFrame(data, columns=columns)
+    table["contig"] = gene_contigs(data["target_name"])
+    return table
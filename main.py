@@ -1,6 +1,7 @@
 import flet as ft
 from args import Args
 import PlasticTools
+import batch
 import io
 import sys
 import traceback
@@ -161,8 +162,13 @@ class GUI:
             # Add progress ring to the page
             self.page.add(self.progress_ring)
 
-            # Run the main function
-            PlasticTools.main(args)
+            # Several contigs files run as a batch with one output folder per contigs file
+            contigs_files = args.contigs.split(',')
+            if len(contigs_files) > 1:
+                batch.run_batch(args, batch.samples_from_files(contigs_files, args.mappings.split(',')), PlasticTools.main)
+            else:
+                # Run the main function
+                PlasticTools.main(args)
 
             # Remove progress ring from the page
             self.page.remove(self.progress_ring)
@@ -55,7 +55,7 @@ def create_fig(df):
     return fig
 
 
-def create_html(p):
+def read_sample_tsvs(p):
     # Create an empty list to store all the dataframes
     combined_dfs = []
 
@@ -65,15 +65,25 @@ def create_html(p):
 
             # Read the TSV file
             df = pd.read_csv(os.path.join(p.temps, filename), sep='\t')
-            # Scale the values logarithmically
-            df['log reads mapped'] = df['reads mapped'].apply(lambda x: np.log(x) if x != 0 else 0)
             df['sample'] = name
 
             # Append the current dataframe to the list of dataframes
             combined_dfs.append(df)
 
     # Concatenate all the dataframes in the list into a single dataframe
-    combined_df = pd.concat(combined_dfs)
+    return pd.concat(combined_dfs)
+
+
+def create_html(p, table=None):
+    # Use the abundance table of the run, only read the sample TSV files back when it is not given
+    combined_df = read_sample_tsvs(p) if table is None else table.copy()
+    write_html(combined_df, os.path.join(p.output, 'abundances.html'))
+
+
+def write_html(combined_df, html_file):
+
+    # Scale the values logarithmically
+    combined_df['log reads mapped'] = combined_df['reads mapped'].apply(lambda x: np.log(x) if x != 0 else 0)
 
     fig = create_fig(combined_df)
 
@@ -96,7 +106,6 @@ def create_html(p):
     """
 
     # Save the HTML content to a file
-    html_file = os.path.join(p.output, 'abundances.html')
     with open(html_file, 'w') as f:
         f.write(html_content)
         
@@ -117,7 +126,7 @@ def remove_temps(p, debug=False):
     # Move tsv and fasta files from p.temps to p.output
     move_files(['.tsv', '.fasta'], p.temps, p.output)
 
-    # Delete p.temps folder
-    if not debug:
+    # Delete p.temps folder, unless it is kept to resume later runs from its checkpoints
+    if not debug and not p.keep_temps:
         shutil.rmtree(p.temps)
 
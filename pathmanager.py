@@ -2,6 +2,12 @@ import os
 import sys
 import utilities
 import logging
+from functools import lru_cache
+from checkpoint import Checkpoints
+from scheduler import CoreScheduler
+import translation_cache
+import hmm_engine
+import gene_prediction
 
 def check_directory_exists(directory):
     """Check if a directory exists, create it if it doesn't.
@@ -32,13 +38,14 @@ def check_file_exists(file):
         raise FileNotFoundError(f"File {file} does not exist.")
     return file
 
-def check_files_and_folders(output, contigs, mappings):
+def check_files_and_folders(output, contigs, mappings, counts_tables=None):
     """Check if the necessary files and folders exist.
 
     Args:
         output (str): Path to the output directory.
         contigs (str): Path to the contigs file.
-        mappings (str): Comma-separated string of paths to the mapping files.
+        mappings (str): Comma-separated string of paths to the mapping files, None with count tables.
+        counts_tables (str, optional): Comma-separated string of paths to count tables. Defaults to None.
 
     Returns:
         str: Path to the temporary folder.
@@ -53,10 +60,10 @@ def check_files_and_folders(output, contigs, mappings):
     # Check if contigs file exists
     contigs = check_file_exists(contigs)
     
-    # Check if bam/sam files exist
-    mapping_files = mappings.split(',') if ',' in mappings else [mappings]
-    for mapping_file in mapping_files:
-        check_file_exists(mapping_file.strip())
+    # Check if bam/sam files and count tables exist
+    for files in (mappings, counts_tables):
+        for file in (files.split(',') if files else []):
+            check_file_exists(file.strip())
 
     # If all checks passed
     return temps_folder
@@ -74,8 +81,9 @@ def check_arg(arg, arg_name):
         logging.error(error)
         sys.exit(1)
 
+@lru_cache(maxsize=None)
 def fetch_motifs():
-    """Fetch the hmm motifs.
+    """Fetch the hmm motifs, once per process so batch runs share them.
 
     Returns:
         tuple: A tuple containing the path to the motif directory and the bitscores file.
@@ -88,6 +96,11 @@ def fetch_motifs():
     
     return motif_dir, bitscores_file
 
+@lru_cache(maxsize=None)
+def list_plastics(motif_dir):
+    # The plastics with a motif in the motif directory
+    return tuple(os.path.splitext(file)[0] for file in os.listdir(motif_dir) if file.endswith('.hmm'))
+
 def set_cores(cores=2, max_cores=True):
     """Set the number of cores to use.
 
@@ -101,20 +114,53 @@ def set_cores(cores=2, max_cores=True):
         utilities.set_cores(cores)
 
 
+def build_scheduler(args):
+    """Create the core and memory budget of a run from the --threads, --p and --max_memory arguments.
+
+    Args:
+        args (argparse.Namespace): The parsed command-line arguments.
+
+    Returns:
+        CoreScheduler: The budget, a single core without multiprocessing unless --threads is given.
+    """
+    threads = args.threads if hasattr(args, 'threads') else None
+    multiprocessing = args.p if hasattr(args, 'p') else True
+    max_memory = args.max_memory if hasattr(args, 'max_memory') else None
+    return CoreScheduler(threads if threads or multiprocessing else 1, int(max_memory * 1024 ** 3) if max_memory else None)
+
+
 class PathManager:
     """Class to manage the paths used in the program.
 
     Args:
         args (argparse.Namespace): The parsed command-line arguments.
+        scheduler (CoreScheduler, optional): A core budget shared with other runs, e.g. the other
+            samples of a batch. Defaults to None, the run gets its own budget then.
     """
-    def __init__(self, args):
+    def __init__(self, args, scheduler=None):
         self._args = args
-        self._temps = check_files_and_folders(args.output, args.contigs, args.mappings)
+        self._temps = check_files_and_folders(args.output, args.contigs, args.mappings, getattr(args, 'counts_table', None))
         self._motif, self._bitscores = fetch_motifs()
-        self._all_plastics = [os.path.splitext(file)[0] for file in os.listdir(self.motif) if file.endswith('.hmm')]
+        self._all_plastics = list(list_plastics(self.motif))
+        
+        self._checkpoints = Checkpoints(self._temps, force=self.force_overwrite)
         
-        utilities.check_dependencies()
-        set_cores(max_cores=self.multiprocessing)
+        # --stream runs the prodigal and hmmsearch binaries on every chunk, --combined searches with hmmscan
+        if self.streaming and (self.gene_finder == "pyrodigal" or self.hmm_engine == "pyhmmer"):
+            raise ValueError("ERROR: --stream runs the prodigal and hmmsearch binaries, it cannot be combined with --gene_finder pyrodigal or --hmm_engine pyhmmer")
+        if self.combined_search and self.hmm_engine == "pyhmmer":
+            raise ValueError("ERROR: --combined searches with hmmscan, it cannot be combined with --hmm_engine pyhmmer")
+
+        # The in-process search and gene prediction do not need the hmmsearch and prodigal binaries
+        skip = ("hmmsearch",) if self.use_pyhmmer else ()
+        skip += ("prodigal",) if self.use_pyrodigal else ()
+        # Count tables replace counting the mapping files, featureCounts never runs then
+        skip += ("featureCounts",) if self.counts_tables else ()
+        utilities.check_dependencies(skip=skip)
+
+        # One core and memory budget for every external tool, single core without multiprocessing unless --threads is given
+        self._scheduler = scheduler if scheduler is not None else build_scheduler(args)
+        set_cores(self._scheduler.total, max_cores=False)
         
     @property
     def output(self):
@@ -164,4 +210,87 @@ class PathManager:
     @property
     def force_overwrite(self):
         return self._args.f if hasattr(self._args, 'f') else True
-    
\ No newline at end of file
+
+    @property
+    def keep_temps(self):
+        return self._args.k if hasattr(self._args, 'k') else False
+
+    @property
+    def cache_size(self):
+        return translation_cache.get_cache_size(getattr(self._args, 'cache_size', None))
+
+    @property
+    def checkpoints(self):
+        return self._checkpoints
+
+    @property
+    def combined_search(self):
+        return self._args.combined if hasattr(self._args, 'combined') else False
+
+    @property
+    def combined_counts(self):
+        return self._args.combined_counts if hasattr(self._args, 'combined_counts') else False
+    
+
+    @property
+    def streaming(self):
+        return self._args.stream if hasattr(self._args, 'stream') else False
+
+    @property
+    def threads(self):
+        return self._args.threads if hasattr(self._args, 'threads') else None
+
+    @property
+    def scheduler(self):
+        return self._scheduler
+
+    @property
+    def max_memory(self):
+        # The --max_memory cap in bytes, given in GB
+        max_memory = self._args.max_memory if hasattr(self._args, 'max_memory') else None
+        return int(max_memory * 1024 ** 3) if max_memory else None
+
+    @property
+    def blast_db(self):
+        return self._args.blast_db if hasattr(self._args, 'blast_db') else None
+
+    @property
+    def counts_tables(self):
+        # The --counts_table files, read instead of the mapping files
+        counts_table = self._args.counts_table if hasattr(self._args, 'counts_table') else None
+        return [file.strip() for file in counts_table.split(',') if file.strip()] if counts_table else None
+
+    @property
+    def hmm_engine(self):
+        # hmmsearch runs the HMMER binary, pyhmmer searches in process, auto uses pyhmmer when it is installed
+        return self._args.hmm_engine if hasattr(self._args, 'hmm_engine') and self._args.hmm_engine else "auto"
+
+    @property
+    def gene_finder(self):
+        # prodigal runs the Prodigal binary, pyrodigal predicts in process, auto uses pyrodigal when it is installed
+        return self._args.gene_finder if hasattr(self._args, 'gene_finder') and self._args.gene_finder else "auto"
+
+    @property
+    def write_genes(self):
+        # Write the .faa and .ffn files also when the proteins are only searched in memory
+        return self._args.write_genes if hasattr(self._args, 'write_genes') else False
+
+    @property
+    def use_pyrodigal(self):
+        # auto only picks pyrodigal when no flag asks for the prodigal binary, like --stream does
+        return not self.streaming and gene_prediction.use_pyrodigal(self.gene_finder)
+
+    @property
+    def use_pyhmmer(self):
+        # auto only picks pyhmmer when no flag asks for the HMMER binaries, like --stream and --combined do
+        return not (self.streaming or self.combined_search) and hmm_engine.use_pyhmmer(self.hmm_engine)
+
+    @property
+    def in_process_search(self):
+        # Genes predicted with pyrodigal stream straight into the pyhmmer search
+        return self.use_pyrodigal and self.use_pyhmmer
+
+    @property
+    def counter(self):
+        # featurecounts runs featureCounts on every read, regions reads only the hit genes of indexed BAM files
+        return self._args.counter if hasattr(self._args, 'counter') and self._args.counter else "featurecounts"
@@ -10,18 +10,19 @@ Input:
     A sorted and indexed BAM file
 
 Requires:
-    Samtools
+    A .bai or .csi index next to every BAM file
 
 """
 import os
 import pandas as pd
 import sys
 from utilities import check_dependencies
-import threading
-import subprocess
-import time
+from bam_index import index_stats_all, idxstats_table
+from hmmer_tables import read_tblout
+from counts_tables import read_counts_tables, tables_counts
 import glob
 import numpy as np
+from scipy import sparse
 import logging
 
 error2="""
@@ -45,107 +46,136 @@ def check_args(args):
 
 def quantify_hmm(p):
 
-# Load the read_counts table and sum the second column
-    if p.gene_counts_file is None and p.bams:
-        bam_dir = p.bams
-        bam_files = [os.path.join(bam_dir, bam_file) for bam_file in os.listdir(bam_dir) if bam_file.endswith('.bam')]
-    
-        gene_counts_file = []
-    
-        for bam_file in bam_files:
-            samtools_command = f"samtools idxstats {bam_file}"
-            base = os.path.basename(bam_file).split(".")[0]
-            log_file = os.path.abspath(os.path.join(p.temps, f"{base}_samtools.log"))
-            samtools_output = os.path.abspath(os.path.join(p.temps, f"{base}_samtools_output.tsv"))
-    
-            with open(log_file, 'w') as f_err, open(samtools_output, 'w') as f_out:
-                process = subprocess.Popen(samtools_command, shell=True, stdout=f_out, stderr=f_err)
-
-            while process.poll() is None:
-                time.sleep(0.1)
-
-    
-            logging.info("\nsamtools finished running. Logs saved to {}".format(log_file))
-    
-            if not os.path.exists(samtools_output) or os.stat(samtools_output).st_size == 0:
-                print(f"SAMTOOLS FAILED FOR {base} file: For more information check samtools log at: {log_file}")
-            else:
-                gene_counts_file.append(samtools_output)
-                
-    elif p.gene_counts_file and p.bams is None:
-        gene_counts_file = p.gene_counts_file
-
-    # Initialize an empty list to store abundance data for each file
-
-    abundance_data = []    
-    hmmer_output_file = [os.path.join(p.temps, file) for file in os.listdir(p.temps) if file.endswith("_HMMER.out")]
+    # The hit genes of every plastic, one HMMER output per plastic
+    hmmer_outputs = find_hmmer_outputs(p.temps)
 
-    if not hmmer_output_file:
+    if not hmmer_outputs:
         print(error2)
         print("\nError: No hmm output file found in the temporary folder. Make sure to run translate_search() before quantify_enzymes().")
         sys.exit(1)
 
-    for hmm_file in hmmer_output_file:
-        enzyme = os.path.basename(hmm_file).split('_')[0]
-        # Load the hmmsearch output table and transform it into pandas
-        with open(hmm_file) as f:
-            lines = f.readlines()
-            # Remove lines that start with '#' or are empty
-            rows = [line.split() for line in lines if not line.startswith('#') and line.strip()]
-            df = pd.DataFrame(rows)
-        
-            # Remove columns that contain only '#'
-            df = df.loc[:, ~df.eq('#').all()]
-            df = df.iloc[:, :10]  # subset first 10 columns
-            df.columns = ['#target_name', 'target_accession', 'query_name', 'query_accession', 'E_value', 'score', 'bias', 'exp', 'reg', 'clu']  # column names
-            # convert numerical columns to numeric types
-            numeric_cols = ['E_value', 'score', 'bias', 'exp', 'reg', 'clu']
-            df[numeric_cols] = df[numeric_cols].apply(pd.to_numeric)  # convert numerical columns to numeric types
-            df['contig'] = df['#target_name'].apply(lambda x: '_'.join(x.split('_')[:2]))  # extract contig information
-        
-            final_abundance = 0
-            total_num_reads = 0
-            
-            for count_file in gene_counts_file:
-                read_counts_table = pd.read_csv(count_file, sep='\t', header=None, names=['contig', 'length', 'num_reads', 'unmapped_reads'])
-                total_num_reads = read_counts_table['num_reads'].sum()
-                merged_table = pd.merge(df, read_counts_table, on='contig')
-                merged_table['rpkm'] = (1e9 * merged_table['num_reads']) / (total_num_reads * merged_table['length'])
-                final_abundance = merged_table['rpkm'].sum()
-            
-                # Perform Z-standardization
-                mean_rpkm = merged_table['rpkm'].mean()
-                std_rpkm = merged_table['rpkm'].std()
-                merged_table['z-standarize'] = (merged_table['rpkm'] - mean_rpkm) / std_rpkm
-            
-                # Calculate average bit-score, std and sem
-                if len(df) > 1:
-                    bit_stats = {
-                        'score_std': df['score'].std(),
-                        'score_sem': df['score'].sem(),
-                    }
-                else:
-                    bit_stats = {
-                        'score_std': "NA",
-                        'score_sem': "NA",
-                    }
-            
-                # Append final abundance, average bit score, bit statistics, and enzyme for each file to the list
-                abundance_data.append([os.path.basename(count_file), final_abundance, df['score'].mean(), bit_stats, enzyme])
-
-            # Convert the abundance_data list to a DataFrame
-            abundance_df = pd.DataFrame(abundance_data, columns=['Sample', 'Average abundance (average RPKM)', 'Average_bit_score', 'Bit_stats', 'Enzyme substrate'])
-
-            # Specify the output directory
-            output_directory = os.path.join(p.output, 'output')
-            
-            # Create the output directory if it does not exist
-            os.makedirs(output_directory, exist_ok=True)
-            
-            # Write the DataFrame to a .csv file in the output directory
-            output_file = os.path.join(output_directory, 'abundance_output.csv')
-            abundance_df.to_csv(output_file, index=False)
-
+    hits = {enzyme: read_tblout(hmm_file) for enzyme, hmm_file in hmmer_outputs.items()}
+    contigs = hit_contigs(hits)
+    threads = p.scheduler.total if hasattr(p, 'scheduler') else None
 
+# Load the read counts of the hit contigs and the library size of every sample
+    if p.gene_counts_file is None and p.bams:
+        bam_dir = p.bams
+        bam_files = [os.path.join(bam_dir, bam_file) for bam_file in os.listdir(bam_dir) if bam_file.endswith('.bam')]
 
+        # The read counts of every contig come from the BAM indexes, all BAM files are read in parallel
+        idxstats_tables = {}
+        for bam_file, stats in zip(bam_files, index_stats_all(bam_files, threads)):
+            idxstats_tables[os.path.basename(bam_file)] = idxstats_table(stats)
+        counts = tables_counts(contigs, idxstats_tables)
+        logging.info(f"Read counts of {len(bam_files)} BAM files taken from their indexes.")
 
+    elif p.gene_counts_file and p.bams is None:
+        # Count tables are read in chunks, keeping only the rows of the hit contigs
+        counts = read_counts_tables(list(p.gene_counts_file), contigs, threads=threads)
+
+    abundance_df, gene_df = abundance_table(hits, contigs, counts)
+
+    # Specify the output directory
+    output_directory = os.path.join(p.output, 'output')
+
+    # Create the output directory if it does not exist
+    os.makedirs(output_directory, exist_ok=True)
+
+    # Write the DataFrame to a .csv file in the output directory
+    output_file = os.path.join(output_directory, 'abundance_output.csv')
+    abundance_df.to_csv(output_file, index=False)
+
+    # The RPKM and z-score of every hit gene, per sample
+    gene_df.to_csv(os.path.join(output_directory, 'gene_abundance.csv'), index=False)
+    logging.info(f"Abundance of {len(hits)} plastics in {len(counts.samples)} samples written to {output_file}")
+
+
+def find_hmmer_outputs(temps):
+    """Find the hmmsearch output of every plastic in the temporary folder.
+
+    translate_search writes temps/<plastic>/<contigs>_<plastic>_HMMER.out, outputs of earlier
+    versions directly in temps are named <plastic>_..._HMMER.out.
+
+    Returns:
+        dict: The path of the output of every plastic.
+    """
+    outputs = {}
+    for hmm_file in sorted(glob.glob(os.path.join(temps, "*", "*_HMMER.out"))):
+        outputs.setdefault(os.path.basename(os.path.dirname(hmm_file)), hmm_file)
+    for hmm_file in sorted(glob.glob(os.path.join(temps, "*_HMMER.out"))):
+        outputs.setdefault(os.path.basename(hmm_file).split('_')[0], hmm_file)
+    return outputs
+
+
+def hit_contigs(hits):
+    # The contigs with hit genes of any plastic, in order of first appearance
+    all_contigs = [df['contig'].to_numpy() for df in hits.values()]
+    return pd.Index(pd.unique(np.concatenate(all_contigs))) if all_contigs else pd.Index([])
+
+
+def abundance_table(hits, contigs, counts):
+    """Compute the abundance of every plastic in every sample from one hit gene x sample matrix.
+
+    The RPKM of a gene in a sample is 1e9 * reads / (library size * contig length), computed for
+    all genes and samples at once by scaling the columns of the reads per base matrix. Only genes
+    whose contig is listed in the count table of a sample take part in its mean and standard
+    deviation, like an inner join of the hits with that table.
+
+    Args:
+        hits (dict): The read_tblout table of every plastic.
+        contigs (pandas.Index): The contigs of hit_contigs.
+        counts (SampleCounts): The read counts of these contigs in every sample.
+
+    Returns:
+        tuple: The abundance of every plastic and sample, the rows of abundance_output.csv, and the
+            RPKM and z-score of every listed hit gene in every sample.
+    """
+    samples = np.array(counts.samples, dtype=object)
+    densities, listed, library_sizes = counts.densities, counts.listed, counts.library_sizes
+
+    abundance_data = []
+    gene_tables = []
+    for enzyme, df in hits.items():
+        genes = contigs.get_indexer(df['contig'])
+        present = listed[genes]
+        n_genes = present.sum(axis=0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Genes x samples RPKM, the columns scaled by the library sizes
+            rpkm = densities[genes] @ sparse.diags(1e9 / library_sizes)
+            final_abundance = np.asarray(rpkm.sum(axis=0)).ravel()
+            squares = np.asarray(rpkm.multiply(rpkm).sum(axis=0)).ravel()
+
+            # Z-standardization per sample, with the sample standard deviation like pandas
+            mean_rpkm = final_abundance / n_genes
+            std_rpkm = np.sqrt(np.maximum(squares - n_genes * mean_rpkm ** 2, 0) / (n_genes - 1))
+            gene_rows, gene_samples = np.nonzero(present)
+            gene_rpkm = np.asarray(rpkm[gene_rows, gene_samples]).ravel()
+            z_scores = (gene_rpkm - mean_rpkm[gene_samples]) / std_rpkm[gene_samples]
+
+        gene_tables.append(pd.DataFrame({'Sample': samples[gene_samples], 'Enzyme substrate': enzyme,
+                                         'Gene': df['target_name'].to_numpy()[gene_rows],
+                                         'Contig': df['contig'].to_numpy()[gene_rows],
+                                         'RPKM': gene_rpkm, 'Z-score': z_scores}))
+
+        # Calculate average bit-score, std and sem, the same for every sample
+        if len(df) > 1:
+            bit_stats = {
+                'score_std': df['score'].std(),
+                'score_sem': df['score'].sem(),
+            }
+        else:
+            bit_stats = {
+                'score_std': "NA",
+                'score_sem': "NA",
+            }
+        average_bit_score = df['score'].mean()
+
+        # Append final abundance, average bit score, bit statistics, and enzyme for each sample to the list
+        for sample, abundance in zip(samples, final_abundance):
+            abundance_data.append([sample, abundance, average_bit_score, bit_stats, enzyme])
+
+    abundance_df = pd.DataFrame(abundance_data, columns=['Sample', 'Average abundance (average RPKM)', 'Average_bit_score', 'Bit_stats', 'Enzyme substrate'])
+    gene_df = pd.concat(gene_tables, ignore_index=True) if gene_tables else pd.DataFrame(columns=['Sample', 'Enzyme substrate', 'Gene', 'Contig', 'RPKM', 'Z-score'])
+    return abundance_df, gene_df
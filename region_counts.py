@@ -0,0 +1,211 @@
+import struct
+import logging
+from bisect import bisect_left
+import numpy as np
+import bam_index
+from bgzf import BgzfReader
+
+# BAM flags of reads featureCounts does not assign by default
+FLAG_UNMAPPED = 0x4
+FLAG_SECONDARY = 0x100
+FLAG_SUPPLEMENTARY = 0x800
+
+# Reads of a contig are looked up per window of nearby genes, genes closer than this share a window
+WINDOW_GAP = 1 << 14
+
+# CIGAR operations that consume the reference; N splits the read into blocks, D does not
+CIGAR_BLOCK = {0, 2, 7, 8}  # M, D, =, X
+CIGAR_SKIP = 3  # N
+
+# Sizes of the fixed size aux field types
+AUX_SIZES = {ord(t): size for t, size in (("A", 1), ("c", 1), ("C", 1), ("s", 2), ("S", 2), ("i", 4), ("I", 4), ("f", 4))}
+AUX_INTEGERS = {ord(t): code for t, code in (("c", "<b"), ("C", "<B"), ("s", "<h"), ("S", "<H"), ("i", "<i"), ("I", "<I"))}
+
+
+def can_count(mapping_file):
+    # Only indexed BAM files can be counted by region, SAM files and unindexed BAM files need featureCounts
+    if not mapping_file.endswith(".bam"):
+        return False
+    try:
+        bam_index.find_index(mapping_file)
+        return True
+    except ValueError:
+        return False
+
+
+def read_saf(saf_path):
+    """Read a SAF file into its features.
+
+    Returns:
+        tuple: The gene IDs in order of first appearance and the (gene index, chr, 0-based start, end) of every feature.
+    """
+    gene_ids, gene_index, features = [], {}, []
+    with open(saf_path) as saf:
+        next(saf, None)
+        for line in saf:
+            if not line.strip():
+                continue
+            gene_id, chr, start, end = line.rstrip("\n").split("\t")[:4]
+            if gene_id not in gene_index:
+                gene_index[gene_id] = len(gene_ids)
+                gene_ids.append(gene_id)
+            features.append((gene_index[gene_id], chr, int(start) - 1, int(end)))
+    return gene_ids, features
+
+
+def gene_lengths(n_genes, features):
+    # Like featureCounts, the length of a gene is the number of bases covered by its features
+    intervals = {}
+    for gene, _, start, end in features:
+        intervals.setdefault(gene, []).append((start, end))
+    lengths = np.zeros(n_genes, dtype=np.int64)
+    for gene, gene_intervals in intervals.items():
+        covered_end = None
+        for start, end in sorted(gene_intervals):
+            if covered_end is not None and start < covered_end:
+                start = covered_end
+            if end > start:
+                lengths[gene] += end - start
+            covered_end = end if covered_end is None else max(covered_end, end)
+    return lengths
+
+
+def nh_tag(aux):
+    # The value of the NH tag in the aux fields of a record, None without one
+    position, size = 0, len(aux)
+    while position + 3 <= size:
+        tag, value_type = aux[position:position + 2], aux[position + 2]
+        position += 3
+        if tag == b"NH" and value_type in AUX_INTEGERS:
+            return struct.unpack_from(AUX_INTEGERS[value_type], aux, position)[0]
+        if value_type in AUX_SIZES:
+            position += AUX_SIZES[value_type]
+        elif value_type in (ord("Z"), ord("H")):
+            position = aux.index(b"\0", position) + 1
+        elif value_type == ord("B"):
+            count, = struct.unpack_from("<i", aux, position + 1)
+            position += 5 + count * AUX_SIZES[aux[position]]
+        else:
+            break
+    return None
+
+
+def read_blocks(position, cigar):
+    # The reference blocks a read aligns to, a block ends at every N
+    blocks = []
+    start = end = position
+    for value in cigar:
+        length, operation = value >> 4, value & 0xF
+        if operation in CIGAR_BLOCK:
+            end += length
+        elif operation == CIGAR_SKIP:
+            if end > start:
+                blocks.append((start, end))
+            start = end = end + length
+    if end > start:
+        blocks.append((start, end))
+    return blocks
+
+
+class ContigGenes:
+    # The features of one contig, sorted by start, for overlap lookups
+    def __init__(self, features):
+        features = sorted(features, key=lambda feature: feature[2])
+        self.starts = [start for _, _, start, _ in features]
+        self.features = features
+        self.longest = max(end - start for _, _, start, end in features)
+        self.end = max(end for _, _, _, end in features)
+
+    def overlapping(self, begin, end):
+        # The genes with a feature overlapping [begin, end) by at least one base
+        genes = set()
+        i = bisect_left(self.starts, end) - 1
+        while i >= 0 and self.starts[i] > begin - self.longest:
+            gene, _, start, feature_end = self.features[i]
+            if feature_end > begin:
+                genes.add(gene)
+            i -= 1
+        return genes
+
+    def windows(self):
+        # Windows covering all features, features closer than WINDOW_GAP share one
+        windows = []
+        for _, _, start, end in self.features:
+            if windows and start <= windows[-1][1] + WINDOW_GAP:
+                windows[-1][1] = max(windows[-1][1], end)
+            else:
+                windows.append([start, end])
+        return windows
+
+
+def count_contig(reader, ref, chunks, genes, counts):
+    # Count the reads of the chunks of one contig that overlap exactly one gene
+    for chunk_begin, chunk_end in chunks:
+        reader.seek(chunk_begin)
+        while reader.tell() < chunk_end:
+            size_bytes = reader.read(4)
+            if len(size_bytes) < 4:
+                break
+            record = reader.read(struct.unpack("<i", size_bytes)[0])
+            ref_id, position, l_read_name, _, _, n_cigar, flag, l_seq = struct.unpack_from("<iiBBHHHi", record)
+            if ref_id != ref or position >= genes.end:
+                break
+            if flag & (FLAG_UNMAPPED | FLAG_SECONDARY | FLAG_SUPPLEMENTARY):
+                continue
+
+            cigar_offset = 32 + l_read_name
+            cigar = struct.unpack_from(f"<{n_cigar}I", record, cigar_offset)
+            overlapping = set()
+            for block_begin, block_end in read_blocks(position, cigar):
+                overlapping |= genes.overlapping(block_begin, block_end)
+            if len(overlapping) != 1:
+                continue
+
+            # Multi-mapping reads are only checked for reads that would be assigned
+            aux_offset = cigar_offset + 4 * n_cigar + (l_seq + 1) // 2 + l_seq
+            nh = nh_tag(record[aux_offset:])
+            if nh is not None and nh > 1:
+                continue
+            counts[overlapping.pop()] += 1
+
+
+def count_saf(bam_file, saf_path):
+    """Count the reads of an indexed BAM file per gene of a SAF file, reading only the regions of the genes.
+
+    The BAM index gives the BGZF blocks holding the reads of every window of nearby genes, only
+    those are decompressed. Reads are assigned like featureCounts does by default: unmapped,
+    secondary, supplementary and multi-mapping (NH > 1) reads are not counted, neither are reads
+    overlapping no gene or more than one gene. The total is the number of records in the BAM
+    file, taken from the index like the sum of a featureCounts summary.
+
+    Args:
+        bam_file (str): Path to a coordinate sorted and indexed BAM file.
+        saf_path (str): Path to the SAF file.
+
+    Returns:
+        tuple: The assigned and total reads as NumPy arrays with one sample, the gene lengths and
+            the genes x 1 count matrix, the values abundance takes from featureCounts.
+    """
+    gene_ids, features = read_saf(saf_path)
+    counts = np.zeros(len(gene_ids), dtype=np.int64)
+    index = bam_index.read_index(bam_index.find_index(bam_file), with_bins=True)
+    stats = bam_index.index_stats(bam_file)
+    ref_ids = {name: ref for ref, name in enumerate(stats.names)}
+
+    by_contig = {}
+    for feature in features:
+        by_contig.setdefault(feature[1], []).append(feature)
+
+    with BgzfReader(bam_file) as reader:
+        for contig, contig_features in by_contig.items():
+            if contig not in ref_ids:
+                logging.debug(f"Contig {contig} of {saf_path} is not a reference of {bam_file}")
+                continue
+            ref = ref_ids[contig]
+            genes = ContigGenes(contig_features)
+            chunks = bam_index.merge_chunks(tuple(chunk) for begin, end in genes.windows()
+                                            for chunk in bam_index.region_chunks(index, ref, begin, end))
+            count_contig(reader, ref, chunks, genes, counts)
+
+    total = int(stats.mapped.sum() + stats.unmapped.sum() + stats.no_coordinate)
+    return np.array([counts.sum()]), np.array([total]), gene_lengths(len(gene_ids), features), counts.reshape(-1, 1)
@@ -0,0 +1,174 @@
+import os
+import math
+import threading
+import logging
+from contextlib import contextmanager
+
+MB = 1024 ** 2
+
+# Memory footprint of the external tools as base bytes, bytes per byte of input and bytes per thread
+TOOL_MEMORY = {
+    "prodigal": (100 * MB, 2.0, 0),         # keeps every input sequence and its gene models
+    "hmmsearch": (100 * MB, 0.1, 32 * MB),  # streams the target sequences
+    "hmmscan": (200 * MB, 0.5, 32 * MB),    # loads the pressed database
+    "hmmpress": (100 * MB, 2.0, 0),
+    "featureCounts": (300 * MB, 1.0, 64 * MB),  # streams the reads, keeps the annotation
+    "samtools": (50 * MB, 0.0, 0),
+    "blastp": (1024 * MB, 2.0, 64 * MB),
+}
+
+# Seconds between two looks at /proc/meminfo while a task waits for memory
+MEMORY_POLL_INTERVAL = 1.0
+
+
+def estimate_memory(tool, *files, threads=1):
+    """Estimate the memory a tool needs from the size of its input files.
+
+    Args:
+        tool (str): The tool, a key of TOOL_MEMORY.
+        *files (str): The input files the tool loads, missing files are ignored.
+        threads (int, optional): The number of threads the tool runs with. Defaults to 1.
+
+    Returns:
+        int: The estimated footprint in bytes.
+    """
+    base, per_byte, per_thread = TOOL_MEMORY[tool]
+    size = sum(os.path.getsize(file) for file in files if file and os.path.isfile(file))
+    return int(base + per_byte * size + per_thread * threads)
+
+
+def memory_available():
+    # MemAvailable of /proc/meminfo in bytes, None where it cannot be read
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def cgroup_cpu_limit():
+    """Return the number of cores the cgroup CPU quota of this process allows, or None without a quota.
+
+    Both the cgroup v2 cpu.max file and the cgroup v1 cpu.cfs_quota_us/cpu.cfs_period_us files are read.
+    """
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return max(1, math.ceil(int(quota) / int(period)))
+        return None
+    except (OSError, ValueError):
+        pass
+
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return max(1, math.ceil(quota / period))
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def available_cores():
+    # The cores this process may run on, limited by the CPU affinity and the cgroup quota
+    if hasattr(os, "sched_getaffinity"):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    return min(cores, limit) if limit else cores
+
+
+class CoreScheduler:
+    """Budget of CPU cores and memory shared by all external tools of a run.
+
+    Every tool takes core tokens before it starts and gives them back when it finishes, so
+    parallel stages together never run more threads than the budget allows. A request for more
+    cores than are free is granted the free cores instead of waiting for all of them.
+
+    Tasks also reserve their estimated memory. A task is only admitted when its estimate fits in
+    the memory cap next to the reservations of the running tasks and in the memory the system
+    currently has available, otherwise it waits. A task is always admitted when nothing else
+    runs, so a task larger than the cap runs alone instead of never.
+
+    Args:
+        threads (int, optional): The core budget. Defaults to None, all available cores then.
+        max_memory (int, optional): The memory cap in bytes. Defaults to None, only the available
+            memory is checked then.
+    """
+    def __init__(self, threads=None, max_memory=None):
+        self.total = max(1, threads or available_cores())
+        self.max_memory = max_memory
+        self._free = self.total
+        self._reserved = 0
+        self._running = 0
+        self._condition = threading.Condition()
+        logging.debug(f"Core budget of {self.total} cores, memory cap {max_memory or 'none'}.")
+
+    @property
+    def free(self):
+        return self._free
+
+    @property
+    def reserved(self):
+        return self._reserved
+
+    def _admits(self, memory):
+        if self._free == 0:
+            return False
+        if self._running == 0 or memory == 0:
+            return True
+        if self.max_memory and self._reserved + memory > self.max_memory:
+            return False
+        available = memory_available()
+        return available is None or memory <= available
+
+    def acquire(self, cores=1, memory=0):
+        """Wait until at least one core and the memory are free and take up to cores of the free cores.
+
+        Returns:
+            int: The number of cores granted.
+        """
+        cores = max(1, min(cores, self.total))
+        with self._condition:
+            while not self._admits(memory):
+                # The available memory also changes without any task finishing, look again after a while
+                self._condition.wait(timeout=MEMORY_POLL_INTERVAL if self._free else None)
+            granted = min(cores, self._free)
+            self._free -= granted
+            self._reserved += memory
+            self._running += 1
+            return granted
+
+    def release(self, cores, memory=0):
+        with self._condition:
+            self._free += cores
+            self._reserved -= memory
+            self._running -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def cores(self, cores=1, memory=0):
+        """Hold core tokens and a memory reservation for the duration of a with block.
+
+        The block gets the number of granted cores.
+
+        Example:
+            with p.scheduler.cores(8, memory=estimate_memory("featureCounts", saf, threads=8)) as threads:
+                subprocess.Popen(f"featureCounts -T {threads} ...", shell=True).wait()
+        """
+        granted = self.acquire(cores, memory)
+        try:
+            yield granted
+        finally:
+            self.release(granted, memory)
+
+    def share(self, tasks):
+        # The cores every one of tasks parallel tasks can use
+        return max(1, self.total // max(1, tasks))
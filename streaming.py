@@ -0,0 +1,189 @@
+import os
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import utilities
+import translation_cache
+import chunked_prodigal
+import translate_search
+import abundance
+from fasta_index import FastaIndex, remove_index
+from hmmer_tables import read_target_names
+from scheduler import estimate_memory
+
+# Chunks per core, more chunks let the HMM search of the first chunks start earlier
+CHUNKS_PER_CORE = 4
+
+
+def translate_chunk(p, chunk_file):
+    # Translate one chunk on one core of the budget
+    with p.scheduler.cores(1, estimate_memory("prodigal", chunk_file)):
+        return chunked_prodigal.run_chunk(chunk_file, translate_search.PRODIGAL_PARAMS["mode"])
+
+
+def search_chunk(plastic_name, p, chunk_outputs):
+    # Search the proteins of one chunk for a plastic, the outputs are written next to the chunk
+    base = os.path.splitext(chunk_outputs[".faa"])[0]
+    hmm_output = f"{base}_{plastic_name}_HMMER.out"
+    returncode = translate_search.run_hmmsearch(plastic_name, p, chunk_outputs[".faa"], hmm_output,
+                                                f"{base}_{plastic_name}_hmmsearch.out", f"{base}_{plastic_name}_hmmsearch.log")
+    return returncode, hmm_output
+
+
+def chunk_hits(p, plastic_names, chunk_outputs, hmm_outputs):
+    """Extract the hit proteins of one chunk and collect the SAF rows of its hit genes.
+
+    Args:
+        p (PathManager): The path manager of the current run.
+        plastic_names (list): The plastics searched for.
+        chunk_outputs (dict): The .faa, .ffn and .gff files of the chunk.
+        hmm_outputs (dict): The tblout file of the chunk for every plastic.
+
+    Returns:
+        tuple: The hits FASTA file of the chunk for every plastic and the SAF rows of the chunk.
+    """
+    base = os.path.splitext(chunk_outputs[".faa"])[0]
+    index = FastaIndex(chunk_outputs[".faa"])
+
+    hit_fastas = {}
+    hit_plastics = {}
+    for plastic_name in plastic_names:
+        hits = read_target_names(hmm_outputs[plastic_name])
+        hit_fastas[plastic_name] = f"{base}_{plastic_name}_hmm_output.fasta"
+        index.extract(hits, hit_fastas[plastic_name], min_length=10)
+        for hit_id in abundance.read_hit_ids(hit_fastas[plastic_name]):
+            hit_plastics.setdefault(hit_id, []).append(plastic_name)
+
+    saf_rows = list(abundance.hit_saf_rows(abundance.gff_gene_coordinates(chunk_outputs[".gff"]), hit_plastics))
+    return hit_fastas, saf_rows
+
+
+def merge_tblouts(hmm_outputs, merged_file):
+    # Concatenate the tblout rows of all chunks between the header of the first and the footer of the last
+    with open(merged_file, "w") as merged:
+        for i, hmm_output in enumerate(hmm_outputs):
+            with open(hmm_output) as f:
+                lines = f.readlines()
+            rows = [line for line in lines if line.strip() and not line.startswith("#")]
+            # The footer of a tblout starts with a bare "#" line, also when there are no rows
+            start = next((j for j, line in enumerate(lines) if not line.startswith("#") or line.strip() == "#"), len(lines))
+            if i == 0:
+                merged.writelines(lines[:start])
+            merged.writelines(rows)
+            if i == len(hmm_outputs) - 1:
+                merged.writelines(line for line in lines[start:] if line.startswith("#"))
+
+
+def concatenate(files, output_file):
+    with open(output_file, "wb") as output:
+        for file in files:
+            with open(file, "rb") as f:
+                shutil.copyfileobj(f, output)
+
+
+def run_streaming(p):
+    """Translate the contigs and search the proteins chunk by chunk, overlapping both stages.
+
+    The contigs are split into consecutive chunks. As soon as Prodigal finishes a chunk, its
+    proteins are searched for every plastic, and as soon as all searches of a chunk finish its
+    hits are extracted and its SAF rows collected. At the end the chunk outputs are merged into
+    the same files run_prodigal and run_hmmer write, so later stages and runs see no difference.
+
+    Without anything to translate, e.g. when the translation is checkpointed or cached, this
+    falls back to run_prodigal and run_hmmer.
+
+    Args:
+        p (PathManager): The path manager of the current run.
+
+    Returns:
+        dict: The SAF file of every plastic, or None if the SAF files still have to be built.
+    """
+    translate_search.make_plastic_dirs(p)
+    outputs = translate_search.translate_outputs(p)
+    key = translation_cache.cache_key(p.contigs, translate_search.PRODIGAL_PARAMS) if p.cache_size > 0 else None
+    translated = p.checkpoints.is_complete("prodigal", [p.contigs], translate_search.PRODIGAL_PARAMS) and translate_search.check_translate_output(p)
+    if translated or (key and os.path.isfile(os.path.join(utilities.get_cache_dir("prodigal"), key, "complete"))):
+        translate_search.run_prodigal(p)
+        translate_search.run_hmmer(p)
+        return None
+
+    contigs_base = os.path.basename(p.contigs).split(".")[0]
+    plastic_names = p.plastic_list
+    cores = p.scheduler.total
+    chunk_dir = os.path.join(p.temps, "stream_chunks")
+    if os.path.exists(chunk_dir):
+        shutil.rmtree(chunk_dir)
+    os.makedirs(chunk_dir)
+
+    # Outputs may be hard links into the cache, never write through them
+    for output in outputs.values():
+        if os.path.lexists(output):
+            os.remove(output)
+        remove_index(output)
+
+    try:
+        sizes = chunked_prodigal.plan_chunks(chunked_prodigal.read_contig_lengths(p.contigs), cores * CHUNKS_PER_CORE)
+        chunk_files = chunked_prodigal.split_contigs(p.contigs, sizes, chunk_dir)
+        logging.info(f"Streaming {len(chunk_files)} chunks of {p.contigs} through prodigal and hmmsearch")
+
+        chunk_outputs = [None] * len(chunk_files)
+        hmm_outputs = [{} for _ in chunk_files]
+        hit_fastas = [None] * len(chunk_files)
+        saf_rows = [None] * len(chunk_files)
+        failed = []
+
+        with ThreadPoolExecutor(max_workers=cores) as executor:
+            # Every future is tagged with its stage, chunk and plastic, finished stages submit the next ones
+            pending = {executor.submit(translate_chunk, p, chunk_file): ("prodigal", i, None)
+                       for i, chunk_file in enumerate(chunk_files)}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, i, plastic_name = pending.pop(future)
+                    if stage == "prodigal":
+                        returncode, chunk_outputs[i] = future.result()
+                        if returncode != 0:
+                            failed.append(f"prodigal on {chunk_files[i]}")
+                            continue
+                        for name in plastic_names:
+                            pending[executor.submit(search_chunk, name, p, chunk_outputs[i])] = ("hmmsearch", i, name)
+                    elif stage == "hmmsearch":
+                        returncode, hmm_outputs[i][plastic_name] = future.result()
+                        if returncode != 0:
+                            failed.append(f"hmmsearch for {plastic_name} on {chunk_files[i]}")
+                        elif len(hmm_outputs[i]) == len(plastic_names):
+                            pending[executor.submit(chunk_hits, p, plastic_names, chunk_outputs[i], hmm_outputs[i])] = ("hits", i, None)
+                    else:
+                        hit_fastas[i], saf_rows[i] = future.result()
+
+        # The logs of every chunk are collected like those of a single prodigal run
+        with open(os.path.join(p.temps, "prodigal.log"), "w") as log:
+            for chunk_file in chunk_files:
+                log_file = f"{os.path.splitext(chunk_file)[0]}.log"
+                if os.path.isfile(log_file):
+                    with open(log_file) as chunk_log:
+                        log.write(chunk_log.read())
+
+        if failed:
+            raise ValueError(f"ERROR: Streaming pipeline failed running {', '.join(failed)}")
+
+        # Merge the chunks into the outputs of run_prodigal and run_hmmer
+        chunked_prodigal.merge_outputs(chunk_outputs, sizes, {os.path.splitext(output)[1]: output for output in outputs.values()})
+        p.checkpoints.complete("prodigal", [p.contigs], translate_search.PRODIGAL_PARAMS)
+        if key:
+            translation_cache.store(key, outputs, p.cache_size)
+
+        saf_paths = {}
+        for plastic_name in plastic_names:
+            temp_dir = os.path.join(p.temps, plastic_name)
+            output_base = f"{contigs_base}_{plastic_name}_hmm_output"
+            merge_tblouts([hmm_output[plastic_name] for hmm_output in hmm_outputs], os.path.join(temp_dir, f"{contigs_base}_{plastic_name}_HMMER.out"))
+            concatenate([hit_fasta[plastic_name] for hit_fasta in hit_fastas], os.path.join(temp_dir, f"{output_base}.fasta"))
+            saf_paths[plastic_name] = os.path.join(temp_dir, f"{output_base}.saf")
+            p.checkpoints.complete(*translate_search.hmmer_stage(plastic_name, p))
+
+        combined_saf_path = abundance.combined_saf_file(p) if p.combined_counts else None
+        abundance.write_saf(saf_paths, (row for rows in saf_rows for row in rows), combined_saf_path)
+        return saf_paths
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
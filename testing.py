@@ -119,17 +119,17 @@ class TestPlasticTools(unittest.TestCase):
         # Define contigs_base
         contigs_base = os.path.basename(self.p.contigs).split(".")[0]
     
-        # Check that the corrected .ffn and .saf files were created for each plastic type
+        # Check that build_saf wrote the .saf file of the hits of each plastic type, straight from the gene coordinates
         if self.p.plastic == "all":
             plastic_names = self.p.all_plastics
         else:
             plastic_names = self.p.plastic.split(',')
         for plastic_name in plastic_names:
             temp_dir = os.path.join(self.p.temps, plastic_name.lower())
-            corrected_ffn_file = os.path.join(temp_dir, f"{contigs_base}_{plastic_name}_corrected.ffn")
-            saf_file = os.path.join(temp_dir, f"{contigs_base}_{plastic_name}.saf")
-            self.assertTrue(os.path.exists(corrected_ffn_file))
-            self.assertTrue(os.path.exists(saf_file))
+            saf_file = os.path.join(temp_dir, f"{contigs_base}_{plastic_name}_hmm_output.saf")
+            self.assertTrue(os.path.exists(saf_file), saf_file)
+            with open(saf_file) as f:
+                self.assertEqual(f.readline(), "GeneID\tChr\tStart\tEnd\tStrand\n")
     
         # Check that the featureCounts log and output files were created for each plastic type
         if self.p.plastic == "all":
@@ -1,132 +1,440 @@
 import os
 import subprocess
-from Bio import SearchIO, SeqIO
-import time
 import utilities
-import multiprocessing
-from functools import partial
+from multiprocessing.pool import ThreadPool
+from functools import partial, lru_cache
 import shutil
 import logging
+from fasta_index import FastaIndex, remove_index
+from hmmer_tables import read_target_names
+import translation_cache
+import chunked_prodigal
+import hmm_engine
+import gene_prediction
+from scheduler import estimate_memory
+
+# Parameters recorded in the prodigal checkpoint, outputs of prodigal and pprodigal are the same
+PRODIGAL_PARAMS = {"mode": "meta", "outputs": ["faa", "ffn", "gff"]}
+
+
+def prodigal_params(p):
+    # The GFF of pyrodigal differs from that of prodigal, so its outputs are checkpointed and cached apart
+    if p.use_pyrodigal:
+        return dict(PRODIGAL_PARAMS, backend="pyrodigal", version=gene_prediction.pyrodigal.__version__)
+    return PRODIGAL_PARAMS
 
 #use pprodigal if installed, parallelizes prodigal
-def get_prodigal_command(p):
+def get_prodigal_command(p, cores=1):
     contigs_base = os.path.basename(p.contigs).split(".")[0]
     aa_file = os.path.join(p.temps, f"{contigs_base}.faa")
     nt_file = os.path.join(p.temps, f"{contigs_base}.ffn")
+    gff_file = os.path.join(p.temps, f"{contigs_base}.gff")
     
-    if p.multiprocessing:
-        cores = utilities.run_in_parallel("pprodigal")
-        return f"pprodigal -i {p.contigs} -a {aa_file} -p meta -d {nt_file} --tasks {cores}"
+    # run_in_parallel returns 1 when pprodigal is not installed
+    if cores > 1 and utilities.run_in_parallel("pprodigal") > 1:
+        return f"pprodigal -i {p.contigs} -a {aa_file} -p meta -d {nt_file} -f gff -o {gff_file} --tasks {cores}"
     else:
-        return f"prodigal -i {p.contigs} -a {aa_file} -p meta -d {nt_file}"
+        return f"prodigal -i {p.contigs} -a {aa_file} -p meta -d {nt_file} -f gff -o {gff_file}"
 
 
-def run_prodigal(p):
+def make_plastic_dirs(p):
     if isinstance(p.plastic, str) and p.plastic != "all":
         plastic_names = p.plastic.split(',')
     elif isinstance(p.plastic, str) and p.plastic == "all":
         plastic_names = p.all_plastics
               
-    # Create a sub-directory for each plastic type
+    # Create a sub-directory for each plastic type, existing ones are kept to resume from their checkpoints
     for plastic_name in plastic_names:
         temp_dir = os.path.join(os.path.abspath(p.output), "temps", plastic_name.lower())
-        if os.path.exists(temp_dir):
-            if p.force_overwrite:
-                shutil.rmtree(temp_dir)
-                os.makedirs(temp_dir, exist_ok=True)
-            else:
-                raise ValueError("ERROR: Temps folder already exists, please remove it and run the program again.")
-        else:
-            os.makedirs(temp_dir, exist_ok=True)
-            
-    
+        if os.path.exists(temp_dir) and p.force_overwrite:
+            shutil.rmtree(temp_dir)
+        os.makedirs(temp_dir, exist_ok=True)
+
+
+def run_prodigal(p):
+    make_plastic_dirs(p)
+    params = prodigal_params(p)
+
+    # Skip the translation when the contigs did not change since the last completed run
+    if p.checkpoints.is_complete("prodigal", [p.contigs], params) and check_translate_output(p):
+        logging.info("Prodigal output is up to date, skipping translation.")
+        return
+
+    # Reuse the translation of the same contigs from an earlier run through the shared cache
+    outputs = translate_outputs(p)
+    key = translation_cache.cache_key(p.contigs, params) if p.cache_size > 0 else None
+    if key and translation_cache.fetch(key, outputs):
+        p.checkpoints.complete("prodigal", [p.contigs], params)
+        return
+
+    # Outputs may be hard links into the cache, never let prodigal write through them
+    for output in outputs.values():
+        if os.path.lexists(output):
+            os.remove(output)
+        remove_index(output)
 
-    prodigal_command = get_prodigal_command(p)
-    
     prodigal_log_file = os.path.join(p.output, "temps", "prodigal.log")
-    
 
-    with open(prodigal_log_file, 'w') as f:
-        process = subprocess.Popen(prodigal_command, shell=True, stdout=f, stderr=f)
-    
-    while process.poll() is None:
-        time.sleep(0.1)
+    # Nothing else runs during the translation, it gets the whole core budget
+    with p.scheduler.cores(p.scheduler.total, estimate_memory("prodigal", p.contigs)) as cores:
+        # Predict the genes in process on a thread pool, the outputs are those of prodigal
+        if p.use_pyrodigal:
+            outputs_by_ext = {os.path.splitext(output)[1]: output for output in outputs.values()}
+            success = gene_prediction.write_gene_files(p.contigs, outputs_by_ext, cores)
+        # Without pprodigal, split the contigs into chunks and run prodigal on them in parallel
+        elif cores > 1 and utilities.get_path("pprodigal") is None:
+            chunk_dir = os.path.join(p.temps, "prodigal_chunks")
+            outputs_by_ext = {os.path.splitext(output)[1]: output for output in outputs.values()}
+            success = chunked_prodigal.run_chunked_prodigal(p.contigs, outputs_by_ext, cores, chunk_dir, prodigal_log_file, PRODIGAL_PARAMS["mode"])
+        else:
+            prodigal_command = get_prodigal_command(p, cores)
+
+            with open(prodigal_log_file, 'w') as f:
+                process = subprocess.Popen(prodigal_command, shell=True, stdout=f, stderr=f)
+
+            success = process.wait() == 0
     
-    logging.info("\nprodigal finished running. Prodigal logs saved to {}".format(prodigal_log_file))
+    if p.use_pyrodigal:
+        logging.info("\npyrodigal finished running.")
+    else:
+        logging.info("\nprodigal finished running. Prodigal logs saved to {}".format(prodigal_log_file))
+
+    if success and check_translate_output(p):
+        p.checkpoints.complete("prodigal", [p.contigs], params)
+        if key:
+            translation_cache.store(key, outputs, p.cache_size)
+
+
+def translate_outputs(p):
+    # The translation output files of the run, by their file name in the translation cache
+    contigs_base = os.path.basename(p.contigs).split(".")[0]
+    return {f"genes{ext}": os.path.join(p.temps, f"{contigs_base}{ext}") for ext in (".faa", ".ffn", ".gff")}
+
+
+def check_translate_output(p):
+    # Check if the aa, nt and gff files of the translation exist
+    return all(os.path.isfile(output) for output in translate_outputs(p).values())
+
+
+def hmmer_stage(plastic_name, p):
+    # Checkpoint stage name, input files and parameters of the HMM search for a plastic
+    contigs_base = os.path.basename(p.contigs).split(".")[0]
+    inputs = [os.path.join(p.temps, f"{contigs_base}.faa"), os.path.join(p.motif, f"{plastic_name}.hmm")]
+    return f"hmmer/{plastic_name}", inputs, {"bitscore": get_bitscore(plastic_name, p.bitscores)}
+
+
+@lru_cache(maxsize=None)
+def read_bitscores(bitscores_file):
+    # Map every motif in bitscores.txt (e.g. "pet.hmm:75") to its inclusion threshold, read once per process
+    bitscores = {}
+    with open(bitscores_file) as f:
+        for line in f:
+            if ":" not in line:
+                continue
+            motif, score = line.split(":", 1)
+            bitscores[os.path.splitext(motif.strip().lower())[0]] = float(score.strip())
+    return bitscores
+
+
+def get_bitscore(plastic_name, bitscores_file):
+    incT = read_bitscores(bitscores_file).get(plastic_name.lower())
+    if incT is None:
+        raise Exception(f"\n ERROR: No bitscore found for specified plastic type: {plastic_name} in  {bitscores_file}\n ")
+    return incT
 
 
 def run_hmmer(p):
-    plastic_names = p.plastic_list
+    # Only search for the plastics whose proteins or motifs changed since their last completed search
+    contigs_base = os.path.basename(p.contigs).split(".")[0]
+    plastic_names = [plastic_name for plastic_name in p.plastic_list
+                     if not (p.checkpoints.is_complete(*hmmer_stage(plastic_name, p))
+                             and os.path.isfile(os.path.join(p.temps, plastic_name, f"{contigs_base}_{plastic_name}_hmm_output.fasta")))]
+    if not plastic_names:
+        logging.info("HMMER output is up to date, skipping the HMM search.")
+        return
 
-    # Create a new function that has `p` already filled in
-    run_hmmer_thread_p = partial(run_hmmer_thread, p=p)
+    # Search in process, reading the proteins once for all plastics and writing the hits from memory
+    if p.use_pyhmmer:
+        aa_file = os.path.join(p.temps, f"{contigs_base}.faa")
+        thresholds = {plastic_name: get_bitscore(plastic_name, p.bitscores) for plastic_name in plastic_names}
+        with p.scheduler.cores(p.scheduler.total) as threads:
+            hmm_engine.run_search(p, thresholds, hmm_engine.protein_batches(aa_file), p.temps, contigs_base, threads)
+        for plastic_name in plastic_names:
+            p.checkpoints.complete(*hmmer_stage(plastic_name, p))
+        return
 
-    # Start the tasks
-    if p.multiprocessing:
-        pool = multiprocessing.Pool(processes=4)
+    # Index the proteins once so every worker can seek straight to its hits
+    FastaIndex(os.path.join(p.temps, f"{contigs_base}.faa"))
 
-    else:
-        pool = multiprocessing.Pool(processes=1)
+    if p.combined_search:
+        if run_hmmer_combined(p, plastic_names):
+            for plastic_name in plastic_names:
+                p.checkpoints.complete(*hmmer_stage(plastic_name, p))
+        return
+
+    # Create a new function that has `p` and the cores of every search already filled in
+    run_hmmer_thread_p = partial(run_hmmer_thread, p=p, cores=p.scheduler.share(len(plastic_names)))
+
+    # Start the tasks, the threads only wait for hmmsearch and the core budget limits how many run
+    pool = ThreadPool(processes=min(len(plastic_names), p.scheduler.total))
     
-    pool.map(run_hmmer_thread_p, plastic_names)
+    completed = pool.map(run_hmmer_thread_p, plastic_names)
 
     # Wait for the tasks to finish
     pool.close()
     pool.join()    
 
-def run_hmmer_thread(plastic_name, p):
+    for plastic_name, done in zip(plastic_names, completed):
+        if done:
+            p.checkpoints.complete(*hmmer_stage(plastic_name, p))
+
+def gene_search_stage(plastic_name, p):
+    # Checkpoint of predicting and searching in one pass, the proteins only exist in memory so the contigs are the input
+    inputs = [p.contigs, os.path.join(p.motif, f"{plastic_name}.hmm")]
+    return f"hmmer/{plastic_name}", inputs, {"bitscore": get_bitscore(plastic_name, p.bitscores), "genes": "pyrodigal"}
+
+
+def run_gene_search(p):
+    """Predict the genes in process and stream their proteins straight into the in-process HMM search.
+
+    The proteins never touch the disk: only the GFF, which later stages read the gene coordinates
+    from, and the outputs of the search are written. With --write_genes the .faa and .ffn files
+    are written as well.
+
+    Args:
+        p (PathManager): The path manager of the current run.
+    """
+    make_plastic_dirs(p)
+    contigs_base = os.path.basename(p.contigs).split(".")[0]
+    outputs = {os.path.splitext(output)[1]: output for output in translate_outputs(p).values()}
+    if not p.write_genes:
+        outputs = {".gff": outputs[".gff"]}
+
+    # Every plastic is searched again when the genes have to be predicted again
+    up_to_date = all(os.path.isfile(output) for output in outputs.values()) and all(
+        p.checkpoints.is_complete(*gene_search_stage(plastic_name, p))
+        and os.path.isfile(os.path.join(p.temps, plastic_name, f"{contigs_base}_{plastic_name}_hmm_output.fasta"))
+        for plastic_name in p.plastic_list)
+    if up_to_date:
+        logging.info("Genes and HMMER output are up to date, skipping the gene prediction and HMM search.")
+        return
+
+    for output in outputs.values():
+        if os.path.lexists(output):
+            os.remove(output)
+        remove_index(output)
+
+    thresholds = {plastic_name: get_bitscore(plastic_name, p.bitscores) for plastic_name in p.plastic_list}
+    with p.scheduler.cores(p.scheduler.total, estimate_memory("prodigal", p.contigs)) as threads:
+        # The prediction and the search pools run at the same time, so they split the granted cores
+        prediction_threads = max(1, threads // 2)
+        search_threads = max(1, threads - prediction_threads)
+        proteins = gene_prediction.predict_proteins(p.contigs, outputs, prediction_threads)
+        hmm_engine.run_search(p, thresholds, hmm_engine.protein_blocks(proteins), p.temps, contigs_base, search_threads)
+
+    for plastic_name in p.plastic_list:
+        p.checkpoints.complete(*gene_search_stage(plastic_name, p))
+
+
+def run_hmmer_thread(plastic_name, p, cores=1):
     try:
         contigs_base = os.path.basename(p.contigs).split(".")[0]
         aa_file = os.path.join(p.output, "temps", f"{contigs_base}.faa")
         temp_dir = os.path.join(p.temps, plastic_name)
 
-        incT = None
-        with open(p.bitscores) as f:
-            for line in f:
-                if plastic_name in line.lower():
-                    incT = float(line.split(":")[1].strip())
-                    break
-        if incT is None:
-            raise Exception(f"\n ERROR: No bitscore found for specified plastic type: {plastic_name} in  {p.bitscores}\n ")
-    
-        hmm_input = os.path.join(p.motif, f"{plastic_name}.hmm")
         hmm_output = os.path.join(temp_dir, f"{contigs_base}_{plastic_name}_HMMER.out")
-        hmmer_command = f"hmmsearch --tformat fasta -T {incT} --tblout {hmm_output} {hmm_input} {aa_file}"
         log_file = os.path.join(temp_dir, f"{plastic_name}_hmmsearch.log")
         
         # specify the file to capture program output
         program_output_file = os.path.join(temp_dir, f"{contigs_base}_{plastic_name}_hmmsearch.out")
+
+        # The outputs of an earlier run must never be read as the hits of this one
+        hits_output = os.path.join(temp_dir, f"{contigs_base}_{plastic_name}_hmm_output.fasta")
+        for output in (hmm_output, hits_output):
+            if os.path.isfile(output):
+                os.remove(output)
         
-        with open(log_file, 'w') as f, open(program_output_file, 'w') as p_out:
-            process = subprocess.Popen(hmmer_command, shell=True, stdout=p_out, stderr=f)
-        
-        while process.poll() is None:
-            time.sleep(0.1)
+        returncode = run_hmmsearch(plastic_name, p, aa_file, hmm_output, program_output_file, log_file, cores)
 
         logging.info("\nhmmsearch finished running. Results saved to {}".format(hmm_output))
         logging.info("hmmsearch logs saved to {}".format(log_file))
         logging.info("hmmsearch program output saved to {}".format(program_output_file))
-        
-
-        output = os.path.join(temp_dir, f"{contigs_base}_{plastic_name}_hmm_output.fasta")
-        try:
-            qresults = SearchIO.read(hmm_output, "hmmer3-tab")
-            hits = [result.id for result in qresults]
-
-            records = list(SeqIO.parse(aa_file, "fasta"))
-            for record in records:
-                if record.id in hits and len(record) > 10:
-                    with open(output, "a") as f:
-                        f.write(">" + str(record.id) + "\n" + str(record.seq) + "\n")
 
-        except Exception as e:
-            logging.warning(f"Error reading HMMER output for {plastic_name}: {e}")
-            with open(output, "w") as f:
+        if returncode != 0:
+            logging.error(f"hmmsearch failed for {plastic_name}, see {log_file}. Reporting no hits.")
+            with open(hits_output, "w") as f:
                 pass
+            return False
 
+        extract_hits(plastic_name, p)
+        return True
         
     except Exception as e:
         logging.error(f"Error running HMMER for {plastic_name}: {e}")
+        return False
 
-    
 
+def run_hmmsearch(plastic_name, p, aa_file, hmm_output, program_output_file, log_file, cores=1):
+    # Search the proteins in aa_file with the motif of a plastic and its bitscore threshold
+    incT = get_bitscore(plastic_name, p.bitscores)
+    hmm_input = os.path.join(p.motif, f"{plastic_name}.hmm")
+
+    with p.scheduler.cores(cores, estimate_memory("hmmsearch", hmm_input, aa_file, threads=cores)) as cpu:
+        hmmer_command = f"hmmsearch --tformat fasta --cpu {cpu} -T {incT} --tblout {hmm_output} {hmm_input} {aa_file}"
+
+        with open(log_file, 'w') as f, open(program_output_file, 'w') as p_out:
+            process = subprocess.Popen(hmmer_command, shell=True, stdout=p_out, stderr=f)
+
+        return process.wait()
+
+
+def extract_hits(plastic_name, p):
+    contigs_base = os.path.basename(p.contigs).split(".")[0]
+    aa_file = os.path.join(p.output, "temps", f"{contigs_base}.faa")
+    temp_dir = os.path.join(p.temps, plastic_name)
+    hmm_output = os.path.join(temp_dir, f"{contigs_base}_{plastic_name}_HMMER.out")
+
+    output = os.path.join(temp_dir, f"{contigs_base}_{plastic_name}_hmm_output.fasta")
+    try:
+        hits = read_target_names(hmm_output)
+
+        FastaIndex(aa_file).extract(hits, output, min_length=10)
+
+    except Exception as e:
+        logging.warning(f"Error reading HMMER output for {plastic_name}: {e}")
+        with open(output, "w") as f:
+            pass
+
+
+def build_hmm_database(p, plastic_names):
+    """Combine the motifs of the given plastics into one pressed HMM database.
+
+    Every model is renamed to its plastic and gets its bitscores.txt threshold as gathering
+    cutoff, so a single hmmscan run with --cut_ga applies the per-plastic thresholds. The
+    pressed database is cached by content and reused by later runs.
+
+    Args:
+        p (PathManager): The path manager of the current run.
+        plastic_names (list): The plastics whose motifs are combined.
+
+    Returns:
+        str: Path to the pressed HMM database.
+    """
+    bitscores = read_bitscores(p.bitscores)
+    plastic_names = sorted(set(plastic_names))
+    hmm_files = [os.path.join(p.motif, f"{plastic_name}.hmm") for plastic_name in plastic_names]
+    thresholds = ",".join(f"{plastic_name}:{get_bitscore(plastic_name, p.bitscores)}" for plastic_name in plastic_names)
+
+    key = utilities.hash_files(*hmm_files, extra=thresholds)
+    db_dir = utilities.get_cache_dir("hmmdb", key[:16])
+    db_file = os.path.join(db_dir, "motifs.hmm")
+
+    # hmmpress writes these four files next to the database
+    if all(os.path.isfile(db_file + ext) for ext in (".h3f", ".h3i", ".h3m", ".h3p")):
+        logging.info(f"Using cached HMM database {db_file}")
+        return db_file
+
+    tmp_file = f"{db_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as db:
+        for plastic_name, hmm_file in zip(plastic_names, hmm_files):
+            incT = bitscores[plastic_name]
+            with open(hmm_file) as f:
+                for line in f:
+                    tag = line.split(" ", 1)[0]
+                    if tag == "NAME":
+                        line = f"NAME  {plastic_name}\n"
+                    elif tag in ("GA", "TC", "NC"):
+                        continue
+                    elif tag == "STATS" and "LOCAL MSV" in line:
+                        db.write(f"GA    {incT} {incT};\n")
+                    db.write(line)
+    os.replace(tmp_file, db_file)
+
+    log_file = os.path.join(db_dir, "hmmpress.log")
+    with p.scheduler.cores(1, estimate_memory("hmmpress", db_file)), open(log_file, 'w') as f:
+        process = subprocess.Popen(f"hmmpress -f {db_file}", shell=True, stdout=f, stderr=f)
+        returncode = process.wait()
+
+    if returncode != 0:
+        raise ValueError(f"ERROR: hmmpress failed, see {log_file}")
+
+    logging.info(f"HMM database for {', '.join(plastic_names)} pressed to {db_file}")
+    return db_file
+
+
+def split_tblout(scan_output, p, plastic_names):
+    """Split a hmmscan tblout into the per-plastic hmmsearch-style tblout files.
+
+    The rows are written to temps/<plastic>/<contigs>_<plastic>_HMMER.out with target and query
+    swapped back, so downstream readers see the same layout as a per-plastic hmmsearch.
+
+    Only the layout, the hits and the scores match those of hmmsearch. The E-values are copied
+    from hmmscan, which computes them against the number of models in the database instead of
+    the number of proteins searched, so they differ from what a per-plastic hmmsearch reports and
+    must not be compared with it; the tblout files note this in their header.
+    """
+    contigs_base = os.path.basename(p.contigs).split(".")[0]
+    bitscores = read_bitscores(p.bitscores)
+    header = ("# target name accession query name accession E-value score bias E-value score bias exp reg clu ov env dom rep inc description of target\n"
+              "# E-values of hmmscan --cut_ga, computed against the number of models, not the number of proteins like hmmsearch\n")
+
+    outputs = {}
+    for plastic_name in plastic_names:
+        hmm_output = os.path.join(p.temps, plastic_name, f"{contigs_base}_{plastic_name}_HMMER.out")
+        outputs[plastic_name] = open(hmm_output, "w")
+        outputs[plastic_name].write(header)
+
+    try:
+        with open(scan_output) as f:
+            for line in f:
+                if line.startswith("#") or not line.strip():
+                    continue
+                fields = line.split(None, 18)
+                plastic_name = fields[0]
+                if plastic_name not in outputs or float(fields[5]) < bitscores[plastic_name]:
+                    continue
+                row = [fields[2], fields[3], fields[0], fields[1]] + fields[4:18] + ["-"]
+                outputs[plastic_name].write(" ".join(row) + "\n")
+    finally:
+        for output in outputs.values():
+            output.write("# [ok]\n")
+            output.close()
+
+
+def run_hmmer_combined(p, plastic_names):
+    """Search the proteins once with the motifs of all plastics and split the hits per plastic.
+
+    Args:
+        p (PathManager): The path manager of the current run.
+        plastic_names (list): The plastics to search for.
+
+    Returns:
+        bool: True if the search completed.
+    """
+    contigs_base = os.path.basename(p.contigs).split(".")[0]
+    aa_file = os.path.join(p.temps, f"{contigs_base}.faa")
+
+    db_file = build_hmm_database(p, plastic_names)
+
+    scan_output = os.path.join(p.temps, f"{contigs_base}_hmmscan.tbl")
+    program_output_file = os.path.join(p.temps, f"{contigs_base}_hmmscan.out")
+    log_file = os.path.join(p.temps, "hmmscan.log")
+    with p.scheduler.cores(p.scheduler.total, estimate_memory("hmmscan", db_file, aa_file, threads=p.scheduler.total)) as cores:
+        hmmer_command = f"hmmscan --qformat fasta --cut_ga --cpu {cores} --tblout {scan_output} -o {program_output_file} {db_file} {aa_file}"
+
+        with open(log_file, 'w') as f:
+            process = subprocess.Popen(hmmer_command, shell=True, stdout=f, stderr=f)
+        process.wait()
+
+    logging.info("\nhmmscan finished running. Results saved to {}".format(scan_output))
+    logging.info("hmmscan logs saved to {}".format(log_file))
+
+    if process.returncode != 0:
+        logging.error(f"hmmscan failed, see {log_file}")
+        return False
+
+    split_tblout(scan_output, p, plastic_names)
+
+    for plastic_name in plastic_names:
+        extract_hits(plastic_name, p)
+    return True
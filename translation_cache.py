@@ -0,0 +1,142 @@
+import os
+import hashlib
+import shutil
+import subprocess
+import time
+import logging
+import utilities
+from fasta_index import remove_index
+
+# Default size cap of the translation cache in bytes, PLASTICTOOLS_CACHE_SIZE (in GB) overrides it
+DEFAULT_CACHE_SIZE = 50 * 1024 ** 3
+
+
+def get_cache_size(cache_size=None):
+    """Return the size cap of the translation cache in bytes.
+
+    Args:
+        cache_size (float, optional): Size cap in GB, e.g. from the --cache_size argument. Defaults to None.
+    """
+    if cache_size is None:
+        cache_size = os.environ.get("PLASTICTOOLS_CACHE_SIZE")
+    if cache_size is None:
+        return DEFAULT_CACHE_SIZE
+    return int(float(cache_size) * 1024 ** 3)
+
+
+def prodigal_version():
+    # prodigal prints its version to stderr, e.g. "Prodigal V2.6.3: February, 2016"
+    try:
+        result = subprocess.run(["prodigal", "-v"], capture_output=True, text=True)
+        return (result.stdout + result.stderr).strip()
+    except OSError:
+        return "unknown"
+
+
+def cache_key(contigs, params):
+    """Return the cache key of the translation of a contigs file.
+
+    Args:
+        contigs (str): Path to the contigs file.
+        params (dict): The parameters of the translation, e.g. the Prodigal mode.
+    """
+    extra = ";".join(f"{name}={value}" for name, value in sorted(params.items()))
+    return hashlib.sha256(f"{utilities.file_checksum(contigs)};{extra};{prodigal_version()}".encode()).hexdigest()
+
+
+def link_file(src, dst):
+    # Hard link, reflink or as last resort copy src to dst
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        subprocess.run(["cp", "--reflink=auto", src, dst], check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError):
+        shutil.copy2(src, dst)
+
+
+def entry_size(entry_dir):
+    return sum(os.path.getsize(os.path.join(entry_dir, file)) for file in os.listdir(entry_dir))
+
+
+def fetch(key, outputs):
+    """Link the cached outputs of a translation into the run.
+
+    Args:
+        key (str): The cache key returned by cache_key.
+        outputs (dict): Destination path of every cached file, by file name in the cache.
+
+    Returns:
+        bool: True if the translation was found in the cache.
+    """
+    entry_dir = os.path.join(utilities.get_cache_dir("prodigal"), key)
+    if not os.path.isfile(os.path.join(entry_dir, "complete")):
+        return False
+    if not all(os.path.isfile(os.path.join(entry_dir, name)) for name in outputs):
+        return False
+
+    for name, dst in outputs.items():
+        # An index of the replaced file must not be taken for the index of the linked one
+        remove_index(dst)
+        link_file(os.path.join(entry_dir, name), dst)
+
+    # The modification time of the marker is the last use for the LRU eviction
+    os.utime(os.path.join(entry_dir, "complete"))
+    logging.info(f"Using cached Prodigal output {entry_dir}")
+    return True
+
+
+def store(key, outputs, max_size=DEFAULT_CACHE_SIZE):
+    """Add the outputs of a translation to the cache and evict the least recently used entries.
+
+    Args:
+        key (str): The cache key returned by cache_key.
+        outputs (dict): Path of every output file, by file name in the cache.
+        max_size (int, optional): Size cap of the cache in bytes. Defaults to DEFAULT_CACHE_SIZE.
+    """
+    cache_dir = utilities.get_cache_dir("prodigal")
+    entry_dir = os.path.join(cache_dir, key)
+    if max_size <= 0 or os.path.isfile(os.path.join(entry_dir, "complete")):
+        return
+
+    tmp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        for name, src in outputs.items():
+            link_file(src, os.path.join(tmp_dir, name))
+        open(os.path.join(tmp_dir, "complete"), "w").close()
+        os.rename(tmp_dir, entry_dir)
+    except OSError as e:
+        # Another run stored the same translation first
+        logging.debug(f"Could not store Prodigal output in the cache: {e}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+
+    evict(max_size, keep=key)
+
+
+def evict(max_size, keep=None):
+    """Remove the least recently used cache entries until the cache fits in max_size bytes."""
+    cache_dir = utilities.get_cache_dir("prodigal")
+    entries = []
+    for key in os.listdir(cache_dir):
+        marker = os.path.join(cache_dir, key, "complete")
+        if os.path.isfile(marker):
+            entries.append((os.path.getmtime(marker), key, entry_size(os.path.join(cache_dir, key))))
+        elif key.endswith(".tmp") and os.path.getmtime(os.path.join(cache_dir, key)) < time.time() - 24 * 3600:
+            # Left behind by a crashed run
+            shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+
+    total = sum(size for _, _, size in entries)
+    for _, key, size in sorted(entries):
+        if total <= max_size:
+            break
+        if key == keep:
+            continue
+        logging.info(f"Evicting {key} from the Prodigal cache")
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total -= size
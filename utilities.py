@@ -2,18 +2,21 @@ import shutil
 import os
 import sys
 import time
-import multiprocessing
 import logging
+import hashlib
+import sqlite3
+from scheduler import available_cores
 
 MAX_CORES = True
 CORES = 2
 
-def check_dependencies():
-    # List of commands to check
-    commands = ["hmmsearch", "featureCounts", "prodigal", "samtools"]
+def check_dependencies(skip=()):
+    # List of commands to check, the ones in skip are not needed by the run
+    commands = ["hmmsearch", "featureCounts", "prodigal"]
     
     for command in commands:
-        add_to_path(command)
+        if command not in skip:
+            add_to_path(command)
 
 # Find the full path to the command
 def get_path(command):
@@ -37,18 +40,66 @@ def add_to_path(command):
         raise ValueError(f"ERROR: {command} command not found")
 
 
-# Returns the number of logical cores on the cpu
+# Returns the cache directory shared between runs, PLASTICTOOLS_CACHE overrides the default location
+def get_cache_dir(*subdirs):
+    base = os.environ.get("PLASTICTOOLS_CACHE")
+    if not base:
+        base = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "plastictools")
+    cache_dir = os.path.join(base, *subdirs)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+# Returns the sha256 hex digest of the content of one or more files
+def hash_files(*files, extra=""):
+    digest = hashlib.sha256()
+    for file in files:
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    digest.update(extra.encode())
+    return digest.hexdigest()
+
+
+# Returns the identity of a file from its path, size, modification time and inode, without reading the file
+def file_identity(file):
+    stat = os.stat(file)
+    return f"{os.path.realpath(file)}:{stat.st_size}:{stat.st_mtime_ns}:{stat.st_ino}"
+
+
+# Returns the sha256 checksum of a file, remembered in the cache per path, size and modification time
+def file_checksum(file):
+    stat = os.stat(file)
+    key = (os.path.realpath(file), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    db = sqlite3.connect(os.path.join(get_cache_dir(), "checksums.sqlite"), timeout=60)
+    try:
+        db.execute("CREATE TABLE IF NOT EXISTS checksums (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, checksum TEXT)")
+        row = db.execute("SELECT size, mtime_ns, inode, checksum FROM checksums WHERE path = ?", (key[0],)).fetchone()
+        if row is not None and tuple(row[:3]) == key[1:]:
+            return row[3]
+
+        checksum = hash_files(file)
+        with db:
+            db.execute("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?)", key + (checksum,))
+        return checksum
+    finally:
+        db.close()
+
+
+# Returns the number of logical cores available to the run
 def get_logical_cores():
     if MAX_CORES:
-        return multiprocessing.cpu_count()
+        return available_cores()
     else:
-        return min(multiprocessing.cpu_count(), CORES)
+        return min(available_cores(), CORES)
     
 def set_cores(cores):
+    global MAX_CORES, CORES
     MAX_CORES = False
     CORES = cores
 
 def set_max_cores():
+    global MAX_CORES
     MAX_CORES = True
     
 